@@ -4,6 +4,7 @@ import subprocess
 import sys
 
 import dash_bootstrap_components as dbc
+import ursa.tiles as tiles
 
 from components.navbar import navbar
 from dash import Dash, html, dcc
@@ -80,6 +81,9 @@ app.layout = dbc.Container(
     fluid=True,
 )
 
+# XYZ tiles for the raster layers of the maps
+tiles.register(app.server)
+
 
 if __name__ == "__main__":
     try:
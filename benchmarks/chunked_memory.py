@@ -0,0 +1,123 @@
+"""Compares the peak memory of the urban growth table and the display
+rasters in default and chunked mode, on a synthetic metro written to a
+city store. Each mode runs in its own process and reports its resident
+memory before the analytics and its peak RSS.
+
+The 100 m rasters are generated and written chunk by chunk, so grids
+larger than memory can be benchmarked.
+
+Usage: python benchmarks/chunked_memory.py [size_km] [strip_budget]
+"""
+
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import dask.array as da
+import numpy as np
+import ursa.utils.store as store
+
+from pathlib import Path
+from urban_growth import YEARS, make_raster, make_smod
+
+
+def make_large_metro(size_km):
+    """SMOD of make_metro with lazy random BUILT_S and POP at 100 m."""
+
+    smod = make_smod(size_km, np.random.default_rng(0))
+
+    rng = da.random.default_rng(0)
+    shape = (len(YEARS), size_km * 10, size_km * 10)
+    chunks = (1, store.CHUNK_SIZE, store.CHUNK_SIZE)
+    built = rng.integers(0, 10000, shape, dtype="uint16", chunks=chunks)
+    pop = (rng.random(shape, dtype="float32", chunks=chunks) * 50).astype("float32")
+
+    origin = (-8e6 + 300, -2e6 - 700)
+    return smod, make_raster(built, 100, origin), make_raster(pop, 100, origin)
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes.
+
+    ru_maxrss carries over the peak of the parent across fork and exec, so
+    the high water mark of the process memory map is used where available.
+    """
+
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    """Resident memory of this process in bytes, 0 where unknown."""
+
+    status = Path("/proc/self/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def run(path_cache, size_km, strip_budget):
+    """Runs the growth table and display rasters of a stored metro."""
+
+    import ursa.ghsl as ghsl
+    import ursa.utils.chunked as chunked
+
+    from shapely.geometry import Point
+
+    smod = store.open_raster(path_cache, "SMOD").load()
+    built = store.open_raster(path_cache, "BUILT_S_100")
+    pop = store.open_raster(path_cache, "POP_100")
+    if strip_budget != "off":
+        chunked.enable(strip_budget)
+        built, pop = chunked.rechunk(built), chunked.rechunk(pop)
+
+    base = current_rss() / 1e6
+    centroid = Point(smod.x.values[size_km // 2], smod.y.values[size_km // 2])
+    start = time.perf_counter()
+    ghsl.get_urb_growth_df(smod, built, pop, centroid, path_cache)
+    ghsl.first_year_grid(built, 0.2, 1_000_000)
+    ghsl.display_density(built, "m", 1_000_000)
+    ghsl.display_density(pop, "km", 250_000)
+    elapsed = time.perf_counter() - start
+
+    peak = peak_rss() / 1e6
+    print(
+        f"{strip_budget:>8}: {elapsed:6.1f} s, "
+        f"RSS before {base:5.0f} MB, peak RSS {peak:5.0f} MB"
+    )
+
+
+def main():
+    size_km = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    strip_budget = sys.argv[2] if len(sys.argv) > 2 else "64MB"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path_cache = Path(tmp)
+        smod, built, pop = make_large_metro(size_km)
+        store.write_raster(path_cache, "SMOD", smod)
+        store.write_raster(path_cache, "BUILT_S_100", built)
+        store.write_raster(path_cache, "POP_100", pop)
+        band_mb = pop.nbytes / len(YEARS) / 1e6
+
+        print(f"Grid: {size_km * 10} x {size_km * 10} at 100 m, "
+              f"{band_mb:.0f} MB per POP band")
+        for budget in ("off", strip_budget):
+            subprocess.run(
+                [sys.executable, __file__, "--run", tmp, str(size_km), budget],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        run(Path(sys.argv[2]), int(sys.argv[3]), sys.argv[4])
+    else:
+        main()
@@ -0,0 +1,61 @@
+"""Compares colorizing a classified raster with a boolean mask per class
+against a single gather through a color table, with numpy and, if it is
+installed, numba.
+
+Usage: python benchmarks/colorize.py [size]
+"""
+
+import sys
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+import ursa.utils.render as render
+
+
+def colorize_masks(classes, n):
+    """Colorization as built_agg_overlay did it, a mask per class."""
+
+    img = np.zeros((*classes.shape, 4), dtype="uint8")
+    colors_rgba = [plt.get_cmap("cividis", n)(i) for i in range(n)]
+    colors = (np.array(colors_rgba) * 255).astype("uint8")
+    for k, color in enumerate(colors, start=1):
+        img[classes == k] = color
+    return img
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    out = f(*args)
+    return out, time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    n = 10
+    rng = np.random.default_rng(0)
+    classes = rng.integers(0, n + 1, (size, size), dtype="uint8")
+    table = render.categorical_table("cividis", n)
+
+    old, t_old = timed(colorize_masks, classes, n)
+
+    numba = render.numba
+    render.numba = None
+    new_np, t_np = timed(render.apply_lut, classes, table)
+    render.numba = numba
+    assert np.array_equal(old, new_np)
+
+    print(f"Grid: {size} x {size}, {n} classes")
+    print(f"Mask per class:   {t_old:.3f} s")
+    print(f"LUT, numpy:       {t_np:.3f} s ({t_old / t_np:.1f}x)")
+
+    if numba is not None:
+        # First call compiles
+        render.apply_lut(classes[:8, :8], table)
+        new_nb, t_nb = timed(render.apply_lut, classes, table)
+        assert np.array_equal(old, new_nb)
+        print(f"LUT, numba:       {t_nb:.3f} s ({t_old / t_nb:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
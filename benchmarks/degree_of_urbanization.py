@@ -0,0 +1,100 @@
+"""Compares the urban cluster classification of degree_of_urbanization
+with the per label loops it used to run, on a synthetic 100 m density
+grid with thousands of small clusters. Population filtering and hole
+filling are timed without and with majority rule smoothing.
+
+Usage: python benchmarks/degree_of_urbanization.py [size]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from scipy import ndimage
+from ursa.degree_of_urbanization import find_urban_clusters
+
+
+def make_density(size):
+    """Population density in people per km2, float32 as read from GHSL."""
+
+    rng = np.random.default_rng(0)
+    base = ndimage.gaussian_filter(rng.random((size, size)), 4)
+    base = (base - base.min()) / (base.max() - base.min())
+    return (rng.lognormal(0, 1, (size, size)) * base**4 * 3000).astype("float32")
+
+
+def find_urban_clusters_loop(
+    pop_array,
+    u_cluster_density=300,
+    u_cluster_pop=5000,
+    smooth=True,
+    min_hole_size=100,
+):
+    """find_urban_clusters with a mask per label and hole, smoothing each
+    cluster over the whole grid."""
+
+    u_cluster_array = np.zeros_like(pop_array, dtype="uint8")
+    u_cluster_array[pop_array >= u_cluster_density] = 1
+
+    kernel8 = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    clusters, nclusters = ndimage.label(u_cluster_array, structure=kernel8)
+    labels = []
+    for lbl in range(1, nclusters + 1):
+        mask = clusters == lbl
+        if pop_array[mask].sum() < u_cluster_pop:
+            u_cluster_array[mask] = 0
+        else:
+            labels.append(lbl)
+
+    if smooth:
+        kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
+        for lbl in labels:
+            current_center = (clusters == lbl).astype(int)
+            while True:
+                n_nbrs = ndimage.convolve(
+                    current_center, kernel, mode="constant", output=int
+                )
+                mask = n_nbrs >= 5
+                if mask.sum() == 0:
+                    break
+                current_center[mask] = 1
+                u_cluster_array[mask] += 1
+        u_cluster_array[u_cluster_array > 1] = 0
+
+    holes, nholes = ndimage.label(1 - u_cluster_array)
+    for h in range(1, nholes + 1):
+        mask = holes == h
+        if mask.sum() <= min_hole_size:
+            u_cluster_array[mask] = 1
+
+    return u_cluster_array
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    out = f(*args, **kwargs)
+    return out, time.perf_counter() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    density = make_density(size)
+    _, nclusters = ndimage.label(density >= 300, structure=np.ones((3, 3)))
+    print(f"Grid: {size} x {size}, {nclusters} candidate clusters")
+
+    # First call compiles
+    find_urban_clusters(density[:50, :50])
+
+    for smooth in (False, True):
+        old, t_old = timed(find_urban_clusters_loop, density, smooth=smooth)
+        new, t_new = timed(find_urban_clusters, density, smooth=smooth)
+        assert np.array_equal(old, new)
+
+        print(f"Smoothing: {smooth}")
+        print(f"  Mask per label: {t_old:.2f} s")
+        print(f"  Current:        {t_new:.3f} s ({t_old / t_new:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
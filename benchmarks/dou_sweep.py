@@ -0,0 +1,53 @@
+"""Compares a batched sweep of urban cluster thresholds with running the
+Degree of Urbanization of a year from scratch for every combination, on
+a synthetic 100 m density grid. Reports throughput in combinations per
+second.
+
+Usage: python benchmarks/dou_sweep.py [size]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from degree_of_urbanization import make_density
+from ursa.degree_of_urbanization import dou_sweep_year, dou_year
+
+DENSITIES = [200, 300, 400, 500]
+POPULATIONS = [2500, 5000, 10000, 20000]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    density = xr.DataArray(make_density(size), dims=("y", "x"))
+    builtup = density.copy(data=np.clip(density.values / 5000, 0, 1))
+    param_sets = [(d, p) for d in DENSITIES for p in POPULATIONS]
+    print(f"Grid: {size} x {size}, {len(param_sets)} combinations")
+
+    # First call compiles
+    dou_sweep_year(density[:50, :50], builtup[:50, :50], 2020, param_sets[:1])
+
+    start = time.perf_counter()
+    old = [
+        dou_year(density, builtup, 2020, u_cluster_density=d, u_cluster_pop=p)[1]
+        for d, p in param_sets
+    ]
+    t_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = dou_sweep_year(density, builtup, 2020, param_sets)
+    t_new = time.perf_counter() - start
+
+    for a, b in zip(old, new):
+        pd.testing.assert_frame_equal(a, b)
+
+    n = len(param_sets)
+    print(f"  From scratch: {t_old:.2f} s, {n / t_old:.1f} combinations/s")
+    print(f"  Batched:      {t_new:.2f} s, {n / t_new:.1f} combinations/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Compares drawing the 2020 cluster outlines of the growth maps with a
+px.line_mapbox figure per cluster against a single trace per zone, on a
+synthetic metro. Reports figure construction time and JSON size.
+
+Usage: python benchmarks/outlines.py [size_km]
+"""
+
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+import xarray as xr
+
+from affine import Affine
+from scipy import ndimage
+from shapely.geometry import Point, box
+from ursa.ghsl import add_zone_outlines, smod_polygons
+
+YEARS = list(range(1975, 2021, 5))
+NAMES = {
+    "Central Zone": "Central Zone",
+    "Peripheral Zones": "Peripheral Zones",
+    "Analysis Zone": "Analysis Zone",
+}
+
+
+def make_smod(size_km):
+    """SMOD at 1 km with a main cluster and many satellite towns."""
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:size_km, :size_km]
+    dist = np.hypot(yy - size_km / 2, xx - size_km / 2)
+    noise = ndimage.gaussian_filter(rng.random((size_km, size_km)), 2)
+
+    urban = (dist + 40 * (noise - noise.mean()) * size_km / 100) < size_km * 0.25
+    towns = noise > np.quantile(noise, 0.95)
+    smod = np.where(urban, 30, np.where(towns, 22, 11)).astype("uint8")
+    smod = np.repeat(smod[None], len(YEARS), axis=0)
+
+    transform = Affine(1000.0, 0.0, -8e6, 0.0, -1000.0, 2e6)
+    x = transform.c + (np.arange(size_km) + 0.5) * 1000
+    y = transform.f - (np.arange(size_km) + 0.5) * 1000
+    smod = xr.DataArray(
+        smod, coords={"band": YEARS, "y": y, "x": x}, dims=("band", "y", "x")
+    )
+    return smod.rio.write_crs("ESRI:54009").rio.write_transform(transform)
+
+
+def outlines_px(fig, clusters, bbox_mollweide):
+    """Outlines as the growth maps drew them, a px figure per cluster."""
+
+    clusters = clusters.to_crs(4326)
+    n_mains = 0
+    n_other = 0
+    for _, row in clusters.iterrows():
+        if row.is_main:
+            name = NAMES["Central Zone"]
+            n_mains += 1
+        else:
+            name = NAMES["Peripheral Zones"]
+            n_other += 1
+
+        x, y = row.geometry.exterior.xy
+        p_df = pd.DataFrame({"lats": y, "lons": x})
+        p_fig = px.line_mapbox(
+            p_df,
+            lat="lats",
+            lon="lons",
+            color=[name] * len(x),
+            color_discrete_map={
+                NAMES["Central Zone"]: "maroon",
+                NAMES["Peripheral Zones"]: "orange",
+            },
+        )
+        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
+        if row.is_main and n_mains > 1:
+            p_fig.update_traces(showlegend=False)
+        if not row.is_main and n_other > 1:
+            p_fig.update_traces(showlegend=False)
+        fig.add_traces(p_fig.data)
+
+    bbox_temp = (
+        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
+        .to_crs(4326)
+        .geometry.iloc[0]
+    )
+    x, y = bbox_temp.exterior.xy
+    p_df = pd.DataFrame({"lats": y, "lons": x})
+    p_fig = px.line_mapbox(
+        p_df,
+        lat="lats",
+        lon="lons",
+        color=[NAMES["Analysis Zone"]] * len(x),
+        color_discrete_map={NAMES["Analysis Zone"]: "blue"},
+    )
+    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
+    fig.add_traces(p_fig.data)
+
+
+def timed(f, *args):
+    fig = go.Figure()
+    start = time.perf_counter()
+    f(fig, *args)
+    fig_json = fig.to_json()
+    return fig, time.perf_counter() - start, len(fig_json)
+
+
+def n_vertices(fig):
+    return sum(sum(v is not None for v in trace.lon) for trace in fig.data)
+
+
+def main():
+    size_km = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    smod = make_smod(size_km)
+    centroid = Point(smod.x.values[size_km // 2], smod.y.values[size_km // 2])
+    bbox_mollweide = box(*smod.rio.bounds())
+
+    smod_p = smod_polygons(smod, centroid)
+    clusters = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
+
+    old, t_old, size_old = timed(outlines_px, clusters, bbox_mollweide)
+    new, t_new, size_new = timed(add_zone_outlines, clusters, bbox_mollweide, NAMES)
+
+    print(f"Clusters: {len(clusters)}")
+    print(f"px.line_mapbox per cluster: {len(old.data)} traces, {n_vertices(old)} "
+          f"vertices, {t_old:.2f} s, {size_old / 1e3:.0f} KB")
+    print(f"Single trace per zone:      {len(new.data)} traces, {n_vertices(new)} "
+          f"vertices, {t_new:.2f} s, {size_new / 1e3:.0f} KB")
+    print(f"Speedup: {t_old / t_new:.1f}x, JSON {size_old / size_new:.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
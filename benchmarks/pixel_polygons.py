@@ -0,0 +1,80 @@
+"""Compares building a polygon per pixel with DataFrame.apply(row2cell)
+against the vectorized xy2cells, on a synthetic BUILT_S stack.
+
+Usage: python benchmarks/pixel_polygons.py [size] [n_years]
+"""
+
+import sys
+import time
+
+import geopandas as gpd
+import numpy as np
+import xarray as xr
+
+from affine import Affine
+from ursa.ghsl import built_s_polygons
+from ursa.utils.raster import row2cell
+
+
+def make_built(size, n_years):
+    rng = np.random.default_rng(0)
+    # About half of the pixels are built up
+    data = rng.random((n_years, size, size), dtype="float32") * 2e4 - 1e4
+    data = np.clip(data, 0, None)
+
+    transform = Affine(100.0, 0.0, -8e6, 0.0, -100.0, -2e6)
+    x = transform.c + (np.arange(size) + 0.5) * transform.a
+    y = transform.f + (np.arange(size) + 0.5) * transform.e
+    built = xr.DataArray(
+        data,
+        coords={"band": list(range(1975, 1975 + 5 * n_years, 5)), "y": y, "x": x},
+        dims=("band", "y", "x"),
+    )
+    built = built.rio.write_crs("ESRI:54009").rio.write_transform(transform)
+    return built
+
+
+def built_s_polygons_apply(built):
+    """built_s_polygons as it was, one row2cell call per pixel."""
+
+    resolution = built.rio.resolution()
+    pixel_area = abs(np.prod(resolution))
+
+    built_df = built.to_dataframe(name="b_area").reset_index()
+    built_df = built_df.rename(columns={"band": "year"})
+    built_df = built_df.drop(columns="spatial_ref")
+
+    built_df = built_df[built_df.b_area > 0].reset_index(drop=True)
+
+    built_df["fraction"] = built_df.b_area / pixel_area
+    built_df["geometry"] = built_df.apply(row2cell, res_xy=resolution, axis=1)
+
+    built_gdf = gpd.GeoDataFrame(built_df, crs=built.rio.crs).drop(columns=["x", "y"])
+
+    return built_gdf
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    n_years = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    built = make_built(size, n_years)
+
+    start = time.perf_counter()
+    old = built_s_polygons_apply(built)
+    t_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = built_s_polygons(built)
+    t_new = time.perf_counter() - start
+
+    assert old.geometry.geom_equals_exact(new.geometry, tolerance=0).all()
+    assert old.drop(columns="geometry").equals(new.drop(columns="geometry"))
+
+    print(f"Grid: {n_years} x {size} x {size}, {len(new)} built up pixels")
+    print(f"DataFrame.apply(row2cell): {t_old:.2f} s")
+    print(f"xy2cells:                  {t_new:.2f} s")
+    print(f"Speedup:                   {t_old / t_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
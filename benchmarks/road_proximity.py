@@ -0,0 +1,111 @@
+"""Compares the nearest road rasters of sleuth_prep, computed with a
+chessboard distance transform, with the KDTree queries they used to run, on
+a synthetic road grid. Each method runs in its own process and reports its
+time and how much it raises the peak RSS over the imports and the input.
+
+Distances must be identical. Where several roads are at the same distance
+the KDTree picks any of them, the transform the one with the lowest flat
+index, which is checked against a brute force search on a sample of cells.
+
+Usage: python benchmarks/road_proximity.py [size]
+"""
+
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from chunked_memory import peak_rss
+from scipy.spatial import KDTree
+from ursa.sleuth_prep import derive_auxiliary_roads_numpy
+
+
+def make_roads(size):
+    """Straight roads with weights 3 to 7 at random rows and columns, and
+    a few diagonals."""
+
+    rng = np.random.default_rng(0)
+    roads = np.zeros((size, size), dtype=np.int32)
+    n = size // 50
+    roads[rng.integers(0, size, n), :] = rng.integers(3, 8, (n, 1))
+    roads[:, rng.integers(0, size, n)] = rng.integers(3, 8, (1, n))
+    for offset in rng.integers(-size // 2, size // 2, 5):
+        idx = np.arange(max(0, -offset), min(size, size - offset))
+        roads[idx, idx + offset] = 7
+    return roads
+
+
+def derive_auxiliary_roads_kdtree(roads, d_metric=np.inf):
+    """derive_auxiliary_roads_numpy with a KDTree query for every cell."""
+
+    roads = roads.copy()
+    roads[0, :] = 0
+    roads[:, 0] = 0
+    roads[-1, :] = 0
+    roads[:, -1] = 0
+
+    road_idx = np.column_stack(np.where(roads > 0))
+    tree = KDTree(road_idx)
+    I, J = roads.shape
+    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
+    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
+    road_dist, idxs = tree.query(coords, p=d_metric)
+    road_dist = road_dist.reshape(roads.shape).astype(np.int32)
+    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
+    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+
+    return roads, road_i, road_j, road_dist
+
+
+METHODS = {
+    "kdtree": derive_auxiliary_roads_kdtree,
+    "transform": derive_auxiliary_roads_numpy,
+}
+
+
+def run(method, size, out):
+    roads = make_roads(size)
+    base = peak_rss()
+    start = time.perf_counter()
+    _, road_i, road_j, road_dist = METHODS[method](roads)
+    elapsed = time.perf_counter() - start
+
+    peak = (peak_rss() - base) / 1e6
+    print(f"{method:>9}: {elapsed:6.2f} s, peak RSS +{peak:4.0f} MB")
+    np.savez(out, road_i=road_i, road_j=road_j, road_dist=road_dist)
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"Grid: {size} x {size}")
+
+    results = {}
+    for method in METHODS:
+        out = f"/tmp/road_proximity_{method}.npz"
+        subprocess.run(
+            [sys.executable, __file__, "--run", method, str(size), out], check=True
+        )
+        results[method] = np.load(out)
+
+    old, new = results["kdtree"], results["transform"]
+    assert np.array_equal(old["road_dist"], new["road_dist"])
+
+    roads, _, _, _ = derive_auxiliary_roads_kdtree(make_roads(size))
+    road_i, road_j = np.nonzero(roads > 0)
+    rng = np.random.default_rng(0)
+    for i, j in rng.integers(0, size, (1000, 2)):
+        dist = np.maximum(np.abs(road_i - i), np.abs(road_j - j))
+        k = np.argmax(dist == dist.min())
+        assert (new["road_i"][i, j], new["road_j"][i, j]) == (road_i[k], road_j[k])
+
+    same = (old["road_i"] == new["road_i"]) & (old["road_j"] == new["road_j"])
+    print("Identical distances, lowest index nearest roads")
+    print(f"Same nearest road as the KDTree in {same.mean():.1%} of cells")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--run"]:
+        run(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        main()
@@ -0,0 +1,79 @@
+"""Compares building the GHSL multiband raster in memory against the former
+round trip through a temporary GeoTIFF.
+
+Usage: python benchmarks/stack_to_raster.py [size]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio as rio
+import rioxarray as rxr
+
+from affine import Affine
+from rasterio.crs import CRS
+from ursa.ghsl import stack_to_raster
+
+
+def make_stack(size, n_years=10):
+    rng = np.random.default_rng(0)
+    array_list = [
+        rng.random((1, size, size), dtype="float32") for _ in range(n_years)
+    ]
+    profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "nodata": -200.0,
+        "width": size,
+        "height": size,
+        "count": 1,
+        "crs": CRS.from_string("ESRI:54009"),
+        "transform": Affine(100.0, 0.0, -8e6, 0.0, -100.0, -2e6),
+    }
+    return array_list, profile
+
+
+def tempfile_round_trip(array_list, profile, year_list):
+    ghs_full = np.concatenate(array_list)
+    profile = dict(profile, count=ghs_full.shape[0])
+    tmp_name = os.path.join(tempfile.gettempdir(), os.urandom(24).hex())
+    with rio.open(tmp_name, "w", **profile) as dst:
+        dst.write(ghs_full)
+    raster = rxr.open_rasterio(tmp_name)
+    raster.coords["band"] = year_list
+    raster.load()
+    return raster, tmp_name
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    year_list = list(range(1975, 2021, 5))
+    array_list, profile = make_stack(size, len(year_list))
+
+    start = time.perf_counter()
+    old, tmp_name = tempfile_round_trip(array_list, profile, year_list)
+    t_old = time.perf_counter() - start
+    leaked = os.path.getsize(tmp_name)
+    os.remove(tmp_name)
+
+    start = time.perf_counter()
+    new = stack_to_raster(array_list, profile, year_list)
+    t_new = time.perf_counter() - start
+
+    assert np.array_equal(old.values, new.values)
+    assert np.array_equal(old.x.values, new.x.values)
+    assert np.array_equal(old.y.values, new.y.values)
+    assert old.rio.transform() == new.rio.transform()
+    assert old.rio.crs == new.rio.crs
+
+    print(f"Grid: {len(year_list)} x {size} x {size}")
+    print(f"Temporary file round trip: {t_old:.3f} s")
+    print(f"In memory:                 {t_new:.3f} s")
+    print(f"Disk bytes written and read back per dataset: {leaked / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
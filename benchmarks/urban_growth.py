@@ -0,0 +1,146 @@
+"""Compares the built-up and population sums per cluster of
+get_urb_growth_df computed with rio.clip against the label grid version, on a synthetic
+metro. Population sums are compared with rio.clip sums accumulated in float32,
+as the app did, and in float64, as the label grid version does.
+
+Usage: python benchmarks/urban_growth.py [size_km]
+"""
+
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+
+from affine import Affine
+from scipy import ndimage
+from shapely.geometry import Point
+from ursa.ghsl import cluster_labels, cluster_sums, smod_polygons
+
+YEARS = list(range(1975, 2021, 5))
+
+
+def make_raster(data, res, origin=(-8e6, -2e6)):
+    transform = Affine(res, 0.0, origin[0], 0.0, -res, origin[1])
+    _, height, width = data.shape
+    x = transform.c + (np.arange(width) + 0.5) * res
+    y = transform.f - (np.arange(height) + 0.5) * res
+    raster = xr.DataArray(
+        data, coords={"band": YEARS, "y": y, "x": x}, dims=("band", "y", "x")
+    )
+    return raster.rio.write_crs("ESRI:54009").rio.write_transform(transform)
+
+
+def make_smod(size_km, rng):
+    """SMOD at 1 km with a growing main cluster and satellite towns."""
+
+    yy, xx = np.mgrid[:size_km, :size_km]
+    center = size_km / 2
+    dist = np.hypot(yy - center, xx - center)
+    noise = ndimage.gaussian_filter(rng.random((size_km, size_km)), 3)
+
+    smod = []
+    for i, _ in enumerate(YEARS):
+        radius = size_km * (0.1 + 0.02 * i)
+        urban = (dist + 40 * (noise - noise.mean()) * size_km / 100) < radius
+        towns = noise > np.quantile(noise, 0.97 - 0.005 * i)
+        smod.append(np.where(urban, 30, np.where(towns, 22, 11)))
+    return make_raster(np.array(smod, dtype="uint8"), 1000)
+
+
+def make_metro(size_km):
+    """SMOD at 1 km with a growing main cluster and satellite towns, BUILT_S
+    (uint16) and POP (float32) at 100 m."""
+
+    rng = np.random.default_rng(0)
+    smod = make_smod(size_km, rng)
+
+    shape = (len(YEARS), size_km * 10, size_km * 10)
+    built = rng.integers(0, 10000, shape, dtype="uint16")
+    pop = (rng.random(shape, dtype="float32") * 50).astype("float32")
+
+    # As for real bounding boxes, the 100 m window does not start on a 1 km
+    # pixel edge
+    origin = (-8e6 + 300, -2e6 - 700)
+    return smod, make_raster(built, 100, origin), make_raster(pop, 100, origin)
+
+
+def sums_clip(built, pop, clusters_gdf, main_cluster, dtype=None):
+    out = []
+    for year in YEARS:
+        cluster = main_cluster[main_cluster.year == year].geometry.iloc[0]
+        cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
+        row = []
+        for raster, geoms in [
+            (built, [cluster]),
+            (pop, [cluster]),
+            (built, cluster_all),
+            (pop, cluster_all),
+        ]:
+            row.append(
+                np.nansum(
+                    raster.sel(band=year)
+                    .rio.set_nodata(0)
+                    .rio.clip(geoms, crs=raster.rio.crs)
+                    .values,
+                    dtype=dtype,
+                )
+            )
+        out.append(row)
+    return np.array(out, dtype="float64")
+
+
+def sums_labels(smod, built, pop, clusters_gdf, main_cluster):
+    out = []
+    for year in YEARS:
+        cluster = main_cluster[main_cluster.year == year].geometry.iloc[0]
+        cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
+        labels = cluster_labels(cluster_all, cluster, smod)
+        b = cluster_sums(built, year, labels, smod, cluster_all, cluster)
+        p = cluster_sums(pop, year, labels, smod, cluster_all, cluster)
+        out.append([b[2], p[2], b[1] + b[2], p[1] + p[2]])
+    return np.array(out, dtype="float64")
+
+
+def main():
+    size_km = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    smod, built, pop = make_metro(size_km)
+    centroid = Point(smod.x.values[size_km // 2], smod.y.values[size_km // 2])
+
+    smod_gdf = smod_polygons(smod, centroid)
+    clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
+    main_cluster = clusters_gdf[clusters_gdf.is_main]
+
+    start = time.perf_counter()
+    old = sums_clip(built, pop, clusters_gdf, main_cluster)
+    t_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = sums_labels(smod, built, pop, clusters_gdf, main_cluster)
+    t_new = time.perf_counter() - start
+
+    built_cols = [0, 2]
+    pop_cols = [1, 3]
+    assert np.array_equal(old[:, built_cols], new[:, built_cols])
+
+    def max_rel(ref):
+        return (np.abs(ref - new[:, pop_cols]) / np.abs(new[:, pop_cols])).max()
+
+    # Float32 pop sums, as the app computed them, and the same sums
+    # accumulated in float64
+    old_64 = sums_clip(built, pop, clusters_gdf, main_cluster, dtype="float64")
+    rel = max_rel(old[:, pop_cols])
+    rel_64 = max_rel(old_64[:, pop_cols])
+
+    print(f"Grid: {len(YEARS)} x {size_km * 10} x {size_km * 10} at 100 m")
+    print(f"Clusters: {len(clusters_gdf)} polygons over {len(YEARS)} years")
+    print(f"rio.clip:         {t_old:.2f} s")
+    print(f"label grid:       {t_new:.2f} s")
+    print(f"Speedup:          {t_old / t_new:.1f}x")
+    print("Built sums identical.")
+    print(f"Max relative difference of pop sums, float32 rio.clip: {rel:.1e}")
+    print(f"Max relative difference of pop sums, float64 rio.clip: {rel_64:.1e}")
+
+
+if __name__ == "__main__":
+    main()
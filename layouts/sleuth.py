@@ -1,11 +1,11 @@
 import json
 import os
-import requests
 
 import dash_bootstrap_components as dbc
 import numpy as np
 import pandas as pd
 import plotly.express as px
+import ursa.utils.sources as sources
 import xarray as xr
 
 from dash import html
@@ -249,15 +249,18 @@ def download_sleuth_predictions(path_cache, id_hash, mode):
             print(f"El archivo {local_filename} ya está descargado.")
             return
 
-        url = f"http://{bucket}.s3.amazonaws.com/SLEUTH_predictions/{id_hash}/{modes[mode]}.npy"
-        r = requests.get(url, allow_redirects=True)
+        source = sources.get_source(bucket)
+        try:
+            content = source.read_bytes(
+                f"SLEUTH_predictions/{id_hash}/{modes[mode]}.npy"
+            )
+        except FileNotFoundError as e:
+            print(f"Error al descargar el archivo. {e}")
+            return
 
-        if r.status_code == 200:
-            with open(path_cache / local_filename, "wb") as file:
-                file.write(r.content)
-            print(f"Archivo {local_filename} descargado exitosamente.")
-        else:
-            print(f"Error al descargar el archivo. Código de estado: {r.status_code}")
+        with open(path_cache / local_filename, "wb") as file:
+            file.write(content)
+        print(f"Archivo {local_filename} descargado exitosamente.")
 
 
 def load_sleuth_predictions(path_cache, id_hash, mode):
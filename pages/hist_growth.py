@@ -2,6 +2,7 @@ import dash
 
 import dash_bootstrap_components as dbc
 import ursa.ghsl as ghsl
+import ursa.prefetch as prefetch
 import ursa.utils.geometry as ug
 
 from components.text import figureWithDescription, figureWithDescription_translation, figureWithDescription_translation2
@@ -677,9 +678,10 @@ def generate_lines(id_hash, bbox_latlon, uc_latlon, btn_lang_es, btn_lang_en, bt
 
     centroid_mollweide = uc_mollweide.centroid
 
+    prefetch.attach(id_hash, "ghsl")
     smod, built, pop = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
 
-    growth_df = ghsl.get_urb_growth_df(
+    growth_df = ghsl.load_or_get_urb_growth_df(
         smod=smod,
         built=built,
         pop=pop,
@@ -793,12 +795,12 @@ def generate_lines(id_hash, bbox_latlon, uc_latlon, btn_lang_es, btn_lang_en, bt
             plots.append(dash.no_update)
             error_triggered = True
 
-    map1 = ghsl.plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, language = language)
+    map1 = ghsl.plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, language = language, path_cache=path_cache)
     map2 = ghsl.plot_smod_clusters(smod, bbox_latlon, language=language)
     map3 = ghsl.plot_built_year_img(
-        smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, language = language
+        smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, language = language, path_cache=path_cache
     )
-    map4 = ghsl.plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, language = language)
+    map4 = ghsl.plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, language = language, path_cache=path_cache)
 
     plots.append(map1)
     plots.append(map2)
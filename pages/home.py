@@ -4,6 +4,7 @@ import json
 import dash_bootstrap_components as dbc
 import dash_leaflet as dl
 import geopandas as gpd
+import ursa.prefetch as prefetch
 import ursa.utils.raster as ru
 
 from dash import callback, html, Input, Output, State
@@ -266,6 +267,10 @@ def set_city(n_clicks, country, city):
     path_cache = Path(f"./data/cache/{str(id_hash)}")
     path_cache.mkdir(exist_ok=True, parents=True)
 
+    # Start filling the cache of every page while the user is still on the
+    # map, pages join the work in flight through prefetch.attach.
+    prefetch.warm_up(id_hash, bbox_latlon, uc_latlon, path_cache)
+
     centroid = bbox_latlon.centroid
 
     coords = bbox_latlon.exterior.coords
@@ -324,6 +329,8 @@ def set_custom_bbox(n_clicks, geojson, bbox_orig):
             "danger",
         )
 
+    # The custom region lies inside the original one, so its GHSL rasters
+    # are assembled from the global tile cache without new downloads.
     id_hash = hash_geometry(bbox_json)
     path_cache = Path(f"./data/cache/{str(id_hash)}")
     path_cache.mkdir(exist_ok=True, parents=True)
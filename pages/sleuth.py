@@ -13,6 +13,7 @@ import plotly.express as px
 import rasterio as rio
 import rasterio.warp as warp
 import sleuth_sklearn.utils as utils
+import ursa.prefetch as prefetch
 import ursa.sleuth_prep as sp
 import ursa.utils.geometry as ug
 import xarray as xr
@@ -2976,6 +2977,7 @@ def download_data(id_hash, bbox_latlon, btn_lang_es, btn_lang_en, btn_lang_pt):
     bbox_latlon = shape(bbox_latlon)
     bbox_mollweide = ug.reproject_geometry(bbox_latlon, "ESRI:54009").envelope
 
+    prefetch.attach(id_hash, "sleuth")
     sp.load_or_prep_rasters(bbox_mollweide, path_cache)
 
     with open(path_cache / "attributes.json", "r") as f:
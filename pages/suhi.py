@@ -6,6 +6,7 @@ import dash_bootstrap_components as dbc
 import pandas as pd
 import ursa.heat_islands as ht
 import ursa.plots.heat_islands as pht
+import ursa.prefetch as prefetch
 import ursa.utils.date as du
 import ursa.utils.geometry as ug
 import ursa.utils.raster as ru
@@ -418,8 +419,8 @@ tab_translations = {
 
 start_time_suhi = None
 
-SEASON = "Qall"
-YEAR = 2022
+SEASON = ht.DEFAULT_SEASON
+YEAR = ht.DEFAULT_YEAR
 
 path_fua = Path("./data/output/cities/")
 
@@ -1296,6 +1297,10 @@ def generate_maps(id_hash, bbox_latlon, fua_latlon, uc_latlon, btn_lang_es, btn_
     uc_latlon = shape(uc_latlon)
     bbox_ee = ru.bbox_to_ee(bbox_latlon)
 
+    # Join the warm-up started on city selection, it leaves the GEE
+    # statistics below in the cache.
+    prefetch.attach(id_hash, "suhi")
+
     start_date, end_date = ht.date_format(SEASON, YEAR)
 
     try:
@@ -1,10 +1,24 @@
+import itertools
+import time
+
 import numpy as np
 import pandas as pd
 import rioxarray as rxr
+import ursa.ghsl as ghsl
+import ursa.utils.cache as uc
+import ursa.utils.chunked as chunked
+import ursa.utils.raster as ru
 import xarray as xr
 
-from scipy.ndimage import label, convolve, center_of_mass
-from ursa.ghsl import load_or_download
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.transform import from_origin
+from scipy.ndimage import label, convolve, find_objects
+from scipy.sparse import coo_matrix
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 lvl_1_classes = {
@@ -13,6 +27,191 @@ lvl_1_classes = {
     "Rural": 0,  # 1
 }
 
+# Default thresholds of the Degree of Urbanization, densities in people
+# per km2, populations in people and built-up as a fraction of the cell
+dou_thresholds = dict(
+    u_center_density=1500,
+    u_center_pop=50000,
+    builtup_trshld=0.5,
+    u_cluster_density=300,
+    u_cluster_pop=5000,
+)
+
+# Codes of the level 1 classes in GHS SMOD rasters, smod // 10 gives the
+# class. Cells are not split into level 2 classes, each class gets its
+# lowest level 2 code.
+smod_codes = {
+    "Urban Center": 30,
+    "Urban Cluster": 21,
+    "Rural": 11,
+}
+
+
+def cluster_totals(clusters, nclusters, pop_array):
+    """Total population of every label of clusters, in float64."""
+
+    return np.bincount(
+        clusters.ravel(), weights=pop_array.ravel(), minlength=nclusters + 1
+    )
+
+
+def populated_clusters(
+    clusters, nclusters, pop_array, min_pop, totals=None, objects=None
+):
+    """Finds the clusters with a total population of at least min_pop.
+
+    Totals of all clusters are taken with a single bincount of the label
+    grid. bincount sums in float64 while a masked sum keeps the dtype of
+    pop_array, so totals close to min_pop are summed again over the mask,
+    within the bounding box of the cluster. The result is the same as
+    comparing pop_array[clusters == lbl].sum() for every label.
+
+    Parameters
+    ----------
+    clusters : np.ndarray
+        Label grid, 0 for the background.
+    nclusters : int
+        Number of labels.
+    pop_array : np.ndarray
+        Population grid.
+    min_pop : float
+        Minimum total population of a cluster.
+    totals : np.ndarray, optional
+        bincount totals of every label, to test several min_pop on the
+        same labels without summing again.
+    objects : list of slice, optional
+        find_objects of clusters, for the same purpose.
+
+    Returns
+    -------
+    keep : np.ndarray
+        Boolean lookup table indexed by label, False for the background.
+
+    """
+
+    if totals is None:
+        totals = cluster_totals(clusters, nclusters, pop_array)
+    keep = totals >= min_pop
+    keep[0] = False
+
+    close = np.flatnonzero(np.isclose(totals, min_pop, rtol=1e-3, atol=0))
+    close = close[close > 0]
+    if len(close) > 0:
+        if objects is None:
+            objects = find_objects(clusters)
+        for lbl in close:
+            window = objects[lbl - 1]
+            total_pop = pop_array[window][clusters[window] == lbl].sum()
+            keep[lbl] = not total_pop < min_pop
+
+    return keep
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _majority_fill(current):
+        height, width = current.shape
+        rows = np.empty(current.size, dtype=np.int64)
+        cols = np.empty(current.size, dtype=np.int64)
+        while True:
+            # Cells are added all at once, as with the convolution
+            n_new = 0
+            for i in range(height):
+                for j in range(width):
+                    if current[i, j]:
+                        continue
+                    n_nbrs = 0
+                    for k in range(max(i - 1, 0), min(i + 2, height)):
+                        for m in range(max(j - 1, 0), min(j + 2, width)):
+                            n_nbrs += current[k, m]
+                    if n_nbrs >= 5:
+                        rows[n_new] = i
+                        cols[n_new] = j
+                        n_new += 1
+            if n_new == 0:
+                break
+            for n in range(n_new):
+                current[rows[n], cols[n]] = 1
+        return current
+
+
+def majority_fill(center):
+    """Grows a binary cluster by majority rule until no cells are added.
+
+    Non cluster cells with 5 or more of their 8 neighbours in the cluster
+    are added to it, repeatedly. A cell outside the bounding box of the
+    cluster has at most 3 neighbours inside it, so the cluster never grows
+    out of its bounding box and center can be cropped to it.
+
+    Parameters
+    ----------
+    center : np.ndarray
+        Boolean grid, True on the cluster.
+
+    Returns
+    -------
+    grown : np.ndarray
+        Boolean grid with the grown cluster.
+
+    """
+
+    current_center = center.astype("uint8")
+    if numba is not None:
+        return _majority_fill(current_center).astype(bool)
+
+    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
+    while True:
+        # Find number of neighbors of each cell
+        # Non urban pixels have neighbor values 0-8, while urban
+        # pixels have -8-0
+        n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
+        # New cells are non urban pixels with >=5 neighbors
+        mask = n_nbrs >= 5
+        if mask.sum() == 0:
+            break
+        current_center[mask] = 1
+    return current_center.astype(bool)
+
+
+def smooth_clusters(u_array, clusters, labels, grown=None):
+    """Fills gaps and smooths the borders of clusters by majority rule.
+
+    Each cluster is grown on its own within its bounding box, see
+    majority_fill, and its new cells are counted in u_array. Cells added
+    to more than one cluster, or added to a cluster while belonging to
+    another one, end up with counts over 1 and are removed.
+
+    Parameters
+    ----------
+    u_array : np.ndarray
+        uint8 grid, 1 on the clusters, updated in place.
+    clusters : np.ndarray
+        Label grid of the clusters.
+    labels : array_like
+        Labels of the clusters to smooth.
+    grown : dict, optional
+        Window and new cells of each label, filled on the first call and
+        reused by later calls on the same labeling. A cluster grows the
+        same whatever other clusters are kept.
+
+    """
+
+    if grown is None:
+        grown = {}
+
+    objects = None
+    for lbl in labels:
+        if lbl not in grown:
+            if objects is None:
+                objects = find_objects(clusters)
+            window = objects[lbl - 1]
+            center = clusters[window] == lbl
+            grown[lbl] = window, majority_fill(center) & ~center
+        window, added = grown[lbl]
+        u_array[window] += added
+    u_array[u_array > 1] = 0
+
 
 def find_urban_centers(
     pop_array,
@@ -34,38 +233,15 @@ def find_urban_centers(
 
     # Find their total population and remove them from
     # urban center array if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_center_pop:
-            u_center_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    keep = populated_clusters(clusters, nclusters, pop_array, u_center_pop)
+    removed = ~keep[clusters]
+    u_center_array[removed] = 0
+    clusters[removed] = 0
+    labels = np.flatnonzero(keep)
 
     # Fill gaps and smooth borders, majority rule
-    # Apply per urban center, find all candidates
-    # for allocation
-    kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-    for lbl in labels:
-        # This needs to be done iteratively until no more additions are performed
-        current_center = (clusters == lbl).astype(int)
-        while True:
-            # Find number of neighbors of each cell
-            # Non urban pixels have neighbor values 0-8, while urban
-            # pixels have -8-0
-            n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-            # New cells are non urban pixels with >=5 neighbors
-            mask = n_nbrs >= 5
-            if mask.sum() == 0:
-                break
-            # Update both current center and urban_center_array
-            current_center[mask] = 1
-            u_center_array[mask] += 1
-    # Cells added to more than one urban center have counts > 1.
-    # Remove them
-    u_center_array[u_center_array > 1] = 0
+    # Cells added to more than one urban center are removed
+    smooth_clusters(u_center_array, clusters, labels)
 
     if fill:
         # Fill holes smaller than min hole size, defaults to 15km
@@ -73,10 +249,10 @@ def find_urban_centers(
         inverted = 1 - u_center_array
         # Find all holes smaller than min size
         holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_center_array[mask] = 1
+        sizes = np.bincount(holes.ravel(), minlength=nholes + 1)
+        small = sizes <= min_hole_size
+        small[0] = False
+        u_center_array[small[holes]] = 1
 
     return u_center_array
 
@@ -98,42 +274,40 @@ def find_urban_clusters(
     kernel8 = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
     clusters, nclusters = label(u_cluster_array, structure=kernel8)
 
-    # Find their total population and remove them from
-    # if necessary
-    labels = []
-    for lbl in range(1, nclusters + 1):
-        mask = clusters == lbl
-        total_pop = pop_array[mask].sum()
-        if total_pop < u_cluster_pop:
-            u_cluster_array[mask] = 0
-            clusters[mask] = 0
-        else:
-            labels.append(lbl)
+    # Find their total population
+    keep = populated_clusters(clusters, nclusters, pop_array, u_cluster_pop)
+
+    return clean_clusters(
+        u_cluster_array, clusters, keep, smooth, fill, min_hole_size
+    )
+
+
+def clean_clusters(
+    u_cluster_array,
+    clusters,
+    keep,
+    smooth=True,
+    fill=True,
+    min_hole_size=100,
+    grown=None,
+):
+    """Removes the urban clusters not in keep from u_cluster_array, then
+    smooths and fills the remaining ones as in find_urban_clusters.
+
+    u_cluster_array and clusters are modified in place, and
+    u_cluster_array is returned. See smooth_clusters for grown.
+    """
+
+    # Remove the clusters not populated enough
+    removed = ~keep[clusters]
+    u_cluster_array[removed] = 0
+    clusters[removed] = 0
+    labels = np.flatnonzero(keep)
 
     if smooth:
         # Fill gaps and smooth borders, majority rule
-        # Apply per urban center, find all candidates
-        # for allocation
-        kernel = np.array([[1, 1, 1], [1, -8, 1], [1, 1, 1]])
-        for lbl in labels:
-            # This needs to be done iteratively until no more
-            # additions are performed
-            current_center = (clusters == lbl).astype(int)
-            while True:
-                # Find number of neighbors of each cell
-                # Non urban pixels have neighbor values 0-8, while urban
-                # pixels have -8-0
-                n_nbrs = convolve(current_center, kernel, mode="constant", output=int)
-                # New cells are non urban pixels with >=5 neighbors
-                mask = n_nbrs >= 5
-                if mask.sum() == 0:
-                    break
-                # Update both current center and urban_center_array
-                current_center[mask] = 1
-                u_cluster_array[mask] += 1
-        # Cells added to more than one urban center have counts > 1.
-        # Remove them
-        u_cluster_array[u_cluster_array > 1] = 0
+        # Cells added to more than one urban cluster are removed
+        smooth_clusters(u_cluster_array, clusters, labels, grown)
 
     if fill:
         # Fill holes smaller min_hole_size, defaults to 1km
@@ -141,10 +315,10 @@ def find_urban_clusters(
         inverted = 1 - u_cluster_array
         # Find all holes smaller than min size
         holes, nholes = label(inverted)
-        for h in range(1, nholes + 1):
-            mask = holes == h
-            if mask.sum() <= min_hole_size:
-                u_cluster_array[mask] = 1
+        sizes = np.bincount(holes.ravel(), minlength=nholes + 1)
+        small = sizes <= min_hole_size
+        small[0] = False
+        u_cluster_array[small[holes]] = 1
 
     return u_cluster_array
 
@@ -177,10 +351,110 @@ def dou_lvl1(
     return dou_rxr
 
 
+def grid_sums(raster, year, transform, shape):
+    """Sums a band of a 100 m GHS raster into the pixels of a nested grid,
+    counting nodata as 0."""
+
+    band = raster.sel(band=year)
+    nodata = raster.rio.nodata
+    if nodata is not None:
+        band = band.where(band != nodata, 0)
+
+    if chunked.is_enabled():
+        return chunked.block_sums(band, raster.rio.transform(), transform, shape)
+
+    return ru.block_sums(band.values, raster.rio.transform(), transform, shape)
+
+
+def smod_from_ghs(pop, built):
+    """Level 1 Degree of Urbanization on a 1 km grid, from the 100 m GHS
+    population and built-up surface.
+
+    Both rasters are summed into the 1 km grid of GHS SMOD that covers
+    them. Urban centers follow find_urban_centers, with holes of up to
+    15 km2 filled, and urban clusters are the 8-connected cells with at
+    least 300 people per km2 and 5000 people in total, with no smoothing.
+    Cells at the edges partly outside the 100 m rasters are summed over
+    the covered part only.
+
+    Parameters
+    ----------
+    pop : xarray.DataArray
+        GHS POP raster at 100 m, people per cell, one band per year.
+    built : xarray.DataArray
+        GHS BUILT_S raster on the same grid, built-up m2 per cell.
+
+    Returns
+    -------
+    smod : xarray.DataArray
+        uint8 raster with the same bands as pop, coded as GHS SMOD, see
+        smod_codes.
+
+    """
+
+    # Cells of 1 km2, population sums are densities in people per km2
+    resolution = 1000
+    transform = pop.rio.transform()
+    left, top = transform.c, transform.f
+    right = left + transform.a * pop.rio.width
+    bottom = top + transform.e * pop.rio.height
+
+    # Snap outwards to the global grid of the 1 km GHS rasters
+    x0 = np.floor(left / resolution) * resolution
+    y0 = np.ceil(top / resolution) * resolution
+    width = int(np.ceil((right - x0) / resolution))
+    height = int(np.ceil((y0 - bottom) / resolution))
+    smod_transform = from_origin(x0, y0, resolution, resolution)
+
+    years = pop.coords["band"].values
+    smod_array = np.full(
+        (len(years), height, width), smod_codes["Rural"], dtype="uint8"
+    )
+    for i, year in enumerate(years):
+        print(f"Deriving SMOD for {year} ...")
+        density = grid_sums(pop, year, smod_transform, (height, width))
+        built_fraction = (
+            grid_sums(built, year, smod_transform, (height, width))
+            / resolution**2
+        )
+
+        clusters = find_urban_clusters(density, smooth=False, fill=False)
+        centers = find_urban_centers(density, built_fraction, min_hole_size=15)
+        smod_array[i][clusters > 0] = smod_codes["Urban Cluster"]
+        smod_array[i][centers > 0] = smod_codes["Urban Center"]
+
+    smod = xr.DataArray(
+        smod_array,
+        coords={
+            "band": years,
+            "y": y0 - (np.arange(height) + 0.5) * resolution,
+            "x": x0 + (np.arange(width) + 0.5) * resolution,
+        },
+        dims=("band", "y", "x"),
+    )
+    smod = smod.rio.write_crs(pop.rio.crs)
+    smod = smod.rio.write_transform(smod_transform)
+
+    return smod
+
+
 def get_stats_dict(
     class_array, pop_array, builtup_array, classes, year, cell_area=0.01, connectivity=4
 ):
-    stat_list = []
+    """Area, population, built up area and centroid of each class.
+
+    If classes is not a dict, class_array is labeled with the given
+    connectivity and each cluster is a class named f"{classes} {label}".
+    Statistics of all classes are taken in one pass over the grid per
+    quantity, with bincount of the class codes.
+
+    Returns
+    -------
+    df : DataFrame
+        One row per class, with sums in float64.
+
+    """
+
     if not isinstance(classes, dict):
         if connectivity == 8:
             class_array, ncenters = label(class_array, structure=np.ones((3, 3)))
@@ -188,88 +462,239 @@ def get_stats_dict(
             class_array, ncenters = label(class_array)
         classes = {f"{classes} {lbl}": lbl for lbl in range(1, ncenters + 1)}
 
-    for c, l in classes.items():
-        mask = class_array == l
-        stat_dict = {"Grupo": c}
-        stat_dict["year"] = year
-        stat_dict["Area"] = mask.sum() * cell_area
-        stat_dict["Area_fraction"] = stat_dict["Area"] / (class_array.size * cell_area)
-        stat_dict["Pob"] = pop_array[mask].sum() * cell_area
-        stat_dict["Pop_density"] = stat_dict["Pob"] / stat_dict["Area"]
-        stat_dict["Pop_fraction"] = stat_dict["Pob"] / pop_array.sum()
-        stat_dict["Builtup_area"] = builtup_array[mask].sum() * cell_area
-        stat_dict["Builtup_fraction"] = stat_dict["Builtup_area"] / (
-            builtup_array.sum() * cell_area
-        )
-        stat_dict["centroid"] = center_of_mass(mask)
-        stat_list.append(stat_dict)
-    return stat_list
+    codes = np.array(list(classes.values()), dtype=int)
+    flat = class_array.ravel()
+    nbins = max(flat.max(initial=0), codes.max(initial=0)) + 1
+
+    def class_sums(weights=None):
+        return np.bincount(flat, weights=weights, minlength=nbins)[codes]
+
+    count = class_sums()
+    area = count * cell_area
+    pob = class_sums(pop_array.ravel()) * cell_area
+    builtup_area = class_sums(builtup_array.ravel()) * cell_area
+
+    # Centroids in pixel coordinates, the sums ndimage.center_of_mass takes
+    rows, cols = np.indices(class_array.shape, dtype="float64", sparse=True)
+    row_sums = class_sums(np.broadcast_to(rows, class_array.shape).ravel())
+    col_sums = class_sums(np.broadcast_to(cols, class_array.shape).ravel())
+
+    # Absent classes have no area, their density and centroid are NaN
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pop_density = pob / area
+        centroids = list(zip(row_sums / count, col_sums / count))
+
+    return pd.DataFrame(
+        {
+            "Grupo": list(classes),
+            "year": year,
+            "Area": area,
+            "Area_fraction": area / (class_array.size * cell_area),
+            "Pob": pob,
+            "Pop_density": pop_density,
+            "Pop_fraction": pob / pop_array.sum(),
+            "Builtup_area": builtup_area,
+            "Builtup_fraction": builtup_area / (builtup_array.sum() * cell_area),
+            "centroid": centroids,
+        }
+    )
 
 
 def get_stats_df(dou_array, pop_array, builtup_array, year):
-    df = pd.DataFrame(
-        get_stats_dict(dou_array, pop_array, builtup_array, lvl_1_classes, year)
-        # + get_stats_dict(
-        #     (dou_array == lvl_1_classes['Urban Center']).astype(int),
-        #     pop_array,
-        #     builtup_array,
-        #     'Center',
-        #     year
-        # )
-        + get_stats_dict(
-            (dou_array > 1).astype(int),
-            pop_array,
-            builtup_array,
-            "Cluster",
-            year,
-            connectivity=8,
-        )
+    df = pd.concat(
+        [
+            get_stats_dict(dou_array, pop_array, builtup_array, lvl_1_classes, year),
+            # get_stats_dict(
+            #     (dou_array == lvl_1_classes['Urban Center']).astype(int),
+            #     pop_array,
+            #     builtup_array,
+            #     'Center',
+            #     year
+            # ),
+            get_stats_dict(
+                (dou_array > 1).astype(int),
+                pop_array,
+                builtup_array,
+                "Cluster",
+                year,
+                connectivity=8,
+            ),
+        ],
+        ignore_index=True,
     )
 
     return df
 
 
-def find_closest(df, centroid):
-    d = np.inf
-    for i, cent in enumerate(df.centroid):
-        dd = np.sum((cent - centroid) ** 2)
-        if dd < d:
-            d = dd
-            idx = i
-    return df.iloc[idx]
-
-
-def stats_for_largest_cluster(df_stats):
-    # We want only urban clusters
-    df_clusts = df_stats[df_stats.Grupo.str.startswith("Cluster")]
+def overlap_matrix(labels_a, labels_b):
+    """Sparse contingency matrix of two label grids.
+
+    Returns
+    -------
+    overlap : scipy.sparse.csr_matrix
+        Number of cells with label i in labels_a and label j in labels_b
+        at row i, column j. Background cells, label 0, are left out.
+
+    """
+
+    both = (labels_a > 0) & (labels_b > 0)
+    rows = labels_a[both]
+    cols = labels_b[both]
+    shape = (labels_a.max(initial=0) + 1, labels_b.max(initial=0) + 1)
+
+    overlap = coo_matrix((np.ones(len(rows), dtype="int64"), (rows, cols)), shape)
+    overlap = overlap.tocsr()
+    overlap.sort_indices()
+    return overlap
+
+
+def cluster_lineage(labels, years, main_label):
+    """Follows a cluster through a sequence of label grids.
+
+    In each year the cluster is the one sharing the most cells with the
+    cluster of the previous year, so it stays the same cluster when it
+    absorbs others. Ties go to the lowest label.
+
+    Parameters
+    ----------
+    labels : list of np.ndarray
+        Label grids of consecutive years, 0 for the background.
+    years : list of int
+        Year of each label grid.
+    main_label : int
+        Label of the cluster in the first grid.
+
+    Returns
+    -------
+    lineage : DataFrame
+        One row per year with the label of the cluster, 0 if it vanished,
+        the cells it shares with the cluster of the previous year and the
+        number of other clusters of the previous year merged into it.
+
+    """
+
+    rows = [dict(year=years[0], label=main_label, overlap=0, merged=0)]
+    current = main_label
+    for prev, cur, year in zip(labels[:-1], labels[1:], years[1:]):
+        overlap = overlap_matrix(prev, cur)
+        successors = overlap[current] if current < overlap.shape[0] else None
+        if current == 0 or successors is None or successors.nnz == 0:
+            current, shared, merged = 0, 0, 0
+        else:
+            k = successors.data.argmax()
+            current = successors.indices[k]
+            shared = successors.data[k]
+            # The cluster followed is one of its own predecessors
+            merged = overlap[:, current].nnz - 1
+        rows.append(dict(year=year, label=current, overlap=shared, merged=merged))
+
+    return pd.DataFrame(rows).astype({"label": int, "overlap": int, "merged": int})
+
+
+def main_cluster_lineage(dou, weights=None):
+    """Main urban cluster of every year of a DoU raster.
+
+    Urban cells are grouped in 8 connected clusters, as in get_stats_df.
+    The main cluster of the first year is the one with the largest sum of
+    weights, e.g. population, or the largest one if weights is None, and
+    is followed through the following years with cluster_lineage.
+
+    Parameters
+    ----------
+    dou : xarray.DataArray
+        DoU with a band or year dimension, as from load_or_process_dou.
+    weights : np.ndarray, optional
+        Grid of the first year to rank its clusters.
+
+    Returns
+    -------
+    lineage : DataFrame
+        Main cluster label per year, see cluster_lineage.
+    labels : np.ndarray
+        int32 label grids with dimensions (year, y, x).
+
+    """
+
+    years = [int(year) for year in dou[dou.dims[0]].values]
+    labels = np.stack(
+        [label(urban > 0, structure=np.ones((3, 3)))[0] for urban in dou.values]
+    )
 
-    # Get year lists
-    years = sorted(df_stats.year.unique())
+    sizes = np.bincount(
+        labels[0].ravel(), weights=None if weights is None else weights.ravel()
+    )
+    sizes[0] = 0
+    main_label = int(sizes.argmax()) if len(sizes) > 1 else 0
+
+    return cluster_lineage(labels, years, main_label), labels
+
+
+def lineage_stats(labels, lineage, pop_density, built_fraction, cell_area=0.01):
+    """Area, population and built up area of the main cluster of each year.
+
+    Sums are taken over the label grids the lineage was built from, see
+    main_cluster_lineage, so they follow the tracked cluster even when it
+    merges with others.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Label grids with dimensions (year, y, x).
+    lineage : DataFrame
+        Main cluster label per year, see cluster_lineage.
+    pop_density, built_fraction : xarray.DataArray
+        Population density and built-up fraction with one band per year,
+        read one year at a time.
+    cell_area : float
+        Area of a cell in km2.
+
+    Returns
+    -------
+    df : DataFrame
+        lineage with the Area, Pob, Pop_density and Builtup_area columns
+        added, NaN densities for the years the cluster vanished.
+
+    """
+
+    rows = []
+    for year_labels, year, lbl in zip(labels, lineage.year, lineage.label):
+        flat = year_labels.ravel()
+        nbins = flat.max(initial=0) + 1
+        pop = pop_density.sel(band=year).values.ravel()
+        built = built_fraction.sel(band=year).values.ravel()
+
+        # Sums of all labels in float64, label 0 is the background and
+        # stands for a vanished cluster
+        sums = [
+            np.bincount(flat, weights=weights, minlength=nbins)[lbl]
+            if lbl > 0
+            else 0.0
+            for weights in (None, pop, built)
+        ]
+        rows.append(
+            dict(
+                Area=sums[0] * cell_area,
+                Pob=sums[1] * cell_area,
+                Builtup_area=sums[2] * cell_area,
+            )
+        )
 
-    # For first year find largest cluster in population
-    df_year = df_clusts[df_clusts.year == years[0]]
-    centroid = df_year.iloc[df_year.Pob.argmax()].centroid
+    df = lineage.assign(**pd.DataFrame(rows, index=lineage.index))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df["Pop_density"] = df.Pob / df.Area
 
-    # Loop over years choosing always the same cluster
-    largest_clustrs = []
-    for year in years:
-        df_year = df_clusts[df_clusts.year == year]
-        closest = find_closest(df_year, centroid)
-        largest_clustrs.append(closest)
-    df_largest = pd.concat(largest_clustrs, axis=1)
-    return df_largest.T
+    return df
 
 
 def load_input_data_ghs(bbox_mollweide, path_cache, resolution=100):
     print("Loading GHS datasets for Degree of Urbanization ...")
 
-    rasters = {}
-    for key in ["BUILT_S", "POP", "LAND"]:
-        res = load_or_download(
-            bbox_mollweide, key, data_path=path_cache, resolution=resolution
-        )
-        res = res.rio.set_nodata(0)
-        rasters[key] = res
+    rasters = ghsl.load_or_download_many(
+        bbox_mollweide,
+        [(key, resolution) for key in ["BUILT_S", "POP", "LAND"]],
+        data_path=path_cache,
+    )
+    rasters = {key: res.rio.set_nodata(0) for key, res in rasters.items()}
 
     # Get population density grid in km^2
     cell_area = rasters["POP"].rio.resolution()[0] ** 2
@@ -287,7 +712,122 @@ def load_input_data_ghs(bbox_mollweide, path_cache, resolution=100):
     return pop_density, built_fraction, land_fraction
 
 
-def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
+def dou_year(
+    density,
+    builtup,
+    year,
+    u_center_density=1500,
+    u_center_pop=50000,
+    builtup_trshld=0.5,
+    u_cluster_density=300,
+    u_cluster_pop=5000,
+):
+    """Degree of Urbanization and its statistics for a single year.
+
+    Runs in the worker processes of dou_for_ghs. density and builtup are
+    lazy rasters of the city store, so only their task graphs are sent to
+    the worker, which reads the year from the store itself.
+
+    Returns
+    -------
+    dou_xr : xarray.DataArray
+        Level 1 classification of the year, not harmonized.
+    df_stats : DataFrame
+        Statistics of the year, see get_stats_df.
+
+    """
+
+    print(f"Calculating DoU for year {year}...")
+    # Workers are forked, the dask thread pool of the parent is not usable
+    density = density.compute(scheduler="synchronous")
+    builtup = builtup.compute(scheduler="synchronous")
+
+    dou_xr = dou_lvl1(
+        density,
+        builtup,
+        u_center_density,
+        u_center_pop,
+        builtup_trshld,
+        u_cluster_density,
+        u_cluster_pop,
+    )
+    df_stats = get_stats_df(dou_xr.values, density.values, builtup.values, year)
+
+    return dou_xr, df_stats
+
+
+def dou_sweep_year(density, builtup, year, param_sets):
+    """Statistics of the Degree of Urbanization of a single year for
+    several urban cluster thresholds.
+
+    Cells are labeled once per density threshold, and the population of
+    each cluster is summed and its majority rule growth computed once per
+    labeling, shared by all the population thresholds. Each result equals
+    the statistics of dou_year with the same thresholds.
+
+    Population thresholds run in increasing order, so the clusters kept
+    by a threshold are already grown by the previous ones.
+
+    Parameters
+    ----------
+    density, builtup : xarray.DataArray
+        Lazy population density and built-up fraction of the year.
+    year : int
+    param_sets : list of tuple
+        (u_cluster_density, u_cluster_pop) pairs.
+
+    Returns
+    -------
+    df_list : list of DataFrame
+        Statistics of the year for each pair, see get_stats_df.
+
+    """
+
+    print(f"Sweeping DoU thresholds for year {year}...")
+    # Workers are forked, the dask thread pool of the parent is not usable
+    density = density.compute(scheduler="synchronous").values
+    builtup = builtup.compute(scheduler="synchronous").values
+
+    by_density = {}
+    for i, (u_cluster_density, u_cluster_pop) in enumerate(param_sets):
+        by_density.setdefault(u_cluster_density, []).append((i, u_cluster_pop))
+
+    kernel8 = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    df_list = [None] * len(param_sets)
+    for u_cluster_density, group in by_density.items():
+        u_cluster_array = np.zeros_like(density, dtype="uint8")
+        u_cluster_array[density >= u_cluster_density] = 1
+        clusters, nclusters = label(u_cluster_array, structure=kernel8)
+        totals = cluster_totals(clusters, nclusters, density)
+        objects = find_objects(clusters)
+
+        grown = {}
+        for i, u_cluster_pop in sorted(group, key=lambda x: x[1]):
+            keep = populated_clusters(
+                clusters, nclusters, density, u_cluster_pop, totals, objects
+            )
+            year_clusters = clean_clusters(
+                u_cluster_array.copy(), clusters.copy(), keep, grown=grown
+            )
+
+            dou_array = np.full_like(density, lvl_1_classes["Rural"], dtype="uint8")
+            dou_array[year_clusters > 0] = lvl_1_classes["Urban Cluster"]
+            df_list[i] = get_stats_df(dou_array, density, builtup, year)
+
+    return df_list
+
+
+def dou_for_ghs(bbox_mollweide, path_cache, resolution=100, max_workers=1):
+    """Computes the Degree of Urbanization of every GHSL year and writes
+    dou.tif, dou_stats.csv and dou_largest.csv to the city cache.
+
+    Years are classified one after another in this process by default, and
+    harmonized at the end so urban cells stay urban in later years. With
+    max_workers other than 1 they run in a pool of max_workers forked
+    processes, all cores for None. Only use it from a single threaded
+    process such as ursa-warm, forking the multithreaded app is unsafe.
+    """
+
     (pop_density, built_fraction, land_fraction) = load_input_data_ghs(
         bbox_mollweide, path_cache, resolution
     )
@@ -305,58 +845,172 @@ def dou_for_ghs(bbox_mollweide, path_cache, resolution=100):
     year_list = pop_density.coords["band"].values
 
     # Setup thresholds
-    u_center_density = 1500
-    u_center_pop = 50000
-    builtup_trshld = 0.5
-    u_cluster_density = 300
-    u_cluster_pop = 5000
-
-    df_list = []
-    xr_list = []
-    for year in year_list:
-        print(f"Calculating DoU for year {year}...")
-        density = pop_density.sel(band=year)
-        builtup = built_fraction.sel(band=year)
-
-        print("    Building array...")
-        dou_xr = dou_lvl1(
-            density,
-            builtup,
-            u_center_density,
-            u_center_pop,
-            builtup_trshld,
-            u_cluster_density,
-            u_cluster_pop,
-        )
-
-        print("    Getting stats...")
-        df_stats = get_stats_df(dou_xr.values, density.values, builtup.values, year)
+    thresholds = dou_thresholds
+
+    # Rasters are lazily loaded, each year is read where it is processed
+    args = [
+        (pop_density.sel(band=year), built_fraction.sel(band=year), year)
+        for year in year_list
+    ]
+    if max_workers == 1:
+        results = [dou_year(*a, **thresholds) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(dou_year, *a, **thresholds) for a in args]
+            results = [future.result() for future in futures]
+    xr_list, df_list = zip(*results)
+    print("Done.")
 
-        # dou_xr.rio.to_raster(path_cache / f'dou_{year}.tif')
-        # harmonize from previous year
-        if year > year_list[0]:
-            prev = xr_list[-1].values
-            dou_xr.values = np.logical_or(prev, dou_xr.values).astype("uint8")
-        xr_list.append(dou_xr)
-        df_list.append(df_stats)
-        print("Done.")
+    # Harmonize, cells urban in a year stay urban in the following ones
     dou_full = xr.concat(xr_list, pd.Index(year_list, name="year"))
-    dou_full.rio.to_raster(path_cache / "dou.tif")
+    harmonized = np.logical_or.accumulate(dou_full.values, axis=0)
+    dou_full.values = harmonized.astype("uint8")
+
     df_stats = pd.concat(df_list)
     df_stats["centroid"] = df_stats.centroid.apply(lambda x: np.array(x))
-    # df_largest = stats_for_largest_cluster(df_stats)
 
-    df_stats.to_csv(path_cache / "dou_stats.csv")
-    # df_largest.to_csv(path_cache / 'dou_largest.csv')
+    # Main cluster of each year, ranked by the population of the first one
+    lineage, labels = main_cluster_lineage(
+        dou_full, pop_density.isel(band=0).values
+    )
+    df_largest = lineage_stats(labels, lineage, pop_density, built_fraction)
+
+    with uc.atomic_path(path_cache / "dou_stats.csv") as tmp:
+        df_stats.to_csv(tmp)
+    with uc.atomic_path(path_cache / "dou_largest.csv") as tmp:
+        df_largest.to_csv(tmp)
+
+    # Written last, its presence marks the DoU outputs as complete
+    with uc.atomic_path(path_cache / "dou.tif") as tmp:
+        dou_full.rio.to_raster(tmp)
 
 
-def load_or_process_dou(bbox_mollweide, path_cache, force=False):
+def load_or_process_dou(bbox_mollweide, path_cache, force=False, max_workers=1):
     fpath = path_cache / "dou.tif"
-    if fpath.exists() and not force:
-        pass
-    else:
-        dou_for_ghs(bbox_mollweide, path_cache)
+    with uc.locked(fpath):
+        if fpath.exists() and not force:
+            pass
+        else:
+            dou_for_ghs(bbox_mollweide, path_cache, max_workers=max_workers)
     raster = rxr.open_rasterio(fpath, cache=False)
     raster.coords["band"] = list(range(1975, 2021, 5))
 
     return raster
+
+
+def dou_sweep(
+    bbox_mollweide,
+    path_cache,
+    u_cluster_density=(dou_thresholds["u_cluster_density"],),
+    u_cluster_pop=(dou_thresholds["u_cluster_pop"],),
+    max_workers=1,
+):
+    """Degree of Urbanization statistics of every year for every
+    combination of urban cluster thresholds.
+
+    All combinations missing from the cache are evaluated in one batch,
+    reading each year once, see dou_sweep_year. Years run as in
+    dou_for_ghs, in this process unless max_workers is given. The
+    statistics of each combination are cached in
+    dou_sweep/dou_stats_{density}_{pop}.csv, in the format of dou_stats.csv.
+
+    Urban center thresholds are not swept, urban centers are not part of
+    the level 1 classification, see dou_lvl1.
+
+    Parameters
+    ----------
+    bbox_mollweide : Polygon
+        Bounding box of the city in Mollweide.
+    path_cache : Path
+        Path to the city cache directory.
+    u_cluster_density : list of float
+        Minimum densities of urban cluster cells, in people per km2.
+    u_cluster_pop : list of float
+        Minimum populations of urban clusters.
+    max_workers : int, optional
+        Number of worker processes, 1 runs the years in this process and
+        None uses all cores.
+
+    Returns
+    -------
+    df : DataFrame
+        Statistics of all combinations, with their thresholds in the
+        u_cluster_density and u_cluster_pop columns.
+
+    """
+
+    param_sets = itertools.product(u_cluster_density, u_cluster_pop)
+    param_sets = list(dict.fromkeys(param_sets))
+    path_sweep = path_cache / "dou_sweep"
+    fpaths = {
+        params: path_sweep / "dou_stats_{:g}_{:g}.csv".format(*params)
+        for params in param_sets
+    }
+
+    with uc.locked(path_sweep / "dou_stats"):
+        missing = [params for params in param_sets if not fpaths[params].exists()]
+        if len(missing) > 0:
+            pop_density, built_fraction, _ = load_input_data_ghs(
+                bbox_mollweide, path_cache
+            )
+            year_list = pop_density.coords["band"].values
+
+            start = time.perf_counter()
+            args = [
+                (pop_density.sel(band=year), built_fraction.sel(band=year), year)
+                for year in year_list
+            ]
+            if max_workers == 1:
+                results = [dou_sweep_year(*a, missing) for a in args]
+            else:
+                with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                    futures = [
+                        executor.submit(dou_sweep_year, *a, missing) for a in args
+                    ]
+                    results = [future.result() for future in futures]
+            elapsed = time.perf_counter() - start
+            print(
+                f"Swept {len(missing)} combinations over {len(year_list)} years "
+                f"in {elapsed:.1f} s, {len(missing) / elapsed:.2f} combinations/s"
+            )
+
+            for params, df_list in zip(missing, zip(*results)):
+                df_stats = pd.concat(df_list)
+                df_stats["centroid"] = df_stats.centroid.apply(lambda x: np.array(x))
+                with uc.atomic_path(fpaths[params]) as tmp:
+                    df_stats.to_csv(tmp)
+
+    df_list = []
+    for (density, pop), fpath in fpaths.items():
+        df_stats = pd.read_csv(fpath, index_col=0)
+        df_stats["u_cluster_density"] = density
+        df_stats["u_cluster_pop"] = pop
+        df_list.append(df_stats)
+
+    return pd.concat(df_list)
+
+
+def load_or_get_cluster_lineage(bbox_mollweide, path_cache):
+    """Loads the main cluster lineage of a city with its statistics per
+    year, see lineage_stats, computing it from its DoU if missing."""
+
+    fpath = path_cache / "dou_largest.csv"
+    with uc.locked(fpath):
+        if fpath.exists():
+            return pd.read_csv(fpath, index_col=0)
+
+        dou = load_or_process_dou(bbox_mollweide, path_cache)
+        # Written along with the DoU if it was just computed, missing from
+        # caches made before dou_largest.csv
+        if fpath.exists():
+            return pd.read_csv(fpath, index_col=0)
+
+        pop_density, built_fraction, _ = load_input_data_ghs(
+            bbox_mollweide, path_cache
+        )
+        lineage, labels = main_cluster_lineage(dou, pop_density.isel(band=0).values)
+        df = lineage_stats(labels, lineage, pop_density, built_fraction)
+        with uc.atomic_path(fpath) as tmp:
+            df.to_csv(tmp)
+
+    return df
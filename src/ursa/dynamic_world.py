@@ -4,6 +4,7 @@ import geemap.plotlymap as geemap
 import geopandas as gpd
 import pandas as pd
 import plotly.express as px
+import ursa.utils.cache as uc
 import ursa.utils.date as du
 import ursa.utils.raster as ru
 
@@ -300,7 +301,8 @@ def get_cover_df(bbox_latlon, path_cache):
     df = pd.DataFrame(dict_list).set_index("year").rename(columns=class_dict)
     df = df * 100 / 1e6
     df = df[columns]
-    df.to_csv(path_cache / "land_cover.csv")
+    with uc.atomic_path(path_cache / "land_cover.csv") as tmp:
+        df.to_csv(tmp)
 
     print("Done.")
 
@@ -309,10 +311,11 @@ def get_cover_df(bbox_latlon, path_cache):
 
 def load_or_get_lc_df(bbox_latlon, path_cache, force=False):
     fpath = path_cache / "land_cover.csv"
-    if fpath.exists() and not force:
-        df = pd.read_csv(fpath, index_col="year")
-    else:
-        df = get_cover_df(bbox_latlon, path_cache)
+    with uc.locked(fpath):
+        if fpath.exists() and not force:
+            df = pd.read_csv(fpath, index_col="year")
+        else:
+            df = get_cover_df(bbox_latlon, path_cache)
     return df
 
 
@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import geemap.plotlymap as geemap
@@ -9,20 +10,158 @@ import pandas as pd
 import plotly.express as px
 import rasterio as rio
 import rioxarray as rxr
-import tempfile
+import ursa.degree_of_urbanization as dou
+import ursa.plots.mapbox as pmb
+import ursa.tiles as tiles
+import ursa.utils.cache as uc
+import ursa.utils.chunked as chunked
 import ursa.utils.raster as ru
+import ursa.utils.render as render
+import ursa.utils.sources as sources
+import ursa.utils.store as store
+import ursa.utils.tile_cache as tile_cache
+import xarray as xr
 
 from PIL import Image, ImageOps
+from scipy import ndimage
 from shapely.geometry import shape
 
 HEIGHT = 600
 HIGH_RES = True
 
+# Pixel budget for rasters used only for map display
+DISPLAY_PIXELS = 1_000_000
+
+# Vertex budget for each set of zone outlines drawn on the maps
+OUTLINE_VERTICES = 20_000
+
+# Version of the products derived from the GHS rasters that are persisted
+# in the city cache, bump it when the code computing them changes
+DERIVED_VERSION = 1
+
+# Source of the SMOD raster: "ghsl" downloads the GHS SMOD product, "local"
+# derives it from the cached POP and BUILT_S, see load_or_derive_smod
+SMOD_SOURCE = os.environ.get("URSA_SMOD_SOURCE", "ghsl").lower()
+
 url_pop = "https://doi.org/10.2905/D6D86A90-4351-4508-99C1-CB074B022C4A"
 url_built = "https://doi.org/10.2905/D07D81B4-7680-4D28-B896-583745C27085"
 url_smod = "https://doi.org/10.2905/4606D58A-DC08-463C-86A9-D49EF461C47F"
 
 
+def ghs_files(ds, resolution, s3_path="GHSL/"):
+    """Returns the available years and the relative COG path for each year
+    of a GHS dataset."""
+
+    assert ds in ["SMOD", "BUILT_S", "POP", "LAND"], "Data set not available."
+
+    s3_path = f"{s3_path}/GHS_{ds}/"
+
+    if ds == "LAND":
+        year_list = [2018]
+        fname = f"GHS_{ds}_E{{}}_GLOBE_R2022A_54009_{resolution}_V1_0.tif"
+    else:
+        fname = f"GHS_{ds}_E{{}}_GLOBE_R2023A_54009_{resolution}_V1_0.tif"
+        year_list = list(range(1975, 2021, 5))
+
+    return year_list, [s3_path + fname.format(year) for year in year_list]
+
+
+def stack_to_raster(array_list, profile, year_list):
+    """Builds a multiband raster, a band per year, from yearly arrays.
+
+    The raster is built in memory from the window profile, no disk I/O
+    is done.
+    """
+
+    ghs_full = np.concatenate(array_list)
+
+    # Pixel centered coordinates, as set by rioxarray.open_rasterio
+    transform = profile["transform"]
+    height, width = ghs_full.shape[1:]
+    x = transform.c + transform.a * (np.arange(width) + 0.5)
+    y = transform.f + transform.e * (np.arange(height) + 0.5)
+
+    # Band dimension reflects years
+    raster = xr.DataArray(
+        ghs_full,
+        coords={"band": year_list, "y": y, "x": x},
+        dims=("band", "y", "x"),
+    )
+    raster = raster.rio.write_crs(profile["crs"])
+    raster = raster.rio.write_transform(transform)
+    raster = raster.rio.write_nodata(profile["nodata"])
+
+    return raster
+
+
+def download_s3_many(
+    bbox,
+    datasets,
+    data_path=None,
+    s3_path="GHSL/",
+    bucket="tec-expansion-urbana-p",
+):
+    """Downloads GHSL windowed rasters for several datasets at once.
+
+    The windows for every year of every dataset are assembled from the
+    global tile cache (see ursa.utils.tile_cache). Missing tiles are read
+    concurrently from the global COGs served by the configured raster
+    source, Amazon S3 by default (see ursa.utils.sources). Returns a
+    multiband raster per dataset, a band per year.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    datasets : list of tuple
+        List of (ds, resolution) pairs to download. ds can be one of SMOD,
+        BUILT_S, POP, or LAND, and resolution either 100 or 1000.
+    data_path : Path
+        Path to the city cache directory, rasters are added to its store.
+        If none, don't write to disk.
+    s3_dir : str
+        Relative path to COGs on S3.
+    bucket : str
+
+    Returns
+    -------
+    rasters : dict
+        Mapping from each dataset name to its raster. Rasters are lazily
+        loaded from the store if data_path is given, in memory otherwise.
+
+    """
+
+    names = ", ".join(ds for ds, _ in datasets)
+    print(f"Downloading {names} rasters ...")
+
+    year_lists = {}
+    jobs = {}
+    for ds, resolution in datasets:
+        year_list, paths = ghs_files(ds, resolution, s3_path)
+        year_lists[ds] = year_list
+        for year, path in zip(year_list, paths):
+            jobs[(ds, year)] = path
+
+    results = tile_cache.read_bbox_many(jobs, bbox, sources.get_source(bucket))
+
+    rasters = {}
+    for ds, resolution in datasets:
+        year_list = year_lists[ds]
+        array_list = [results[(ds, year)][0] for year in year_list]
+        profile = results[(ds, year_list[0])][1]
+        raster = stack_to_raster(array_list, profile, year_list)
+
+        if data_path is not None:
+            store.write_raster(data_path, f"{ds}_{resolution}", raster)
+            raster = store.open_raster(data_path, f"{ds}_{resolution}")
+
+        rasters[ds] = raster
+
+    print("Done.")
+
+    return rasters
+
+
 def download_s3(
     bbox,
     ds,
@@ -46,7 +185,7 @@ def download_s3(
     resolution : int
         Resolution of dataset to download, either 100 or 1000.
     data_path : Path
-        Path to directory to store rasters.
+        Path to the city cache directory, the raster is added to its store.
         If none, don't write to disk.
     s3_dir : str
         Relative path to COGs on S3.
@@ -55,47 +194,38 @@ def download_s3(
     Returns
     -------
     raster : rioxarray.DataArray
-        In memory raster.
+        Raster, lazily loaded from the store if data_path is given.
 
     """
 
-    assert ds in ["SMOD", "BUILT_S", "POP", "LAND"], "Data set not available."
-
-    print(f"Downloading {ds} rasters ...")
+    rasters = download_s3_many(bbox, [(ds, resolution)], data_path, s3_path, bucket)
 
-    s3_path = f"{s3_path}/GHS_{ds}/"
+    return rasters[ds]
 
-    if ds == "LAND":
-        year_list = [2018]
-        fname = f"GHS_{ds}_E{{}}_GLOBE_R2022A_54009_{resolution}_V1_0.tif"
-    else:
-        fname = f"GHS_{ds}_E{{}}_GLOBE_R2023A_54009_{resolution}_V1_0.tif"
-        year_list = list(range(1975, 2021, 5))
 
-    array_list = []
-    for year in year_list:
-        subset, profile = ru.np_from_bbox_s3(
-            s3_path + fname.format(year), bbox, bucket, nodata_to_zero=True
-        )
-        array_list.append(subset)
-    ghs_full = np.concatenate(array_list)
+def load_cached(data_path, ds, resolution):
+    """Lazily loads a GHS dataset previously stored on disk.
 
-    # Create rioxarray
-    profile["count"] = ghs_full.shape[0]
-    tmp_name = os.path.join(tempfile.gettempdir(), os.urandom(24).hex())
-    with rio.open(tmp_name, "w", **profile) as dst:
-        dst.write(ghs_full)
-    raster = rxr.open_rasterio(tmp_name)
+    Returns None if the dataset is not cached. Rasters cached as GeoTIFFs
+    by older versions are copied into the city store.
+    """
 
-    # Rename band dimension to reflect years
-    raster.coords["band"] = year_list
+    name = f"{ds}_{resolution}"
+    if store.has_raster(data_path, name):
+        return store.open_raster(data_path, name)
 
-    if data_path is not None:
-        raster.rio.to_raster(data_path / f"GHS_{ds}_{resolution}.tif")
+    fpath = data_path / f"GHS_{ds}_{resolution}.tif"
+    if not fpath.exists():
+        return None
 
-    print("Done.")
+    raster = rxr.open_rasterio(fpath)
+    if ds != "LAND":
+        raster.coords["band"] = list(range(1975, 2021, 5))
+    else:
+        raster.coords["band"] = [2018]
+    store.write_raster(data_path, name, raster)
 
-    return raster
+    return store.open_raster(data_path, name)
 
 
 def load_or_download(
@@ -107,7 +237,7 @@ def load_or_download(
     bucket="tec-expansion-urbana-p",
 ):
     """Searches for a GHS dataset to load, if not available,
-    downloads it from S3 and loads it.
+    downloads it from the raster source and loads it.
 
     Parameters
     ----------
@@ -118,8 +248,7 @@ def load_or_download(
     resolution : int
         Resolution of dataset to download, either 100 or 1000.
     data_path : Path
-        Path to directory to store rasters.
-        If none, don't write to disk.
+        Path to the city cache directory holding the raster store.
     s3_dir : str
         Relative path to COGs on S3.
     bucket : str
@@ -127,22 +256,118 @@ def load_or_download(
     Returns
     -------
     raster : rioxarray.DataArray
-        In memory raster.
+        Dask backed raster, lazily loaded from the store.
 
     """
-    fpath = data_path / f"GHS_{ds}_{resolution}.tif"
-    if fpath.exists():
-        raster = rxr.open_rasterio(fpath)
-        if ds != "LAND":
-            raster.coords["band"] = list(range(1975, 2021, 5))
-        else:
-            raster.coords["band"] = [2018]
-    else:
-        raster = download_s3(bbox, ds, data_path, resolution, s3_path, bucket)
+
+    # The city store is shared by all datasets, lock it as a whole
+    with uc.locked(store.store_path(data_path)):
+        raster = load_cached(data_path, ds, resolution)
+        if raster is None:
+            raster = download_s3(bbox, ds, data_path, resolution, s3_path, bucket)
 
     return raster
 
 
+def load_or_download_many(
+    bbox,
+    datasets,
+    data_path=None,
+    s3_path="GHSL/",
+    bucket="tec-expansion-urbana-p",
+):
+    """Searches for several GHS datasets to load, downloading all the
+    missing ones from the raster source in a single concurrent batch.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    datasets : list of tuple
+        List of (ds, resolution) pairs to load.
+    data_path : Path
+        Path to the city cache directory holding the raster store.
+    s3_dir : str
+        Relative path to COGs on S3.
+    bucket : str
+
+    Returns
+    -------
+    rasters : dict
+        Mapping from each dataset name to its dask backed raster.
+
+    """
+
+    rasters = {}
+    missing = []
+    with uc.locked(store.store_path(data_path)):
+        for ds, resolution in datasets:
+            raster = load_cached(data_path, ds, resolution)
+            if raster is None:
+                missing.append((ds, resolution))
+            else:
+                rasters[ds] = raster
+
+        if len(missing) > 0:
+            rasters.update(
+                download_s3_many(bbox, missing, data_path, s3_path, bucket)
+            )
+
+    return rasters
+
+
+def smod_datasets():
+    """(ds, resolution) pairs to download for the SMOD raster, none when
+    it is derived locally."""
+
+    if SMOD_SOURCE == "local":
+        return []
+    return [("SMOD", 1000)]
+
+
+def load_or_derive_smod(bbox, data_path, pop=None, built=None):
+    """Loads the SMOD raster from URSA_SMOD_SOURCE.
+
+    With the ghsl source the GHS SMOD product is loaded or downloaded, see
+    load_or_download. With the local source a level 1 SMOD is derived from
+    the 100 m POP and BUILT_S, see dou.smod_from_ghs, and kept in the city
+    store.
+
+    Parameters
+    ----------
+    bbox : Polygon
+        Shapely Polygon defining the bounding box.
+    data_path : Path
+        Path to the city cache directory holding the raster store.
+    pop, built : rioxarray.DataArray, optional
+        100 m POP and BUILT_S rasters if already loaded.
+
+    Returns
+    -------
+    smod : rioxarray.DataArray
+        Dask backed SMOD raster, lazily loaded from the store.
+
+    """
+
+    assert SMOD_SOURCE in ["ghsl", "local"], f"Unknown SMOD source {SMOD_SOURCE}."
+
+    if SMOD_SOURCE == "ghsl":
+        return load_or_download(bbox, "SMOD", data_path=data_path, resolution=1000)
+
+    if pop is None or built is None:
+        rasters = load_or_download_many(
+            bbox, [("BUILT_S", 100), ("POP", 100)], data_path=data_path
+        )
+        built, pop = rasters["BUILT_S"], rasters["POP"]
+
+    name = "SMOD_LOCAL_1000"
+    with uc.locked(store.store_path(data_path)):
+        if not store.has_raster(data_path, name):
+            store.write_raster(data_path, name, dou.smod_from_ghs(pop, built))
+
+    return store.open_raster(data_path, name)
+
+
 def clip_dataset(ds, polygons):
     ds = ds.rio.set_nodata(0)
     ds = ds.rio.clip(polygons)
@@ -150,24 +375,19 @@ def clip_dataset(ds, polygons):
 
 
 def load_plot_datasets(bbox_mollweide, path_cache, clip=False):
-    smod = load_or_download(
-        bbox_mollweide,
-        "SMOD",
-        data_path=path_cache,
-        resolution=1000,
-    )
-    built = load_or_download(
-        bbox_mollweide,
-        "BUILT_S",
-        data_path=path_cache,
-        resolution=100,
-    )
-    pop = load_or_download(
+    rasters = load_or_download_many(
         bbox_mollweide,
-        "POP",
+        smod_datasets() + [("BUILT_S", 100), ("POP", 100)],
         data_path=path_cache,
-        resolution=100,
     )
+    built, pop = rasters["BUILT_S"], rasters["POP"]
+    smod = rasters.get("SMOD")
+    if smod is None:
+        smod = load_or_derive_smod(bbox_mollweide, path_cache, pop=pop, built=built)
+
+    if chunked.is_enabled():
+        built = chunked.rechunk(built)
+        pop = chunked.rechunk(pop)
 
     if clip:
         smod = clip_dataset(smod, [bbox_mollweide])
@@ -177,66 +397,140 @@ def load_plot_datasets(bbox_mollweide, path_cache, clip=False):
     return smod, built, pop
 
 
-def smod_polygons(smod, centroid):
-    """Find SMOD polygons for urban centers and urban clusters.
+def smod_labels(smod, centroid):
+    """Labels the urban centers and clusters of every year of a SMOD raster.
+
+    Each 8-connected group of center or cluster pixels of a year gets its
+    own label. The main center and cluster are the ones holding the
+    centroid pixel.
 
     Parameters
     ----------
     smod : xarray.DataArray
         DataArray with SMOD raster data.
     centroid : shapely.Point
-        Polygons containing centroid will be identified as
-        the principal urban center and cluster.
+        Point identifying the principal urban center and cluster.
         Must be in Mollweide proyection.
 
     Returns
     -------
-    smod_polygons : GeoDataFrame
-        GeoDataFrame with polygons for urban clusters and centers.
+    labels : xarray.DataArray
+        Integer labels with dimensions (class, band, y, x), class 2 for
+        clusters and 3 for centers. 0 outside of them.
+    main : xarray.DataArray
+        Label of the main center and cluster with dimensions (class, band),
+        0 if the centroid lies outside all of them.
+
     """
 
     # Get DoU lvl 1 representation (1: rural, 2: cluster, 3: center)
-    smod_lvl_1 = smod // 10
+    smod_lvl_1 = (smod // 10).values
+    masks = {2: smod_lvl_1 > 1, 3: smod_lvl_1 == 3}
+
+    height, width = smod.shape[-2:]
+    row, col = rio.transform.rowcol(smod.rio.transform(), centroid.x, centroid.y)
+    inside = 0 <= row < height and 0 <= col < width
+
+    structure = np.ones((3, 3), dtype=bool)
+    labels = np.zeros((2, *smod.shape), dtype="int32")
+    main = np.zeros((2, smod.shape[0]), dtype="int32")
+    for i, c in enumerate(masks):
+        for j in range(smod.shape[0]):
+            labels[i, j], _ = ndimage.label(masks[c][j], structure=structure)
+            if inside:
+                main[i, j] = labels[i, j, row, col]
+
+    labels = xr.DataArray(
+        labels,
+        coords={"class": list(masks), **smod.coords},
+        dims=("class", *smod.dims),
+    )
+    main = xr.DataArray(
+        main,
+        coords={"class": list(masks), "band": smod.coords["band"]},
+        dims=("class", "band"),
+    )
+
+    return labels, main
+
 
-    smod_centers = (smod_lvl_1 == 3).astype(smod.dtype)
-    smod_clusters = (smod_lvl_1 > 1).astype(smod.dtype)
+def smod_fingerprint(smod, centroid):
+    """Digest of the inputs of smod_polygons, used as cache key."""
 
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(smod.values).tobytes())
+    h.update(str(smod.shape).encode())
+    h.update(str(list(smod.rio.transform())).encode())
+    h.update(centroid.wkb)
+    return h.hexdigest()[:16]
+
+
+def polygonize_smod(smod, centroid):
+    labels, main = smod_labels(smod, centroid)
     transform = smod.rio.transform()
 
     dict_list = []
     for year in smod["band"].values:
-        centers = rio.features.shapes(
-            smod_centers.sel(band=year).values, connectivity=8, transform=transform
-        )
-        clusters = rio.features.shapes(
-            smod_clusters.sel(band=year).values, connectivity=8, transform=transform
-        )
+        # Centers first, then clusters
+        for c in (3, 2):
+            year_labels = labels.sel({"class": c, "band": year}).values
+            main_label = main.sel({"class": c, "band": year}).item()
+            shapes = rio.features.shapes(
+                year_labels,
+                mask=year_labels > 0,
+                connectivity=8,
+                transform=transform,
+            )
+            dict_list += [
+                {
+                    "class": c,
+                    "year": year,
+                    "label": int(value),
+                    "is_main": int(value) == main_label,
+                    "geometry": shape(geom),
+                }
+                for geom, value in shapes
+            ]
+
+    return gpd.GeoDataFrame(dict_list, crs=smod.rio.crs)
 
-        center_list = [shape(f[0]) for f in centers if f[1] > 0]
-        cluster_list = [shape(f[0]) for f in clusters if f[1] > 0]
-
-        center_dicts = [
-            {
-                "class": 3,
-                "year": year,
-                "is_main": centroid.within(center),
-                "geometry": center,
-            }
-            for center in center_list
-        ]
-        cluster_dicts = [
-            {
-                "class": 2,
-                "year": year,
-                "is_main": centroid.within(cluster),
-                "geometry": cluster,
-            }
-            for cluster in cluster_list
-        ]
-        dict_list += center_dicts
-        dict_list += cluster_dicts
-
-    smod_polygons = gpd.GeoDataFrame(dict_list, crs=smod.rio.crs)
+
+def smod_polygons(smod, centroid, path_cache=None):
+    """Find SMOD polygons for urban centers and urban clusters.
+
+    Centers and clusters are labeled on the raster, see smod_labels, and
+    only then polygonized.
+
+    Parameters
+    ----------
+    smod : xarray.DataArray
+        DataArray with SMOD raster data.
+    centroid : shapely.Point
+        Polygons containing centroid will be identified as
+        the principal urban center and cluster.
+        Must be in Mollweide proyection.
+    path_cache : Path
+        Path to the city cache directory. If given, polygons are cached
+        there as GeoParquet, keyed by the SMOD raster and the centroid.
+
+    Returns
+    -------
+    smod_polygons : GeoDataFrame
+        GeoDataFrame with polygons for urban clusters and centers, and
+        their label in smod_labels.
+    """
+
+    if path_cache is None:
+        return polygonize_smod(smod, centroid)
+
+    fpath = path_cache / f"smod_clusters_{smod_fingerprint(smod, centroid)}.parquet"
+    with uc.locked(fpath):
+        if fpath.exists():
+            smod_polygons = gpd.read_parquet(fpath)
+        else:
+            smod_polygons = polygonize_smod(smod, centroid)
+            with uc.atomic_path(fpath) as tmp:
+                smod_polygons.to_parquet(tmp)
 
     return smod_polygons
 
@@ -254,7 +548,7 @@ def built_s_polygons(built):
     built_df = built_df[built_df.b_area > 0].reset_index(drop=True)
 
     built_df["fraction"] = built_df.b_area / pixel_area
-    built_df["geometry"] = built_df.apply(ru.row2cell, res_xy=resolution, axis=1)
+    built_df["geometry"] = ru.xy2cells(built_df.x, built_df.y, resolution)
 
     built_gdf = gpd.GeoDataFrame(built_df, crs=built.rio.crs).drop(columns=["x", "y"])
 
@@ -291,8 +585,289 @@ def plot_built_poly(built_gdf, bbox_latlon, year=2020):
     return Map
 
 
-def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0.2, language="es"):
-    """Plots historic built using an image overlay."""
+def tile_layer(raster, path_cache, layer, **params):
+    """Mapbox layer with the XYZ tiles of a cached city raster, see
+    ursa.tiles.
+
+    Returns
+    -------
+    layer : dict
+        Mapbox raster layer.
+    bounds : tuple
+        Bounds of raster in lat lon.
+
+    """
+
+    bounds = rio.warp.transform_bounds(raster.rio.crs, 4326, *raster.rio.bounds())
+    layer = {
+        "sourcetype": "raster",
+        "source": [tiles.tile_url(path_cache.name, layer, **params)],
+        "opacity": 0.7,
+        "below": "traces",
+    }
+
+    return layer, bounds
+
+
+def image_layer(img, bounds):
+    """Mapbox layer with img covering the lat lon bounds."""
+
+    lonmin, latmin, lonmax, latmax = bounds
+
+    # High res image
+    if HIGH_RES:
+        img = img.resize(
+            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
+        )
+
+    return {
+        "sourcetype": "image",
+        "source": img,
+        "coordinates": [
+            [lonmin, latmin],
+            [lonmax, latmin],
+            [lonmax, latmax],
+            [lonmin, latmax],
+        ],
+        "opacity": 0.7,
+        "below": "traces",
+    }
+
+
+def derived_path(path_cache):
+    """Directory with the derived products of the current DERIVED_VERSION."""
+
+    return path_cache / f"derived_v{DERIVED_VERSION}"
+
+
+def smod_suffix():
+    """Suffix of the cached products computed from the SMOD raster, so
+    each SMOD_SOURCE keeps its own. Empty for the GHS SMOD, caches written
+    before SMOD_SOURCE existed stay valid."""
+
+    return "" if SMOD_SOURCE == "ghsl" else f"_{SMOD_SOURCE}"
+
+
+def load_or_get_display_raster(fname, compute, path_cache=None, bands=None):
+    """Loads a display raster persisted as fname in the derived products
+    of path_cache, computing and saving it first if missing.
+
+    Parameters
+    ----------
+    fname : str
+        File name of the GeoTIFF.
+    compute : callable
+        Returns the raster, called only if it is not persisted.
+    path_cache : Path
+        City cache. The raster is computed and not persisted if None.
+    bands : array_like
+        Band coordinates of a (band, y, x) raster. Single band rasters are
+        returned with dimensions (y, x) if None.
+
+    Returns
+    -------
+    raster : xarray.DataArray
+        The display raster.
+
+    """
+
+    if path_cache is None:
+        return compute()
+
+    fpath = derived_path(path_cache) / fname
+    fpath.parent.mkdir(exist_ok=True, parents=True)
+    with uc.locked(fpath):
+        if not fpath.exists():
+            raster = compute()
+            with uc.atomic_path(fpath) as tmp:
+                raster.rio.to_raster(tmp)
+
+    raster = rxr.open_rasterio(fpath)
+    if bands is None:
+        raster = raster.squeeze("band", drop=True)
+    else:
+        raster.coords["band"] = bands
+
+    return raster
+
+
+def reproject_display(raster, dst_crs):
+    """Reprojects a display raster, strip by strip in chunked mode."""
+
+    if chunked.is_enabled():
+        return chunked.reproject(raster, dst_crs)
+    return raster.rio.reproject(dst_crs, **chunked.WARP_OPTIONS)
+
+
+def first_year_grid(built, thresh=0.2, max_pixels=DISPLAY_PIXELS):
+    """Earliest year built is over thresh, in lat lon.
+
+    Built rasters larger than max_pixels are decimated before reprojection.
+
+    Returns
+    -------
+    built_bin_agg : xarray.DataArray
+        uint8 grid with 1 for 1975, 2 for 1980 and so on, 0 where built
+        never goes over thresh.
+
+    """
+
+    years_uint8 = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], dtype="uint8")
+
+    resolution = built.rio.resolution()
+    pixel_area = abs(np.prod(resolution))
+
+    # Create a density array
+    # Only densities can be safely reprojected
+    built = built / pixel_area
+
+    # Display only, reduce to the pixel budget
+    built, _ = ru.decimate(built, max_pixels)
+
+    # Reproject
+    built.rio.set_nodata(0)
+    built = reproject_display(built, "EPSG:4623")
+
+    # Create a yearly coded binary built array
+    built_bin = (built > thresh).astype("uint8")
+    built_bin *= years_uint8[:, None, None]
+    built_bin.values[built_bin.values == 0] = 200
+
+    # Aggregate yearly binary built data
+    # Keep earliest year of observed urbanization
+    built_bin_agg = np.min(built_bin, axis=0)
+    built_bin_agg.values[built_bin_agg == 200] = 0
+
+    return built_bin_agg
+
+
+def display_density(raster, units="m", max_pixels=DISPLAY_PIXELS):
+    """Density of a (band, y, x) raster per square {units}, in lat lon.
+
+    Rasters larger than max_pixels are decimated before reprojection.
+    """
+
+    c_factor = {"m": 1, "km": 1e6}
+    pixel_area = abs(np.prod(raster.rio.resolution())) / c_factor[units]
+
+    # Only densitities can be safely reprojected
+    density = raster / pixel_area
+    density.rio.set_nodata(0)
+
+    # Display only, reduce to the pixel budget
+    density, _ = ru.decimate(density, max_pixels)
+
+    return reproject_display(density, 4326)
+
+
+def load_or_get_first_year(
+    built, thresh=0.2, max_pixels=DISPLAY_PIXELS, path_cache=None
+):
+    """first_year_grid of built, persisted in path_cache if given."""
+
+    return load_or_get_display_raster(
+        f"first_year_{thresh}_{max_pixels}.tif",
+        lambda: first_year_grid(built, thresh, max_pixels),
+        path_cache,
+    )
+
+
+def load_or_get_display_density(
+    raster, name, units="m", max_pixels=DISPLAY_PIXELS, path_cache=None
+):
+    """display_density of all the years of raster, persisted in path_cache
+    as {name}_density_{max_pixels}.tif if given."""
+
+    return load_or_get_display_raster(
+        f"{name}_density_{max_pixels}.tif",
+        lambda: display_density(raster, units, max_pixels),
+        path_cache,
+        bands=raster.band.values,
+    )
+
+
+def built_agg_overlay(
+    built, thresh=0.2, max_pixels=DISPLAY_PIXELS, path_cache=None
+):
+    """Image overlay with the earliest year built is over thresh.
+
+    Built rasters larger than max_pixels are decimated before reprojection.
+    The first year grid is persisted in path_cache if given.
+
+    Returns
+    -------
+    layer : dict
+        Mapbox image layer.
+    bounds : tuple
+        Bounds of the image in lat lon.
+
+    """
+
+    built_bin_agg = load_or_get_first_year(built, thresh, max_pixels, path_cache)
+    years_uint8 = np.arange(1, len(built.band) + 1, dtype="uint8")
+
+    # Colorize, year codes index the color table
+    table = render.categorical_table("cividis", len(years_uint8))
+    built_img = render.apply_lut(built_bin_agg.values, table)
+
+    # Create Image object (memory haevy)
+    img = ImageOps.flip(Image.fromarray(built_img))
+    bounds = built_bin_agg.rio.bounds()
+
+    return image_layer(img, bounds), bounds
+
+
+def add_zone_outlines(fig, clusters, bbox_mollweide, names):
+    """Adds the outlines of the main and peripheral clusters and of the
+    analysis zone to a mapbox figure, a single trace for each.
+
+    Parameters
+    ----------
+    fig : go.Figure
+        Mapbox figure.
+    clusters : gpd.GeoDataFrame
+        Clusters with is_main column, as returned by smod_polygons.
+    bbox_mollweide : shapely.Polygon
+        Analysis zone in Mollweide.
+    names : dict
+        Translated legend entries for "Central Zone", "Peripheral Zones"
+        and "Analysis Zone".
+
+    """
+
+    clusters = clusters.to_crs(4326)
+    bbox_latlon = gpd.GeoSeries([bbox_mollweide], crs="ESRI:54009").to_crs(4326)
+
+    zones = [
+        (clusters[clusters.is_main].geometry, names["Central Zone"], "maroon"),
+        (clusters[~clusters.is_main].geometry, names["Peripheral Zones"], "orange"),
+        (bbox_latlon, names["Analysis Zone"], "blue"),
+    ]
+    for geoms, name, color in zones:
+        if len(geoms) > 0:
+            fig.add_trace(
+                pmb.outline_trace(
+                    geoms.values, name, color, max_vertices=OUTLINE_VERTICES
+                )
+            )
+
+
+def plot_built_agg_img(
+    smod,
+    built,
+    bbox_mollweide,
+    centroid_mollweide,
+    thresh=0.2,
+    language="es",
+    max_pixels=DISPLAY_PIXELS,
+    path_cache=None,
+    use_tiles=True,
+):
+    """Plots historic built using XYZ tiles served from path_cache, or
+    an image overlay if use_tiles is False or no path_cache is given.
+
+    Built rasters larger than max_pixels are decimated before reprojection.
+    """
 
     translations = {
         "es": {
@@ -327,62 +902,15 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
         "2015",
         "2020",
     ]
-    years_uint8 = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], dtype="uint8")
-
-    resolution = built.rio.resolution()
-    pixel_area = abs(np.prod(resolution))
-
-    # Create a density array
-    # Only densities can be safely reprojected
-    built = built / pixel_area
-
-    # Reproject
-    built.rio.set_nodata(0)
-    built = built.rio.reproject("EPSG:4623")
-
-    # Create a yearly coded binary built array
-    built_bin = (built > thresh).astype("uint8")
-    built_bin *= years_uint8[:, None, None]
-    built_bin.values[built_bin.values == 0] = 200
-
-    # Aggregate yearly binary built data
-    # Keep earliest year of observed urbanization
-    built_bin_agg = np.min(built_bin, axis=0)
-    built_bin_agg.values[built_bin_agg == 200] = 0
-
-    # Create high resolution raster in lat-lon
 
-    # Create array to hold colorized image
-    built_img = np.zeros((*built_bin_agg.shape, 4), dtype="uint8")
-
-    # Set colormap
     colors_rgba = [plt.cm.get_cmap("cividis", 10)(i) for i in range(10)]
-    colors = (np.array(colors_rgba) * 255).astype("uint8")
-    cmap = {y: c for y, c in zip(years_uint8, colors)}
     cmap_cat = {y: mpl.colors.rgb2hex(c) for y, c in zip(years, colors_rgba)}
 
-    # Set colors manually on image array
-    for year, color in cmap.items():
-        mask = built_bin_agg == year
-        built_img[mask] = color
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = built_bin_agg.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
-
-    # Create Image object (memory haevy)
-    img = ImageOps.flip(Image.fromarray(built_img))
-
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    if use_tiles and path_cache is not None:
+        layer, bounds = tile_layer(built, path_cache, "built_agg", thresh=thresh)
+    else:
+        layer, bounds = built_agg_overlay(built, thresh, max_pixels, path_cache)
+    lonmin, latmin, lonmax, latmax = bounds
 
     dummy_df = pd.DataFrame({"lat": [0] * 10, "lon": [0] * 10, "Year": years})
     fig = px.scatter_mapbox(
@@ -403,72 +931,11 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for _, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
-        )
+    add_zone_outlines(fig, clusters_2020, bbox_mollweide, translations[language])
 
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
-
-    # Add trace of bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
-    )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
-    )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
-
-    fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
-    )
+    fig.update_layout(mapbox_layers=[layer])
 
     fig.add_annotation(
         text=f'Datos de: <a href="{url_built}"">GHS-BUILT-S</a>',
@@ -482,12 +949,81 @@ def plot_built_agg_img(smod, built, bbox_mollweide, centroid_mollweide, thresh=0
     return fig
 
 
+def cluster_labels(clusters, main_cluster, raster):
+    """Rasterizes the clusters of a year into the grid of raster.
+
+    Pixels are assigned to a cluster as rio.clip does, by their center.
+    Returns an uint8 grid with 0 outside clusters, 1 for the other
+    clusters and 2 for the main cluster.
+    """
+
+    shapes = [(geom, 1) for geom in clusters] + [(main_cluster, 2)]
+
+    return rio.features.rasterize(
+        shapes,
+        out_shape=raster.shape[-2:],
+        transform=raster.rio.transform(),
+        fill=0,
+        all_touched=False,
+        dtype="uint8",
+    )
+
+
+def cluster_zones(year_labels, main_label):
+    """Zones of the SMOD grid from the cluster labels of a year: 0 outside
+    clusters, 1 for the other clusters and 2 for the main cluster."""
+
+    zones = (year_labels > 0).astype("uint8")
+    zones[(year_labels == main_label) & (year_labels > 0)] = 2
+    return zones
+
+
+def cluster_sums(raster, year, smod_zones, smod, clusters, main_cluster):
+    """Sums raster over the clusters of a year in a single pass.
+
+    Clusters follow the SMOD grid, so when the grid of raster is nested in
+    it, raster is summed into SMOD pixels and zoned with smod_zones, see
+    cluster_zones. Otherwise the cluster polygons are rasterized on the
+    grid of raster.
+
+    Returns an array with the sums outside clusters, in the other clusters
+    and in the main cluster. Sums are accumulated in float64, and kept in
+    float64 for float rasters or cast to the dtype np.sum gives for integer
+    ones, which is exact.
+    """
+
+    band = raster.sel(band=year)
+    transform = raster.rio.transform()
+    smod_transform = smod.rio.transform()
+
+    if ru.is_nested(transform, smod_transform):
+        if chunked.is_enabled():
+            values = chunked.block_sums(
+                band, transform, smod_transform, smod.shape[-2:]
+            )
+        else:
+            values = ru.block_sums(
+                band.values, transform, smod_transform, smod.shape[-2:]
+            )
+        labels = smod_zones
+    else:
+        values = band.values
+        labels = cluster_labels(clusters, main_cluster, raster)
+
+    sums = ru.zonal_sums(values, labels, 3)
+    if np.issubdtype(raster.dtype, np.floating):
+        return sums
+
+    return sums.astype(np.zeros(0, dtype=raster.dtype).sum().dtype)
+
+
 def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
     built.rio.set_nodata(0)
     pop.rio.set_nodata(0)
 
-    smod_gdf = smod_polygons(smod, centroid_mollweide)
+    smod_gdf = smod_polygons(smod, centroid_mollweide, path_cache)
     smod_gdf["Area"] = smod_gdf.area
+    labels, main = smod_labels(smod, centroid_mollweide)
 
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
 
@@ -495,8 +1031,8 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
 
     # Total built-up area and pop per year
     # Built raster contains squared meters
-    total_built = built.sum(axis=(1, 2)).values
-    total_pop = pop.sum(axis=(1, 2)).values
+    total_built = built.sum(axis=(1, 2), dtype="float64").values
+    total_pop = pop.sum(axis=(1, 2), dtype="float64").values
 
     # Built and pop within center and cluster
     years = smod.coords["band"].values
@@ -519,43 +1055,19 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
             # All clusters and centers
             cluster_all = clusters_gdf[clusters_gdf.year == year].geometry
 
-            # Series for main cluster and center
-            cluster_built.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=built.rio.crs)
-                    .values
-                )
-            )
-
-            cluster_pop.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip([cluster], crs=pop.rio.crs)
-                    .values
-                )
-            )
-
-            # Series for ALL clusters and centers
-            cluster_built_all.append(
-                np.nansum(
-                    built.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=built.rio.crs)
-                    .values
-                )
+            # Zone 1 holds the other clusters and zone 2 the main one,
+            # so all clusters are zones 1 + 2
+            zones = cluster_zones(
+                labels.sel({"class": 2, "band": year}).values,
+                main.sel({"class": 2, "band": year}).item(),
             )
+            built_sums = cluster_sums(built, year, zones, smod, cluster_all, cluster)
+            pop_sums = cluster_sums(pop, year, zones, smod, cluster_all, cluster)
 
-            cluster_pop_all.append(
-                np.nansum(
-                    pop.sel(band=year)
-                    .rio.set_nodata(0)
-                    .rio.clip(cluster_all, crs=pop.rio.crs)
-                    .values
-                )
-            )
+            cluster_built.append(built_sums[2])
+            cluster_pop.append(pop_sums[2])
+            cluster_built_all.append(built_sums[1] + built_sums[2])
+            cluster_pop_all.append(pop_sums[1] + pop_sums[2])
 
     cluster_built = np.array(cluster_built)
     cluster_pop = np.array(cluster_pop)
@@ -615,7 +1127,25 @@ def get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
         }
     )
 
-    df.to_csv(path_cache / "urban_growth.csv")
+    with uc.atomic_path(path_cache / f"urban_growth{smod_suffix()}.csv") as tmp:
+        df.to_csv(tmp)
+
+    return df
+
+
+def load_or_get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache):
+    """Loads the urban growth table of a city from its derived products,
+    computing it with get_urb_growth_df if missing."""
+
+    fpath = derived_path(path_cache) / f"urban_growth{smod_suffix()}.parquet"
+    fpath.parent.mkdir(exist_ok=True, parents=True)
+    with uc.locked(fpath):
+        if fpath.exists():
+            return pd.read_parquet(fpath)
+
+        df = get_urb_growth_df(smod, built, pop, centroid_mollweide, path_cache)
+        with uc.atomic_path(fpath) as tmp:
+            df.to_parquet(tmp)
 
     return df
 
@@ -647,7 +1177,7 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters", language='es'):
     df = df.rename(columns={"band": translations[language]["Year"]})
     df = df.sort_values(translations[language]["Year"]).reset_index(drop=True)
 
-    df["geometry"] = df.apply(ru.row2cell, res_xy=smod.rio.resolution(), axis=1)
+    df["geometry"] = ru.xy2cells(df.x, df.y, smod.rio.resolution())
 
     gdf = gpd.GeoDataFrame(df.drop(columns=["x", "y"]), crs=smod.rio.crs)
 
@@ -710,10 +1240,53 @@ def plot_smod_clusters(smod, bbox_latlon, feature="clusters", language='es'):
     return fig
 
 
+def built_year_overlay(
+    built, year=2020, max_pixels=DISPLAY_PIXELS, path_cache=None
+):
+    """Image overlay with the built fraction of year.
+
+    Built rasters larger than max_pixels are decimated before reprojection.
+    The reprojected built density of all years is persisted in path_cache
+    if given.
+
+    Returns
+    -------
+    layer : dict
+        Mapbox image layer.
+    bounds : tuple
+        Bounds of the image in lat lon.
+
+    """
+
+    built = load_or_get_display_density(built, "built", "m", max_pixels, path_cache)
+    built = built.sel(band=year)
+
+    # Get colorized image, 0 is transparent
+    index = render.continuous_index(built.values)
+    colorized = render.apply_lut(index, render.continuous_table("cividis"))
+    img = ImageOps.flip(Image.fromarray(colorized))
+    bounds = built.rio.bounds()
+
+    return image_layer(img, bounds), bounds
+
+
 def plot_built_year_img(
-    smod, built, bbox_latlon, bbox_mollweide, centroid_mollweide, year=2020, language = "es"
+    smod,
+    built,
+    bbox_latlon,
+    bbox_mollweide,
+    centroid_mollweide,
+    year=2020,
+    language="es",
+    max_pixels=DISPLAY_PIXELS,
+    path_cache=None,
+    use_tiles=True,
 ):
-    """Plots built for year using an image overlay."""
+    """Plots built for year using XYZ tiles served from path_cache, or an
+    image overlay if use_tiles is False or no path_cache is given.
+
+    Built rasters larger than max_pixels are decimated before reprojection.
+    """
 
     translations = {
         "es": {
@@ -742,33 +1315,11 @@ def plot_built_year_img(
         }
     }
 
-    resolution = built.rio.resolution()
-    pixel_area = abs(np.prod(resolution))
-
-    # Select specific year and transform into density
-    # Only densitities can be safely reprojected
-    built = built.sel(band=year) / pixel_area
-    built.rio.set_nodata(0)
-
-    # Reprojecto to lat lon
-    built = built.rio.reproject(dst_crs=4326)
-
-    # Get colorized image.
-    cmap = plt.get_cmap("cividis").copy()
-    colorized = cmap(built)
-    mask = built.values == 0
-    colorized[mask] = (0, 0, 0, 0)
-    colorized = np.uint8(colorized * 255)
-    img = ImageOps.flip(Image.fromarray(colorized))
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = built.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
+    if use_tiles and path_cache is not None:
+        layer, bounds = tile_layer(built, path_cache, "built_year", year=year)
+    else:
+        layer, bounds = built_year_overlay(built, year, max_pixels, path_cache)
+    lonmin, latmin, lonmax, latmax = bounds
 
     # Create figure
     west, south, east, north = bbox_latlon.bounds
@@ -793,80 +1344,12 @@ def plot_built_year_img(
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for i, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
-        )
-
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
-
-    # Add trace of bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
-    )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
-    )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
-
-
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
+    add_zone_outlines(fig, clusters_2020, bbox_mollweide, translations[language])
 
     fig.update_layout(coloraxis_colorbar_orientation="h")
-    fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
-    )
+    fig.update_layout(mapbox_layers=[layer])
 
     fig.add_annotation(
         text=f'Datos de: <a href="{url_built}"">GHS-BUILT-S</a>',
@@ -880,8 +1363,68 @@ def plot_built_year_img(
     return fig
 
 
-def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020, language = "es"):
-    
+def pop_year_overlay(
+    pop, year=2020, max_pixels=DISPLAY_PIXELS, path_cache=None
+):
+    """Image overlay with the population classes of year.
+
+    Population rasters larger than max_pixels are decimated before
+    reprojection, classes still refer to people per native pixel. The
+    reprojected population density of all years is persisted in
+    path_cache if given.
+
+    Returns
+    -------
+    layer : dict
+        Mapbox image layer.
+    bounds : tuple
+        Bounds of the image in lat lon.
+
+    """
+
+    factor = ru.decimation_factor(pop.rio.height, pop.rio.width, max_pixels)
+    pop = load_or_get_display_density(pop, "pop", "km", max_pixels, path_cache)
+    pop = pop.sel(band=year)
+
+    # Get back counts per native pixel
+    pop = pop * ru.get_area_grid(pop, "km") / factor**2
+
+    # Normalize values for colormap
+    n_classes = 7
+    pop_min = np.unique(pop)[1]
+    bounds = np.array(
+        [-1, pop_min / 2.0, 5.5, 20.5, 100.5, 300.5, 500.5, 1000.5, 10000]
+    )
+    norm = mpl.colors.BoundaryNorm(boundaries=bounds, ncolors=n_classes + 1)
+    pop_norm = norm(pop).data / n_classes
+
+    # Get colorized image, class 0 is transparent
+    index = render.continuous_index(pop_norm)
+    colorized = render.apply_lut(index, render.continuous_table("cividis"))
+    img = ImageOps.flip(Image.fromarray(colorized))
+    bounds = pop.rio.bounds()
+
+    return image_layer(img, bounds), bounds
+
+
+def plot_pop_year_img(
+    smod,
+    pop,
+    bbox_mollweide,
+    centroid_mollweide,
+    year=2020,
+    language="es",
+    max_pixels=DISPLAY_PIXELS,
+    path_cache=None,
+    use_tiles=True,
+):
+    """Plots population for year using XYZ tiles served from path_cache,
+    or an image overlay if use_tiles is False or no path_cache is given.
+
+    Population rasters larger than max_pixels are decimated before
+    reprojection, classes still refer to people per native pixel.
+    """
+
     translations = {
     "es": {
         "Population": "Población",
@@ -903,45 +1446,14 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020,
     }
 }
     
-    resolution = pop.rio.resolution()
-    pixel_area = abs(np.prod(resolution)) / 1e6
-
-    # Select specific year and transform into density
-    # Only densitities can be safely reprojected
-    pop = pop.sel(band=year) / pixel_area
-    pop.rio.set_nodata(0)
-
-    # Reprojecto to lat lon
-    pop = pop.rio.reproject(dst_crs=4326)
-
-    # Get back counts
-    pop = pop * ru.get_area_grid(pop, "km")
+    if use_tiles and path_cache is not None:
+        layer, bounds = tile_layer(pop, path_cache, "pop_year", year=year)
+    else:
+        layer, bounds = pop_year_overlay(pop, year, max_pixels, path_cache)
+    lonmin, latmin, lonmax, latmax = bounds
 
-    # Normalize values for colormap
     n_classes = 7
-    pop_min = np.unique(pop)[1]
-    bounds = np.array(
-        [-1, pop_min / 2.0, 5.5, 20.5, 100.5, 300.5, 500.5, 1000.5, 10000]
-    )
-    norm = mpl.colors.BoundaryNorm(boundaries=bounds, ncolors=n_classes + 1)
-    pop_norm = norm(pop).data / n_classes
-
-    # Get colorized image.
     cmap = plt.get_cmap("cividis").copy()
-    colorized = cmap(pop_norm)
-    mask = pop_norm == 0
-    colorized[mask] = (0, 0, 0, 0)
-    colorized = np.uint8(colorized * 255)
-    img = ImageOps.flip(Image.fromarray(colorized))
-
-    # Create image bounding box
-    lonmin, latmin, lonmax, latmax = pop.rio.bounds()
-    coordinates = [
-        [lonmin, latmin],
-        [lonmax, latmin],
-        [lonmax, latmax],
-        [lonmin, latmax],
-    ]
 
     mid_vals = ["3", "10", "50", "200", "400", "750", "2000"]
     cls_names = [
@@ -980,78 +1492,11 @@ def plot_pop_year_img(smod, pop, bbox_mollweide, centroid_mollweide, year=2020,
     )
 
     # Create polygons of urban clusters and centers
-    smod_p = smod_polygons(smod, centroid_mollweide)
+    smod_p = smod_polygons(smod, centroid_mollweide, path_cache)
     clusters_2020 = smod_p[(smod_p.year == 2020) & (smod_p["class"] == 2)]
-    clusters_2020 = clusters_2020.to_crs(4326)
-
-    n_mains = 0
-    n_other = 0
-    for i, row in clusters_2020.iterrows():
-        if row.is_main:
-            name = translations[language]["Central Zone"]
-            n_mains += 1
-        else:
-            name = translations[language]["Peripheral Zones"]
-            n_other += 1
-
-        linestring = row.geometry.exterior
-        x, y = linestring.xy
-        p_df = pd.DataFrame({"lats": y, "lons": x})
-        p_fig = px.line_mapbox(
-            p_df,
-            lat="lats",
-            lon="lons",
-            color=[name] * len(x),
-            color_discrete_map={
-                translations[language]["Central Zone"]: "maroon",
-                translations[language]["Peripheral Zones"]: "orange",
-            },
-        )
-
-        p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        if row.is_main and n_mains > 1:
-            p_fig.update_traces(showlegend=False)
-        if not row.is_main and n_other > 1:
-            p_fig.update_traces(showlegend=False)
-
-        fig.add_traces(p_fig.data)
+    add_zone_outlines(fig, clusters_2020, bbox_mollweide, translations[language])
 
-    # Agregar traza del bbox
-    bbox_temp = (
-        gpd.GeoDataFrame({"geometry": bbox_mollweide}, index=[0], crs="ESRI:54009")
-        .to_crs(4326)
-        .geometry.iloc[0]
-    )
-    x, y = bbox_temp.exterior.xy
-    p_df = pd.DataFrame({"lats": y, "lons": x})
-    p_fig = px.line_mapbox(
-        p_df,
-        lat="lats",
-        lon="lons",
-        color=[translations[language]["Analysis Zone"]] * len(x),
-        color_discrete_map={translations[language]["Analysis Zone"]: "blue"},
-    )
-    p_fig.update_traces(hovertemplate=None, hoverinfo="skip")
-    fig.add_traces(p_fig.data)
-
-    # High res image
-    if HIGH_RES:
-        img = img.resize(
-            [hw * 10 for hw in img.size], resample=Image.Resampling.NEAREST
-        )
-
-    fig.update_layout(
-        mapbox_layers=[
-            {
-                "sourcetype": "image",
-                "source": img,
-                "coordinates": coordinates,
-                "opacity": 0.7,
-                "below": "traces",
-            }
-        ]
-    )
+    fig.update_layout(mapbox_layers=[layer])
 
     fig.add_annotation(
         text=f'Datos de: <a href="{url_pop}"">GHS-POP</a>',
@@ -5,6 +5,7 @@ import geopandas as gpd
 import pandas as pd
 import ursa.ghsl as ghsl
 import ursa.sleuth_prep as sp
+import ursa.utils.cache as uc
 import ursa.utils.geometry as ug
 import ursa.world_cover as wc
 
@@ -15,6 +16,10 @@ from ursa.utils.raster import bbox_to_ee
 
 MAX_PIXELS = 1e10
 
+# Season and year shown in the heat islands page
+DEFAULT_SEASON = "Qall"
+DEFAULT_YEAR = 2022
+
 def fmask(image):
     qa = image.select("QA_PIXEL")
 
@@ -96,13 +101,14 @@ def get_temps(lst, masks):
 
 def load_or_get_temps(lst, masks, path_cache):
     fpath = path_cache / "temperatures.json"
-    if fpath.exists():
-        with open(fpath, "r") as f:
-            temps = json.load(f)
-    else:
-        temps = get_temps(lst, masks)
-        with open(path_cache / "temperatures.json", "w") as f:
-            json.dump(temps, f)
+    with uc.locked(fpath):
+        if fpath.exists():
+            with open(fpath, "r") as f:
+                temps = json.load(f)
+        else:
+            temps = get_temps(lst, masks)
+            with uc.atomic_path(fpath) as tmp, open(tmp, "w") as f:
+                json.dump(temps, f)
 
     return temps
 
@@ -172,11 +178,13 @@ def get_temperature_areas(img_cat, masks, bbox):
 
 def load_or_get_t_areas(bbox_ee, img_cat, masks, path_cache):
     fpath = path_cache / "temp_areas.csv"
-    if fpath.exists():
-        df = pd.read_csv(fpath, index_col="clase")
-    else:
-        df = get_temperature_areas(img_cat, masks, bbox_ee)
-        df.to_csv(path_cache / "temp_areas.csv")
+    with uc.locked(fpath):
+        if fpath.exists():
+            df = pd.read_csv(fpath, index_col="clase")
+        else:
+            df = get_temperature_areas(img_cat, masks, bbox_ee)
+            with uc.atomic_path(fpath) as tmp:
+                df.to_csv(tmp)
     return df
 
 
@@ -230,12 +238,14 @@ def get_land_usage_dataframe(bbox_ee, img_cat, lc):
 
 def load_or_get_land_usage_df(bbox_ee, img_cat, path_cache):
     fpath = path_cache / "land_cover_by_temp.csv"
-    if fpath.exists():
-        df = pd.read_csv(fpath)
-    else:
-        lc, _ = wc.get_cover_and_masks(bbox_ee, img_cat.projection())
-        df = get_land_usage_dataframe(bbox_ee, img_cat, lc)
-        df.to_csv(path_cache / "land_cover_by_temp.csv", index=False)
+    with uc.locked(fpath):
+        if fpath.exists():
+            df = pd.read_csv(fpath)
+        else:
+            lc, _ = wc.get_cover_and_masks(bbox_ee, img_cat.projection())
+            df = get_land_usage_dataframe(bbox_ee, img_cat, lc)
+            with uc.atomic_path(fpath) as tmp:
+                df.to_csv(tmp, index=False)
     return df
 
 
@@ -333,28 +343,32 @@ def load_or_get_radial_distributions(
     fpath_f = path_cache / "radial_function.csv"
     fpath_lc = path_cache / "radial_lc.csv"
 
-    if fpath_f.exists() and fpath_lc.exists():
-        df_f = pd.read_csv(fpath_f)
-        df_lc = pd.read_csv(fpath_lc, index_col="x")
-    else:
-        bbox_ee = bbox_to_ee(bbox_latlon)
-        
-        lst, proj = get_lst(bbox_ee, start_date, end_date)
-        lc, masks = wc.get_cover_and_masks(bbox_ee, proj)
+    # Both files are guarded by the lock of the radial function
+    with uc.locked(fpath_f):
+        if fpath_f.exists() and fpath_lc.exists():
+            df_f = pd.read_csv(fpath_f)
+            df_lc = pd.read_csv(fpath_lc, index_col="x")
+        else:
+            bbox_ee = bbox_to_ee(bbox_latlon)
 
-        temps = load_or_get_temps(lst, masks, path_cache)
-        rural_lst_mean = temps["rural"]["mean"]
+            lst, proj = get_lst(bbox_ee, start_date, end_date)
+            lc, masks = wc.get_cover_and_masks(bbox_ee, proj)
 
-        unwanted_mask = masks["unwanted"]
+            temps = load_or_get_temps(lst, masks, path_cache)
+            rural_lst_mean = temps["rural"]["mean"]
 
-        suhi = lst.subtract(rural_lst_mean)
-        suhi = suhi.updateMask(unwanted_mask)
-    
-        df_lc = get_radial_lc(bbox_latlon, uc_latlon, lc)
-        df_f = get_radial_f(bbox_latlon, uc_latlon, suhi)
+            unwanted_mask = masks["unwanted"]
 
-        df_lc.to_csv(fpath_lc)
-        df_f.to_csv(fpath_f)
+            suhi = lst.subtract(rural_lst_mean)
+            suhi = suhi.updateMask(unwanted_mask)
+
+            df_lc = get_radial_lc(bbox_latlon, uc_latlon, lc)
+            df_f = get_radial_f(bbox_latlon, uc_latlon, suhi)
+
+            with uc.atomic_path(fpath_lc) as tmp:
+                df_lc.to_csv(tmp)
+            with uc.atomic_path(fpath_f) as tmp:
+                df_f.to_csv(tmp)
 
     return df_f, df_lc
 
@@ -385,10 +399,8 @@ def add_area(feature):
 
 
 def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache):
-    smod = ghsl.load_or_download(
-        bbox_mollweide, "SMOD", data_path=path_cache, resolution=1000
-    )
-    smod_gdf = ghsl.smod_polygons(smod, uc_mollweide_centroid)
+    smod = ghsl.load_or_derive_smod(bbox_mollweide, path_cache)
+    smod_gdf = ghsl.smod_polygons(smod, uc_mollweide_centroid, path_cache)
     clusters_gdf = smod_gdf[smod_gdf["class"] == 2]
     main_cluster = clusters_gdf[clusters_gdf.is_main]
 
@@ -409,7 +421,9 @@ def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_ca
         {"roofs": roof_area, "urban": urban_area, "roads": road_lenght}, index=[0]
     )
 
-    df.to_csv(path_cache / "mitigation_areas.csv", index=False)
+    fpath = path_cache / f"mitigation_areas{ghsl.smod_suffix()}.csv"
+    with uc.atomic_path(fpath) as tmp:
+        df.to_csv(tmp, index=False)
 
     print("Done.")
 
@@ -419,13 +433,14 @@ def get_mit_areas_df(bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_ca
 def load_or_get_mit_areas_df(
     bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache, force=False
 ):
-    fpath = path_cache / "mitigation_areas.csv"
-    if fpath.exists() and not force:
-        df = pd.read_csv(fpath)
-    else:
-        df = get_mit_areas_df(
-            bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache
-        )
+    fpath = path_cache / f"mitigation_areas{ghsl.smod_suffix()}.csv"
+    with uc.locked(fpath):
+        if fpath.exists() and not force:
+            df = pd.read_csv(fpath)
+        else:
+            df = get_mit_areas_df(
+                bbox_latlon, bbox_mollweide, uc_mollweide_centroid, path_cache
+            )
     return df
 
 
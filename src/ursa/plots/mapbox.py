@@ -0,0 +1,100 @@
+import numpy as np
+import plotly.graph_objects as go
+import shapely
+
+
+def simplify_to_budget(geoms, max_vertices):
+    """Simplifies geoms with Douglas-Peucker until they have at most
+    max_vertices vertices in total.
+
+    The tolerance starts at a ten thousandth of the extent of geoms and is
+    doubled until the budget is met. Geometries keep at least the vertices
+    needed to stay valid, so very small budgets may not be reached.
+    """
+
+    geoms = np.asarray(geoms)
+    if shapely.get_num_coordinates(geoms).sum() <= max_vertices:
+        return geoms
+
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geoms)
+    extent = max(xmax - xmin, ymax - ymin)
+
+    simplified = geoms
+    tolerance = extent * 1e-4
+    while tolerance < extent:
+        simplified = shapely.simplify(geoms, tolerance)
+        if shapely.get_num_coordinates(simplified).sum() <= max_vertices:
+            break
+        tolerance *= 2
+
+    return simplified
+
+
+def outline_coords(geoms, max_vertices=None):
+    """Coordinates of the exterior rings of polygons, separated by None.
+
+    Parameters
+    ----------
+    geoms : array_like of shapely.Polygon or shapely.MultiPolygon
+        Polygons to outline, in lat lon.
+    max_vertices : int, optional
+        Vertex budget, rings are simplified to meet it if given.
+
+    Returns
+    -------
+    lon, lat : np.ndarray
+        Object arrays with the coordinates of each ring followed by None,
+        so a single line trace draws them as separate lines.
+
+    """
+
+    parts = shapely.get_parts(np.asarray(geoms))
+    rings = shapely.get_exterior_ring(parts)
+    if max_vertices is not None:
+        rings = simplify_to_budget(rings, max_vertices)
+
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+
+    # Leave a gap after the last vertex of each ring
+    ends = np.flatnonzero(np.diff(index)) + 1
+    lon = np.insert(coords[:, 0].astype(object), ends, None)
+    lat = np.insert(coords[:, 1].astype(object), ends, None)
+
+    return lon, lat
+
+
+def outline_trace(geoms, name, color, max_vertices=None, showlegend=True):
+    """Scattermapbox trace with the outlines of all geoms.
+
+    Parameters
+    ----------
+    geoms : array_like of shapely.Polygon or shapely.MultiPolygon
+        Polygons to outline, in lat lon.
+    name : str
+        Legend entry of the trace.
+    color : str
+        Line color.
+    max_vertices : int, optional
+        Vertex budget, see outline_coords.
+    showlegend : bool
+        Whether to show the trace in the legend.
+
+    Returns
+    -------
+    trace : go.Scattermapbox
+        A single trace drawing every outline.
+
+    """
+
+    lon, lat = outline_coords(geoms, max_vertices)
+
+    return go.Scattermapbox(
+        lon=lon,
+        lat=lat,
+        mode="lines",
+        name=name,
+        legendgroup=name,
+        line_color=color,
+        showlegend=showlegend,
+        hoverinfo="skip",
+    )
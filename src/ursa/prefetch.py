@@ -0,0 +1,151 @@
+"""Background warm-up of the city cache.
+
+When a city is selected, warm_up schedules the cold work of every page on
+background threads. Stages that depend on each other run in a chain, in
+priority order: GHSL rasters, Degree of Urbanization and SLEUTH inputs. The
+Google Earth Engine heat island statistics depend on none of them and run
+concurrently. Each stage is tracked with its own future. Page callbacks call
+attach before doing the same work, so they wait for the stage in flight
+instead of duplicating it. The work holds the locks of the city cache, so
+a page could not do it any sooner by not waiting.
+"""
+
+import threading
+
+import ursa.degree_of_urbanization as dou
+import ursa.ghsl as ghsl
+import ursa.heat_islands as ht
+import ursa.sleuth_prep as sp
+import ursa.utils.geometry as ug
+import ursa.world_cover as wc
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from ursa.utils.raster import bbox_to_ee
+
+MAX_CITIES = 2
+
+_futures = {}
+_lock = threading.Lock()
+
+
+def stage_ghsl(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    ghsl.load_or_download_many(
+        bbox_mollweide,
+        ghsl.smod_datasets() + [("BUILT_S", 100), ("POP", 100), ("LAND", 100)],
+        data_path=path_cache,
+    )
+    ghsl.load_or_derive_smod(bbox_mollweide, path_cache)
+
+
+def stage_dou(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    # Runs in a thread of the app, forking a process pool from it is unsafe
+    dou.load_or_process_dou(bbox_mollweide, path_cache, max_workers=1)
+
+
+def stage_sleuth(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    sp.load_or_prep_rasters(bbox_mollweide, path_cache)
+
+
+def stage_suhi(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    bbox_ee = bbox_to_ee(bbox_latlon)
+    start_date, end_date = ht.date_format(ht.DEFAULT_SEASON, ht.DEFAULT_YEAR)
+
+    lst, proj = ht.get_lst(bbox_ee, start_date, end_date)
+    _, masks = wc.get_cover_and_masks(bbox_ee, proj)
+
+    img_cat = ht.get_cat_suhi(lst, masks, path_cache)
+    ht.load_or_get_t_areas(bbox_ee, img_cat, masks, path_cache)
+    ht.load_or_get_land_usage_df(bbox_ee, img_cat, path_cache)
+    ht.load_or_get_radial_distributions(
+        bbox_latlon, uc_latlon, start_date, end_date, path_cache
+    )
+
+
+# Stages in priority order
+STAGES = {
+    "ghsl": stage_ghsl,
+    "dou": stage_dou,
+    "sleuth": stage_sleuth,
+    "suhi": stage_suhi,
+}
+
+# Each chain runs its stages in order, chains run concurrently
+CHAINS = [["ghsl", "dou", "sleuth"], ["suhi"]]
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CITIES * len(CHAINS))
+
+
+def run_stages(id_hash, stages, bbox_latlon, uc_latlon, path_cache):
+    bbox_mollweide = ug.reproject_geometry(bbox_latlon, "ESRI:54009").envelope
+
+    for name, future in stages.items():
+        print(f"Warming up {name} for {id_hash} ...")
+        try:
+            STAGES[name](bbox_latlon, uc_latlon, bbox_mollweide, path_cache)
+            future.set_result(True)
+        except Exception as e:
+            print(f"Warm up of {name} for {id_hash} failed: {e}")
+            future.set_exception(e)
+
+
+def warm_up(id_hash, bbox_latlon, uc_latlon, path_cache):
+    """Starts the background warm-up of a city, unless it is already running.
+
+    Parameters
+    ----------
+    id_hash : int or str
+        Hash of the city bounding box.
+    bbox_latlon : Polygon
+        Bounding box of the city in lat-lon.
+    uc_latlon : Polygon
+        Urban center of the city in lat-lon.
+    path_cache : Path
+        Path to the city cache directory.
+
+    """
+
+    id_hash = str(id_hash)
+
+    with _lock:
+        running = [
+            future
+            for (h, _), future in _futures.items()
+            if h == id_hash and not future.done()
+        ]
+        if len(running) > 0:
+            return
+
+        # Finished stages are no longer needed, pages fall back to the cache
+        for key in [key for key, future in _futures.items() if future.done()]:
+            del _futures[key]
+
+        stages = {name: Future() for name in STAGES}
+        for name, future in stages.items():
+            future.set_running_or_notify_cancel()
+            _futures[(id_hash, name)] = future
+
+    for chain in CHAINS:
+        _executor.submit(
+            run_stages,
+            id_hash,
+            {name: stages[name] for name in chain},
+            bbox_latlon,
+            uc_latlon,
+            path_cache,
+        )
+
+
+def attach(id_hash, stage):
+    """Waits for a warm-up stage of a city if it was scheduled.
+
+    Only stage is waited for, stages it depends on run before it in its
+    chain. Returns True if the stage finished successfully, False if it
+    failed or was never scheduled, in which case the caller does the work
+    itself.
+    """
+
+    future = _futures.get((str(id_hash), stage))
+    if future is None:
+        return False
+
+    return future.exception() is None
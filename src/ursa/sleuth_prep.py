@@ -8,25 +8,30 @@ import osmnx as ox
 import rioxarray as rxr
 import ursa.degree_of_urbanization as dou
 import ursa.ghsl as ghsl
+import ursa.utils.cache as uc
 import ursa.utils.geometry as ug
 import ursa.utils.raster as ru
 import xarray as xr
 
 from geocube.api.core import make_geocube
 from rasterio.enums import Resampling
+from scipy import ndimage
 from scipy.spatial import KDTree
 
 
 def load_or_prep_rasters(bbox_mollweide, path_cache):
-    all_exist = True
-    for path in ["urban", "roads", "slope", "excluded", "years"]:
-        full_path = path_cache / f"{path}.npy"
-        all_exist &= full_path.exists()
+    # attributes.json is written last by prep_rasters, its lock guards all
+    # the SLEUTH inputs
+    with uc.locked(path_cache / "attributes.json"):
+        all_exist = True
+        for path in ["urban", "roads", "slope", "excluded", "years"]:
+            full_path = path_cache / f"{path}.npy"
+            all_exist &= full_path.exists()
 
-    all_exist &= (path_cache / "attributes.json").exists()
+        all_exist &= (path_cache / "attributes.json").exists()
 
-    if not all_exist:
-        prep_rasters(bbox_mollweide, path_cache)
+        if not all_exist:
+            prep_rasters(bbox_mollweide, path_cache)
 
     return True
 
@@ -87,11 +92,16 @@ def prep_rasters(bbox_mollweide, path_cache):
     geocube = bbox_to_geocube(bbox_latlon, path_cache, dou_xr)
     roads, *_ = load_roads(geocube)
 
-    np.save(path_cache / "years", urban_years)
-    np.save(path_cache / "urban", dou_xr.values)
-    np.save(path_cache / "roads", roads.values)
-    np.save(path_cache / "slope", slope_xr.values)
-    np.save(path_cache / "excluded", excluded_xr.values)
+    arrays = dict(
+        years=urban_years,
+        urban=dou_xr.values,
+        roads=roads.values,
+        slope=slope_xr.values,
+        excluded=excluded_xr.values,
+    )
+    for name, array in arrays.items():
+        with uc.atomic_path(path_cache / f"{name}.npy") as tmp:
+            np.save(tmp, array)
 
     attr_dict = dict(
         years=[int(year) for year in dou_xr.year.values],
@@ -101,8 +111,9 @@ def prep_rasters(bbox_mollweide, path_cache):
         crs=dou_xr.rio.crs.to_string(),
     )
 
-    with open(path_cache / "attributes.json", "w", encoding="utf8") as f:
-        json.dump(attr_dict, f)
+    with uc.atomic_path(path_cache / "attributes.json") as tmp:
+        with open(tmp, "w", encoding="utf8") as f:
+            json.dump(attr_dict, f)
 
 
 def load_excluded(bbox_ee, bbox_mollweide, path_cache, raster_to_match):
@@ -198,7 +209,7 @@ def load_worldcover(bbox, path_cache, raster_to_match):
                 print(f"An error occurred while downloading {basename} 2.")
                 return
 
-            with open(fpath, "wb") as fd:
+            with uc.atomic_path(fpath) as tmp, open(tmp, "wb") as fd:
                 fd.write(r.content)
             print(f"Data downloaded to {fpath}")
 
@@ -216,7 +227,8 @@ def load_worldcover(bbox, path_cache, raster_to_match):
     print("Reproyectando y guardando el archivo de World Cover...")
     worldcover = worldcover.rio.reproject_match(raster_to_match, Resampling.mode)
     worldcover.name = "worldcover"
-    np.save(path_cache / "worldcover.npy", worldcover)
+    with uc.atomic_path(path_cache / "worldcover.npy") as tmp:
+        np.save(tmp, worldcover)
     print("Archivo de World Cover reproyectado y guardado.")
 
 
@@ -315,7 +327,7 @@ def local_download(img, bbox, fpath):
             print(f"An error occurred while downloading {basename} 2.")
             return
 
-        with open(fpath, "wb") as fd:
+        with uc.atomic_path(fpath) as tmp, open(tmp, "wb") as fd:
             fd.write(r.content)
         print(f"Data downloaded to {fpath}")
 
@@ -339,6 +351,122 @@ def bbox_to_geocube(bbox, path_cache, raster_to_match):
     return roads
 
 
+def next_road(is_road, axis):
+    """Index of the first road at or after each pixel along axis, the
+    length of the grid along axis where there is none."""
+
+    n = is_road.shape[axis]
+    idx = np.arange(n, dtype=np.int32)
+    idx = idx[:, None] if axis == 0 else idx[None, :]
+    idx = np.where(is_road, idx, np.int32(n))
+    idx = np.flip(idx, axis=axis)
+    return np.flip(np.minimum.accumulate(idx, axis=axis), axis=axis)
+
+
+def nearest_roads(roads, d_metric=np.inf, rows=256):
+    """Finds the nearest road pixel of every pixel of a 2D road grid.
+
+    For the default chebyshev distance (Moore neighborhood) distances come
+    from an exact chessboard distance transform of the grid. Of the roads
+    at that distance, the one with the lowest flat index is returned, i.e.
+    the first in row major order. A nearest road lies on the ring of that
+    radius around the pixel, so it is found on the top row of the ring, on
+    its sides or on its bottom row, in that order.
+
+    Other distances query a KDTree of the road pixels, ties are then
+    broken by the traversal of the tree.
+
+    Parameters
+    ----------
+    roads : np.ndarray
+        Road grid, 0 outside roads.
+    d_metric : float
+        Minkowski p of the distance, np.inf by default.
+    rows : int
+        Rows of the grid processed at once.
+
+    Returns
+    -------
+    road_i, road_j : np.ndarray
+        int32 row and column of the nearest road.
+    road_dist : np.ndarray
+        int32 distance to the nearest road, truncated.
+
+    """
+
+    if d_metric != np.inf:
+        return nearest_roads_kdtree(roads, d_metric, rows)
+
+    is_road = roads > 0
+    road_dist = ndimage.distance_transform_cdt(~is_road, metric="chessboard")
+    road_dist = road_dist.astype(np.int32)
+
+    height, width = roads.shape
+    right = next_road(is_road, axis=1)
+    down = next_road(is_road, axis=0)
+
+    road_i = np.empty(roads.shape, dtype=np.int32)
+    road_j = np.empty(roads.shape, dtype=np.int32)
+    j = np.arange(width, dtype=np.int32)[None, :]
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        i = np.arange(start, stop, dtype=np.int32)[:, None]
+        d = road_dist[start:stop]
+
+        # Ring of radius d around each pixel, clipped to the grid
+        top, bottom = i - d, i + d
+        left = np.maximum(j - d, 0)
+        last_col = np.minimum(j + d, width - 1)
+
+        # First road of the top and bottom rows within the ring
+        top_col = right[np.maximum(top, 0), left]
+        on_top = (top >= 0) & (top_col <= last_col)
+        bottom_col = right[np.minimum(bottom, height - 1), left]
+
+        # First road of the left and right sides, between those rows
+        first_row = np.minimum(np.maximum(top + 1, 0), height - 1)
+        last_row = np.minimum(bottom - 1, height - 1)
+        left_row = np.where(j - d >= 0, down[first_row, np.maximum(j - d, 0)], height)
+        right_row = np.where(
+            j + d < width, down[first_row, np.minimum(j + d, width - 1)], height
+        )
+        side_row = np.minimum(left_row, right_row)
+        side_col = np.where(left_row <= right_row, j - d, j + d)
+        on_side = side_row <= last_row
+
+        road_i[start:stop] = np.where(on_top, top, np.where(on_side, side_row, bottom))
+        road_j[start:stop] = np.where(
+            on_top, top_col, np.where(on_side, side_col, bottom_col)
+        )
+
+    return road_i, road_j, road_dist
+
+
+def nearest_roads_kdtree(roads, d_metric, rows=256):
+    """nearest_roads for any Minkowski p, querying a KDTree of the road
+    pixels strip by strip with all cores."""
+
+    road_idx = np.column_stack(np.where(roads > 0))
+    tree = KDTree(road_idx)
+
+    height, width = roads.shape
+    road_i = np.empty(roads.shape, dtype=np.int32)
+    road_j = np.empty(roads.shape, dtype=np.int32)
+    road_dist = np.empty(roads.shape, dtype=np.int32)
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        grid_i, grid_j = np.meshgrid(range(start, stop), range(width), indexing="ij")
+        coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
+        dist, idxs = tree.query(coords, p=d_metric, workers=-1)
+
+        shape = (stop - start, width)
+        road_dist[start:stop] = dist.reshape(shape).astype(np.int32)
+        road_i[start:stop] = road_idx[:, 0][idxs].reshape(shape)
+        road_j[start:stop] = road_idx[:, 1][idxs].reshape(shape)
+
+    return road_i, road_j, road_dist
+
+
 def derive_auxiliary_roads(roads, d_metric=np.inf):
     roads = roads.copy()
 
@@ -348,22 +476,8 @@ def derive_auxiliary_roads(roads, d_metric=np.inf):
     roads.values[-1, :] = 0
     roads.values[:, -1] = 0
 
-    # Create bands with nearest roads indices
-    road_idx = np.column_stack(np.where(roads.values > 0))
-    # KDtree for fast neighbor lookup
-    tree = KDTree(road_idx)
-    # Explicitly create raster grid
-    I, J = roads.values.shape
-    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
-    # Get coordinate pairs (i,j) to loop over
-    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
-    # Find nearest road for every lattice point
-    # p=inf is chebyshev distance (moore neighborhood)
-    dist, idxs = tree.query(coords, p=d_metric)
-    # Create bands
-    dist = dist.reshape(roads.shape).astype(np.int32)
-    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
-    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+    # Create bands with nearest roads indices and distances
+    road_i, road_j, dist = nearest_roads(roads.values, d_metric)
 
     roads.name = "roads"
     road_i = roads.copy(data=road_i)
@@ -385,22 +499,8 @@ def derive_auxiliary_roads_numpy(roads, d_metric=np.inf):
     roads[-1, :] = 0
     roads[:, -1] = 0
 
-    # Create bands with nearest roads indices
-    road_idx = np.column_stack(np.where(roads > 0))
-    # KDtree for fast neighbor lookup
-    tree = KDTree(road_idx)
-    # Explicitly create raster grid
-    I, J = roads.shape
-    grid_i, grid_j = np.meshgrid(range(I), range(J), indexing="ij")
-    # Get coordinate pairs (i,j) to loop over
-    coords = np.column_stack([grid_i.ravel(), grid_j.ravel()])
-    # Find nearest road for every lattice point
-    # p=inf is chebyshev distance (moore neighborhood)
-    road_dist, idxs = tree.query(coords, p=d_metric)
-    # Create bands
-    road_dist = road_dist.reshape(roads.shape).astype(np.int32)
-    road_i = road_idx[:, 0][idxs].reshape(roads.shape).astype(np.int32)
-    road_j = road_idx[:, 1][idxs].reshape(roads.shape).astype(np.int32)
+    # Create bands with nearest roads indices and distances
+    road_i, road_j, road_dist = nearest_roads(roads, d_metric)
 
     return roads, road_i, road_j, road_dist
 
@@ -492,27 +592,32 @@ def load_roads_osm(bbox, path_cache, force_download=False):
     # Load the road graph
     G_path = path_cache / "road_network.graphml"
     edges_path = path_cache / "roads.gpkg"
-    if not edges_path.is_file() or force_download:
-        if not G_path.is_file():
-            print("Downloading the graph...")
-            # Download roads from OSM
-            G = ox.graph_from_polygon(bbox, network_type="drive")
-            G = ox.project_graph(G, to_crs="ESRI:54009")
-            ox.save_graphml(G, G_path)
+    with uc.locked(edges_path):
+        if not edges_path.is_file() or force_download:
+            if not G_path.is_file():
+                print("Downloading the graph...")
+                # Download roads from OSM
+                G = ox.graph_from_polygon(bbox, network_type="drive")
+                G = ox.project_graph(G, to_crs="ESRI:54009")
+                with uc.atomic_path(G_path) as tmp:
+                    ox.save_graphml(G, tmp)
+            else:
+                print("Loading the graph...")
+                G = ox.load_graphml(G_path)
+
+            # Create vector geodataframe to burn in
+            print("Creating edges gdf...")
+            edges = ox.graph_to_gdfs(G, nodes=False)
+            # Specify weight type, larger means more accessible
+            edges["weight"] = edges.apply(
+                lambda x: simplify_road_type(x.highway), axis=1
+            )
+            edges = edges[["length", "weight", "geometry"]]
+            with uc.atomic_path(edges_path) as tmp:
+                edges.to_file(tmp)
         else:
-            print("Loading the graph...")
-            G = ox.load_graphml(G_path)
-
-        # Create vector geodataframe to burn in
-        print("Creating edges gdf...")
-        edges = ox.graph_to_gdfs(G, nodes=False)
-        # Specify weight type, larger means more accessible
-        edges["weight"] = edges.apply(lambda x: simplify_road_type(x.highway), axis=1)
-        edges = edges[["length", "weight", "geometry"]]
-        edges.to_file(path_cache / "roads.gpkg")
-    else:
-        print("Loading edges gdf...")
-        edges = gpd.read_file(path_cache / "roads.gpkg")
+            print("Loading edges gdf...")
+            edges = gpd.read_file(edges_path)
 
     print("Done.")
     return edges
@@ -0,0 +1,328 @@
+"""XYZ map tiles rendered from the cached GHSL rasters of a city.
+
+Historic growth maps used to embed a full extent RGBA image of each raster
+in the Plotly figure, which made callback payloads tens of MB large. The
+figures now reference a raster tile layer instead and the browser requests
+256 x 256 PNG tiles in Web Mercator from a Flask route on the Dash server.
+
+Tiles are rendered on demand from the Zarr store in the city cache, reading
+only the window under the tile, and colorized as the image overlays in
+ursa.ghsl were. Rendered tiles are kept in an in-process LRU cache and in
+the tiles directory of the city cache, under the versions of the renderer
+and of the store raster so they are never served stale. ursa-warm renders
+the tiles of the maps up to WARM_ZOOM ahead of time, see warm_tiles.
+
+Tile URLs have the form
+
+    /tiles/{id_hash}/{layer}/{z}/{x}/{y}.png?year=2020
+
+with layer one of LAYERS, year one of YEARS and, for the built_agg layer, a
+thresh parameter between 0 and 1, rounded to two decimals.
+"""
+
+import os
+
+import numpy as np
+import rasterio as rio
+import ursa.utils.render as render
+import ursa.utils.store as store
+
+from flask import Response, abort, has_request_context, request
+from functools import lru_cache
+from pathlib import Path
+from rasterio.warp import Resampling
+
+TILE_PX = 256
+MAX_ZOOM = 18
+TILE_CACHE_SIZE = int(os.environ.get("URSA_TILE_LRU", 4096))
+PATH_CACHE = Path("./data/cache/")
+
+# Half the side of the Web Mercator square, in meters
+MERCATOR_EXTENT = 20037508.342789244
+
+LAYERS = ("built_agg", "built_year", "pop_year")
+YEARS = tuple(range(1975, 2021, 5))
+DEFAULT_YEAR = 2020
+DEFAULT_THRESH = 0.2
+
+# Version of the tile rendering, bump it when the tiles change
+TILE_VERSION = 1
+
+# Deepest zoom rendered ahead of time by warm_tiles
+WARM_ZOOM = 12
+
+# Parameters of the tiles requested by the maps of the app
+MAP_LAYERS = (
+    ("built_agg", dict(thresh=DEFAULT_THRESH)),
+    ("built_year", dict(year=DEFAULT_YEAR)),
+    ("pop_year", dict(year=DEFAULT_YEAR)),
+)
+
+# Upper bounds of the population classes, people per native pixel
+POP_BOUNDS = np.array([0, 5.5, 20.5, 100.5, 300.5, 500.5, 1000.5])
+
+
+def tile_bounds(z, x, y):
+    """Bounds of tile z/x/y in Web Mercator."""
+
+    size = 2 * MERCATOR_EXTENT / 2**z
+    left = -MERCATOR_EXTENT + x * size
+    top = MERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_under(bounds, z):
+    """Columns and rows of the tiles of zoom z over Web Mercator bounds."""
+
+    left, bottom, right, top = bounds
+    size = 2 * MERCATOR_EXTENT / 2**z
+    x_min = max(int((left + MERCATOR_EXTENT) // size), 0)
+    x_max = min(int((right + MERCATOR_EXTENT) // size), 2**z - 1)
+    y_min = max(int((MERCATOR_EXTENT - top) // size), 0)
+    y_max = min(int((MERCATOR_EXTENT - bottom) // size), 2**z - 1)
+    return range(x_min, x_max + 1), range(y_min, y_max + 1)
+
+
+def tile_url(id_hash, layer, **params):
+    """URL template of a tile layer, as expected by a mapbox raster layer.
+
+    Mapbox loads tiles from a web worker, so the URL is made absolute when
+    called within a request, e.g. from a Dash callback.
+    """
+
+    assert layer in LAYERS, f"Layer must be in {LAYERS}."
+
+    root = request.host_url if has_request_context() else "/"
+    url = f"{root}tiles/{id_hash}/{layer}/{{z}}/{{x}}/{{y}}.png"
+    if params:
+        url += "?" + "&".join(f"{k}={v}" for k, v in params.items())
+    return url
+
+
+def city_version(id_hash, name):
+    """Version of the tiles of a city raster, see store.raster_version.
+
+    Read on every call, so a raster rewritten while the server runs gets
+    new tiles, handles and bounds.
+    """
+
+    version = store.raster_version(PATH_CACHE / id_hash, name)
+    if version is None:
+        raise FileNotFoundError(f"{name} not cached for {id_hash}.")
+    return f"v{TILE_VERSION}_{version}"
+
+
+@lru_cache(maxsize=64)
+def open_city_raster(id_hash, name, version):
+    """Opens a city raster, version is the one of city_version and keys
+    the cache."""
+
+    return store.open_raster(PATH_CACHE / id_hash, name)
+
+
+@lru_cache(maxsize=64)
+def city_bounds(id_hash, name, version):
+    """Bounds of a city raster in Web Mercator."""
+
+    raster = open_city_raster(id_hash, name, version)
+    return rio.warp.transform_bounds(
+        raster.rio.crs, "EPSG:3857", *raster.rio.bounds(), densify_pts=21
+    )
+
+
+def tile_window(raster, bounds):
+    """Rows and columns of raster under bounds, None if they do not
+    intersect."""
+
+    left, bottom, right, top = rio.warp.transform_bounds(
+        "EPSG:3857", raster.rio.crs, *bounds, densify_pts=21
+    )
+    transform = raster.rio.transform()
+    col_min, row_min = ~transform * (left, top)
+    col_max, row_max = ~transform * (right, bottom)
+
+    # One pixel margin so resampling at the tile edges sees its neighbours
+    row_min = max(int(np.floor(row_min)) - 1, 0)
+    col_min = max(int(np.floor(col_min)) - 1, 0)
+    row_max = min(int(np.ceil(row_max)) + 1, raster.rio.height)
+    col_max = min(int(np.ceil(col_max)) + 1, raster.rio.width)
+    if row_min >= row_max or col_min >= col_max:
+        return None
+
+    return slice(row_min, row_max), slice(col_min, col_max)
+
+
+def read_window(raster, window, bands):
+    """Reads a window of raster.
+
+    Returns
+    -------
+    data : np.ndarray
+        Float array with dimensions (band, y, x), nodata set to 0.
+    transform : Affine
+        Transform of the window.
+
+    """
+
+    rows, cols = window
+    data = raster.sel(band=bands).isel(y=rows, x=cols).values.astype("float32")
+    if raster.rio.nodata is not None:
+        data[data == raster.rio.nodata] = 0
+
+    transform = raster.rio.transform() * rio.Affine.translation(cols.start, rows.start)
+    return data, transform
+
+
+def warp(data, src_transform, src_crs, bounds, resampling):
+    """Reprojects a (band, y, x) array into the pixels of a tile."""
+
+    dst = np.zeros((data.shape[0], TILE_PX, TILE_PX), dtype="float32")
+    rio.warp.reproject(
+        data,
+        dst,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        dst_transform=rio.transform.from_bounds(*bounds, TILE_PX, TILE_PX),
+        dst_crs="EPSG:3857",
+        resampling=resampling,
+    )
+    return dst
+
+
+def classify(layer, raster, data, thresh):
+    """Turns the warped tile data of a layer into color table indices."""
+
+    pixel_area = abs(np.prod(raster.rio.resolution()))
+
+    if layer == "built_agg":
+        # Earliest year the built fraction is over thresh, 1 for 1975
+        built_bin = data / pixel_area > thresh
+        classes = np.where(built_bin.any(axis=0), built_bin.argmax(axis=0) + 1, 0)
+        return classes, render.categorical_table("cividis", len(data))
+
+    if layer == "built_year":
+        fraction = data[0] / pixel_area
+        return render.continuous_index(fraction), render.continuous_table("cividis")
+
+    # People per native pixel, averaged over the tile pixel
+    classes = np.digitize(data[0], POP_BOUNDS, right=True)
+    return classes, render.class_table("cividis", len(POP_BOUNDS))
+
+
+def tile_path(key):
+    id_hash, layer, year, thresh, z, x, y, version = key
+    fname = f"{year}_{thresh}/{z}/{x}/{y}.png"
+    return PATH_CACHE / id_hash / "tiles" / version / layer / fname
+
+
+_tile_cache = render.PNGCache(TILE_CACHE_SIZE, path=tile_path)
+
+
+def render_tile(id_hash, layer, z, x, y, year=DEFAULT_YEAR, thresh=DEFAULT_THRESH):
+    """Renders tile z/x/y of a city layer.
+
+    Built up area and population are reprojected as densities, averaging
+    the native pixels under each tile pixel. Tiles are cached in memory and
+    in the tiles directory of the city cache.
+
+    Returns
+    -------
+    png : bytes
+        PNG encoded RGBA tile.
+
+    """
+
+    name = "POP_100" if layer == "pop_year" else "BUILT_S_100"
+    version = city_version(id_hash, name)
+    raster = open_city_raster(id_hash, name, version)
+
+    if layer == "built_agg":
+        bands = raster.band.values.tolist()
+        # Year does not change the layer, keep a single cache entry
+        year = None
+    else:
+        if year not in raster.band.values:
+            raise ValueError(f"Year {year} not available.")
+        bands = [year]
+        thresh = None
+
+    # Tiles off the city are not cached
+    left, bottom, right, top = tile_bounds(z, x, y)
+    c_left, c_bottom, c_right, c_top = city_bounds(id_hash, name, version)
+    if left >= c_right or right <= c_left or bottom >= c_top or top <= c_bottom:
+        return empty_tile()
+
+    def render_png():
+        bounds = (left, bottom, right, top)
+        window = tile_window(raster, bounds)
+        if window is None:
+            return empty_tile()
+
+        data, transform = read_window(raster, window, bands)
+        data = warp(data, transform, raster.rio.crs, bounds, Resampling.average)
+        index, table = classify(layer, raster, data, thresh)
+        return render.encode_png(render.apply_lut(index, table))
+
+    key = (id_hash, layer, year, thresh, z, x, y, version)
+    return _tile_cache.get(key, render_png)
+
+
+def warm_tiles(id_hash, max_zoom=WARM_ZOOM):
+    """Renders the tiles of the maps of a city up to max_zoom, so the
+    first visit finds them in the tiles directory of the city cache.
+
+    Returns
+    -------
+    n_tiles : int
+        Number of tiles over the city.
+
+    """
+
+    n_tiles = 0
+    for layer, params in MAP_LAYERS:
+        name = "POP_100" if layer == "pop_year" else "BUILT_S_100"
+        bounds = city_bounds(id_hash, name, city_version(id_hash, name))
+        for z in range(max_zoom + 1):
+            cols, rows = tiles_under(bounds, z)
+            for x in cols:
+                for y in rows:
+                    render_tile(id_hash, layer, z, x, y, **params)
+            n_tiles += len(cols) * len(rows)
+
+    return n_tiles
+
+
+@lru_cache(maxsize=None)
+def empty_tile():
+    return render.encode_png(np.zeros((TILE_PX, TILE_PX, 4), dtype="uint8"))
+
+
+def register(server):
+    """Adds the tile route to the Flask server of the Dash app."""
+
+    @server.route("/tiles/<id_hash>/<layer>/<int:z>/<int:x>/<int:y>.png")
+    def serve_tile(id_hash, layer, z, x, y):
+        # id_hash is used as a directory name, only accept integer hashes
+        if layer not in LAYERS or not id_hash.lstrip("-").isdigit():
+            abort(404)
+        if z > MAX_ZOOM or x >= 2**z or y >= 2**z:
+            abort(404)
+
+        # Parameters end up in the tile cache paths, only accept the values
+        # the maps use so clients cannot grow the cache without bound
+        year = request.args.get("year", DEFAULT_YEAR, type=int)
+        thresh = request.args.get("thresh", DEFAULT_THRESH, type=float)
+        thresh = round(thresh, 2)
+        if year not in YEARS or not 0 < thresh < 1:
+            abort(400)
+
+        try:
+            png = render_tile(id_hash, layer, z, x, y, year=year, thresh=thresh)
+        except (FileNotFoundError, ValueError):
+            abort(404)
+
+        response = Response(png, mimetype="image/png")
+        response.headers["Cache-Control"] = "public, max-age=86400"
+        return response
+
+    return serve_tile
@@ -1,10 +1,109 @@
+"""City cache helpers.
+
+Several threads or server processes may serve the same city at once, so
+every load_or_* helper guards its artifacts with locked and writes them
+through atomic_path:
+
+    with locked(fpath):
+        if not fpath.exists():
+            with atomic_path(fpath) as tmp:
+                df.to_csv(tmp)
+
+The first caller computes the artifact while later callers block on the
+lock and then find it on disk, so each artifact is computed once. Readers
+never see a partially written file, a crash leaves at most a stray
+temporary file behind.
+"""
+
 import json
+import os
+import threading
 
 import geopandas as gpd
 
+from contextlib import contextmanager
+from pathlib import Path
 from ursa.utils.geometry import geometry_to_json, hash_geometry
 from ursa.utils.raster import get_bboxes
 
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(key):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(key, threading.Lock())
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        # msvcrt gives up after 10 seconds, keep waiting
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def locked(fpath):
+    """Holds an exclusive lock on the cache artifact fpath.
+
+    The lock lives in a sibling .lock file, so it excludes other processes
+    as well as other threads of this one. Blocks until the lock is free.
+    """
+
+    fpath = Path(fpath)
+    fpath.parent.mkdir(exist_ok=True, parents=True)
+
+    with _thread_lock(str(fpath.resolve())):
+        with open(fpath.with_name(f"{fpath.name}.lock"), "a+") as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+
+@contextmanager
+def atomic_path(fpath):
+    """Yields a temporary path to write fpath to.
+
+    The temporary file is renamed to fpath only if the block succeeds. It
+    keeps the suffix of fpath so writers relying on it still work.
+    """
+
+    fpath = Path(fpath)
+    tmp = fpath.with_name(
+        f".{fpath.stem}.{os.getpid()}.{threading.get_ident()}{fpath.suffix}"
+    )
+    try:
+        yield tmp
+        os.replace(tmp, fpath)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
 def generate_hash_files(path_cache):
     df = gpd.read_file(path_cache / "cities_fua.gpkg")
 
@@ -0,0 +1,216 @@
+"""Opt-in out-of-core execution for the GHSL analytics.
+
+City rasters are opened lazily from the store as dask arrays, but a few
+steps still pull whole bands or stacks into memory: the cluster sums of
+get_urb_growth_df and the reprojections of the display rasters. That is
+fine for most cities, not for the largest metro areas plus their buffer.
+
+When chunked mode is enabled, those steps work strip by strip instead:
+
+- rasters are rechunked so a chunk fits the strip budget,
+- block sums into the SMOD grid read a strip of rows at a time, strips
+  being aligned to the SMOD rows so results are the same,
+- reprojections are done by strips of destination rows, reading only
+  the source window under each strip,
+- dask runs with num_workers threads.
+
+The strip budget is the size of a single chunk or strip as float64, it
+is not a ceiling for the process. Peak memory is that of the process
+before the analytics, plus a few budgets per dask thread, plus the
+outputs, e.g. a display raster of ghsl.DISPLAY_PIXELS a band. What chunked
+mode removes is the full bands and stacks at the resolution of the city.
+
+Enable it with enable() or with the environment variables
+
+    URSA_CHUNKED=1
+    URSA_STRIP_BUDGET=64MB  # size of a chunk or strip, 64MB by default
+    URSA_WORKERS=2          # dask threads, all cores by default
+"""
+
+import gc
+import os
+
+import dask
+import numpy as np
+import rasterio as rio
+import ursa.utils.raster as ru
+import ursa.utils.store as store
+import xarray as xr
+
+from dask.utils import parse_bytes
+from rasterio.enums import Resampling
+from rioxarray.rioxarray import affine_to_coords
+
+# Side of the chunks of the city store
+ALIGN = store.CHUNK_SIZE
+
+# GDAL splits warps above its memory limit into smaller warps, each
+# approximating the transformation over its own part of a row, so a pixel
+# may get another source pixel depending on the split. With OPTIMIZE_SIZE
+# warps are only split into full rows, so strips and whole rasters give
+# the same pixels.
+WARP_OPTIONS = {"OPTIMIZE_SIZE": "TRUE"}
+
+_settings = dict(enabled=False, strip_budget=parse_bytes("64MB"), num_workers=None)
+
+
+def enable(strip_budget="64MB", num_workers=None):
+    """Enables chunked mode with a strip budget in bytes or as a string
+    such as "256MB"."""
+
+    if isinstance(strip_budget, str):
+        strip_budget = parse_bytes(strip_budget)
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    _settings.update(enabled=True, strip_budget=strip_budget, num_workers=num_workers)
+    dask.config.set(scheduler="threads", num_workers=num_workers)
+
+
+def disable():
+    _settings["enabled"] = False
+
+
+def is_enabled():
+    return _settings["enabled"]
+
+
+def chunk_bytes():
+    """Size budget of a single chunk or strip."""
+
+    return _settings["strip_budget"]
+
+
+def chunk_side(itemsize=8):
+    """Side of a square spatial chunk within budget, float64 by default
+    since most operations upcast.
+
+    The side divides ALIGN, so chunks never straddle or merge chunks of the
+    city store.
+    """
+
+    side = int(np.sqrt(chunk_bytes() / itemsize))
+    if side >= ALIGN:
+        return ALIGN
+    return ALIGN // int(np.ceil(ALIGN / max(side, 1)))
+
+
+def strip_rows(width, multiple=1, itemsize=8):
+    """Rows of a full width strip within budget, a multiple of multiple."""
+
+    rows = chunk_bytes() // (width * itemsize)
+    return max(rows // multiple, 1) * multiple
+
+
+def rechunk(raster):
+    """Rechunks a (band, y, x) raster to a band and a budget sized square
+    per chunk."""
+
+    side = chunk_side()
+    return raster.chunk({"band": 1, "y": side, "x": side})
+
+
+def block_sums(band, fine_transform, coarse_transform, coarse_shape):
+    """Strip by strip version of ru.block_sums for a lazy 2D raster.
+
+    Strips start and end on rows of the coarse grid, so each coarse pixel
+    is summed within a single strip and results equal ru.block_sums.
+    """
+
+    f, c = fine_transform, coarse_transform
+    ky = int(round(c.e / f.e))
+    lead = int(round((f.f - c.f) / f.e)) % ky
+
+    height, width = band.shape
+    rows = strip_rows(width, multiple=ky)
+
+    out = np.zeros(coarse_shape, dtype="float64")
+    start = 0
+    # First strip ends on the first coarse row boundary
+    stop = min((ky - lead) % ky or rows, height)
+    while start < height:
+        values = band[start:stop].values
+        out += ru.block_sums(
+            values, f * rio.Affine.translation(0, start), c, coarse_shape
+        )
+        start, stop = stop, min(stop + rows, height)
+
+    return out
+
+
+def reproject(raster, dst_crs, resampling=Resampling.nearest):
+    """Strip by strip version of raster.rio.reproject(dst_crs).
+
+    The destination grid is the one rio.reproject uses. Each strip of
+    destination rows is reprojected from the window of raster under it,
+    so only that window is read.
+    """
+
+    src_crs = raster.rio.crs
+    nodata = raster.rio.nodata
+    dst_transform, dst_width, dst_height = rio.warp.calculate_default_transform(
+        src_crs, dst_crs, raster.rio.width, raster.rio.height, *raster.rio.bounds()
+    )
+
+    n_bands = raster.shape[0] if raster.ndim == 3 else 1
+    rows = strip_rows(dst_width * n_bands)
+    if rows >= dst_height:
+        return raster.rio.reproject(dst_crs, resampling=resampling, **WARP_OPTIONS)
+
+    src_transform = raster.rio.transform()
+
+    out = None
+    for start in range(0, dst_height, rows):
+        stop = min(start + rows, dst_height)
+        strip_transform = dst_transform * rio.Affine.translation(0, start)
+        left, top = strip_transform * (0, 0)
+        right, bottom = strip_transform * (dst_width, stop - start)
+
+        # Source window under the strip, with a halo of a source pixel
+        s_left, s_bottom, s_right, s_top = rio.warp.transform_bounds(
+            dst_crs, src_crs, left, bottom, right, top, densify_pts=21
+        )
+        col_0, row_0 = ~src_transform * (s_left, s_top)
+        col_1, row_1 = ~src_transform * (s_right, s_bottom)
+        window = raster.isel(
+            y=slice(max(int(np.floor(row_0)) - 1, 0), max(int(np.ceil(row_1)) + 1, 0)),
+            x=slice(max(int(np.floor(col_0)) - 1, 0), max(int(np.ceil(col_1)) + 1, 0)),
+        )
+
+        strip = window.rio.write_nodata(nodata).rio.reproject(
+            dst_crs,
+            transform=strip_transform,
+            shape=(stop - start, dst_width),
+            resampling=resampling,
+            **WARP_OPTIONS,
+        )
+
+        # Strips are copied into the full grid rather than concatenated at
+        # the end, which would hold the output twice
+        if out is None:
+            coords = {
+                name: coord
+                for name, coord in strip.coords.items()
+                if not {"y", "x"} & set(coord.dims)
+            }
+            coords.update(affine_to_coords(dst_transform, dst_width, dst_height))
+            values = np.empty(strip.shape[:-2] + (dst_height, dst_width), strip.dtype)
+            out = xr.DataArray(values, coords=coords, dims=strip.dims, attrs=strip.attrs)
+        out.values[..., start:stop, :] = strip.values
+
+        # The rio accessor cached on window and strip makes a reference cycle,
+        # collect them now rather than holding every strip until the end
+        del window, strip
+        gc.collect()
+
+    out.rio.write_transform(dst_transform, inplace=True)
+    out.rio.write_crs(dst_crs, inplace=True)
+
+    return out
+
+
+if os.environ.get("URSA_CHUNKED", "0") == "1":
+    enable(
+        os.environ.get("URSA_STRIP_BUDGET", "64MB"),
+        int(os.environ["URSA_WORKERS"]) if "URSA_WORKERS" in os.environ else None,
+    )
@@ -0,0 +1,106 @@
+"""Concurrent windowed reads from Cloud Optimized GeoTIFFs."""
+
+import time
+
+import rasterio as rio
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+BACKOFF = 0.5
+
+# GDAL settings shared by all worker threads. Skipping directory listings
+# and caching fetched blocks lets reads of the same COG reuse headers and
+# HTTP connections instead of renegotiating them on every window.
+GDAL_ENV = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": 64 * 1024 * 1024,
+}
+
+
+def run_with_retry(task, retries, backoff):
+    """Runs a read task, retrying with exponential backoff on I/O errors.
+
+    Returns the task result and the elapsed time in seconds.
+    """
+
+    for attempt in range(retries + 1):
+        start = time.perf_counter()
+        try:
+            with rio.Env(**GDAL_ENV):
+                result = task()
+            return result, time.perf_counter() - start
+        except rio.errors.RasterioIOError:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def fetch_tasks(
+    tasks,
+    max_workers=MAX_WORKERS,
+    retries=MAX_RETRIES,
+    backoff=BACKOFF,
+    verbose=True,
+):
+    """Runs many read tasks concurrently.
+
+    Each task is run by a bounded pool of threads. Failed reads are retried
+    with exponential backoff before the error is propagated.
+
+    Parameters
+    ----------
+    tasks : dict
+        Mapping from an arbitrary key to a function without arguments that
+        performs a read.
+    max_workers : int
+        Maximum number of reads at the same time.
+    retries : int
+        Number of times a failed read is retried.
+    backoff : float
+        Initial wait in seconds between retries, doubled on each attempt.
+    verbose : bool
+        If True, prints the time spent on each read.
+
+    Returns
+    -------
+    results : dict
+        Mapping from each key in tasks to the result of its function.
+    timings : dict
+        Mapping from each key in tasks to the seconds spent on its read.
+
+    """
+
+    results = {}
+    timings = {}
+
+    if len(tasks) == 0:
+        return results, timings
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = {
+            executor.submit(run_with_retry, task, retries, backoff): key
+            for key, task in tasks.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            results[key], timings[key] = future.result()
+    total = time.perf_counter() - start
+
+    if verbose:
+        for key, elapsed in sorted(timings.items(), key=lambda x: str(x[0])):
+            print(f"    {key}: {elapsed:.2f} s")
+        print(
+            f"    {len(tasks)} reads in {total:.2f} s "
+            f"({sum(timings.values()):.2f} s of serial read time)."
+        )
+
+    return results, timings
+
@@ -2,6 +2,7 @@ from osgeo import gdal
 import numpy as np
 import geopandas as gpd
 import rasterio as rio
+import shapely
 from shapely.geometry import box, Polygon
 import ee
 from pathlib import Path
@@ -24,6 +25,116 @@ def row2cell(row, res_xy):
     return poly
 
 
+def xy2cells(x, y, res_xy):
+    """Vectorized row2cell, returns an array of pixel polygons from arrays
+    of pixel center coordinates."""
+
+    res_x, res_y = res_xy
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    return shapely.box(
+        x - (res_x / 2), y + (res_y / 2), x + (res_x / 2), y - (res_y / 2)
+    )
+
+
+def zonal_sums(values, labels, n_labels):
+    """Sums values per zone of an integer label grid in a single pass.
+
+    NaNs are ignored, as in np.nansum. Returns an array of length n_labels
+    with the sum of each label, 0 included.
+    """
+
+    values = np.asarray(values).ravel()
+    if np.issubdtype(values.dtype, np.floating) and np.isnan(values).any():
+        values = np.where(np.isnan(values), 0, values)
+
+    # Weights are summed in float64
+    return np.bincount(
+        np.asarray(labels).ravel(),
+        weights=values.astype("float64", copy=False),
+        minlength=n_labels,
+    )
+
+
+def is_nested(fine_transform, coarse_transform):
+    """Checks whether every pixel of the fine grid lies within a single
+    pixel of the coarse grid, as for the 100 m and 1 km GHSL grids."""
+
+    f, c = fine_transform, coarse_transform
+    if f.b != 0 or f.d != 0 or c.b != 0 or c.d != 0:
+        return False
+
+    def is_int(x):
+        return np.isclose(x, np.round(x), rtol=0, atol=1e-6)
+
+    return (
+        is_int(c.a / f.a)
+        and is_int(c.e / f.e)
+        and is_int((f.c - c.c) / f.a)
+        and is_int((f.f - c.f) / f.e)
+    )
+
+
+def sum_blocks(values, lead, k):
+    """Sums consecutive blocks of k rows in float64, the first block
+    missing its first lead rows."""
+
+    n = values.shape[0]
+    head = min((k - lead) % k, n)
+    n_full = (n - head) // k
+    tail = n - head - n_full * k
+
+    # Whole blocks are summed through a reshaped view, partial blocks at
+    # the edges on their own
+    parts = []
+    if head > 0:
+        parts.append(values[:head].sum(axis=0, dtype="float64")[None])
+    if n_full > 0:
+        full = values[head : head + n_full * k]
+        full = full.reshape(n_full, k, *values.shape[1:])
+        parts.append(full.sum(axis=1, dtype="float64"))
+    if tail > 0:
+        parts.append(values[n - tail :].sum(axis=0, dtype="float64")[None])
+
+    return np.concatenate(parts)
+
+
+def block_sums(values, fine_transform, coarse_transform, coarse_shape):
+    """Sums a 2D fine raster into the pixels of a nested coarse grid.
+
+    Fine pixels outside the coarse grid are dropped and NaNs are ignored.
+    Sums are accumulated in float64. See is_nested.
+    """
+
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.floating) and np.isnan(values).any():
+        values = np.where(np.isnan(values), 0, values)
+
+    f, c = fine_transform, coarse_transform
+    height, width = coarse_shape
+    ky = int(round(c.e / f.e))
+    kx = int(round(c.a / f.a))
+
+    # Coarse pixel holding the first fine pixel, and the position of the
+    # fine pixel inside it
+    row_0, lead_y = divmod(int(round((f.f - c.f) / f.e)), ky)
+    col_0, lead_x = divmod(int(round((f.c - c.c) / f.a)), kx)
+
+    # Rows first, it sums contiguous memory and shrinks the second pass
+    blocks = sum_blocks(values, lead_y, ky)
+    blocks = sum_blocks(blocks.T, lead_x, kx).T
+    n_rows, n_cols = blocks.shape
+
+    out = np.zeros(coarse_shape, dtype="float64")
+    r0, r1 = max(row_0, 0), min(row_0 + n_rows, height)
+    c0, c1 = max(col_0, 0), min(col_0 + n_cols, width)
+    if r0 < r1 and c0 < c1:
+        out[r0:r1, c0:c1] = blocks[r0 - row_0 : r1 - row_0, c0 - col_0 : c1 - col_0]
+
+    return out
+
+
 def km_2_lat(d):
     # radius of the earth
     R = 6371
@@ -159,25 +270,9 @@ def np_from_bbox_s3(
 
     """
 
-    gdal.PushErrorHandler("CPLQuietErrorHandler")
-
     url = f"http://{bucket}.s3.amazonaws.com/{s3_path}"
 
-    with rio.open(url) as src:
-        profile = src.profile.copy()
-        transform = profile["transform"]
-        window = rio.windows.from_bounds(*bbox.bounds, transform)
-        window = window.round_lengths().round_offsets()
-        # The transform is specified as (dx, rot_x, x_0 , rot_y, dy, y0)
-        new_transform = src.window_transform(window)
-        profile.update(
-            {"height": window.height, "width": window.width, "transform": new_transform}
-        )
-        subset = src.read(window=window)
-    if nodata_to_zero:
-        subset[subset == profile["nodata"]] = 0
-
-    return subset, profile
+    return np_from_bbox(url, bbox, nodata_to_zero)
 
 
 def tif_from_bbox_s3(
@@ -364,7 +459,34 @@ def np_from_bbox_local(local_path, bbox, nodata_to_zero=False):
 
     """
 
-    with rio.open(local_path) as src:
+    return np_from_bbox(local_path, bbox, nodata_to_zero)
+
+
+def np_from_bbox(path, bbox, nodata_to_zero=False):
+    """Reads a windowed raster with bounds defined by bbox from a COG, either
+    a local file or a URL, and stores it in memory in a numpy array.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path or URL of the COG.
+    bbox : Polygon
+        Shapely Polygon defining the raster's bounding box.
+    nodata_to_zero : bool
+        If True, sets the output raster's nodata attribute to 0.
+
+    Returns
+    -------
+    subset : np.array
+        Numpy array with raster data.
+    profile : dict
+        Dictionary with geographical properties of the raster.
+
+    """
+
+    gdal.PushErrorHandler("CPLQuietErrorHandler")
+
+    with rio.open(path) as src:
         profile = src.profile.copy()
         transform = profile["transform"]
         window = rio.windows.from_bounds(*bbox.bounds, transform)
@@ -381,6 +503,54 @@ def np_from_bbox_local(local_path, bbox, nodata_to_zero=False):
     return subset, profile
 
 
+def decimation_factor(height, width, max_pixels):
+    """Smallest integer factor that brings a height x width grid
+    within max_pixels."""
+
+    return max(1, int(np.ceil(np.sqrt(height * width / max_pixels))))
+
+
+def decimate(raster, max_pixels):
+    """Reduces a (band,) y, x raster to a display pixel budget.
+
+    Blocks of factor x factor pixels are averaged, so only intensive
+    quantities such as densities or fractions should be decimated.
+    Incomplete blocks on the bottom and right edges are dropped.
+
+    Parameters
+    ----------
+    raster : DataArray
+        Input raster.
+    max_pixels : int
+        Maximum number of pixels per band in the output raster.
+
+    Returns
+    -------
+    decimated : DataArray
+        Decimated raster, unchanged if already within budget.
+    factor : int
+        Decimation factor applied to each spatial dimension.
+
+    """
+
+    factor = decimation_factor(raster.rio.height, raster.rio.width, max_pixels)
+    if factor == 1:
+        return raster, factor
+
+    transform = raster.rio.transform()
+    crs = raster.rio.crs
+    nodata = raster.rio.nodata
+
+    decimated = raster.coarsen(x=factor, y=factor, boundary="trim").mean()
+    decimated = decimated.rio.write_crs(crs)
+    decimated = decimated.rio.write_transform(
+        transform * transform.scale(factor, factor)
+    )
+    decimated = decimated.rio.write_nodata(nodata)
+
+    return decimated, factor
+
+
 def pop_2_density(raster, units="ha", save=False):
     """Tranforms a populatiuon counts raster into a population density raster.
 
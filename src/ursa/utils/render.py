@@ -0,0 +1,168 @@
+"""Raster rendering helpers for the GHSL maps.
+
+Rasters are colorized by first turning them into integer indices into a
+color table, either their class or their position in a continuous color
+map, and then gathering the RGBA rows of the table in one pass. Index 0
+is always transparent. The gather runs in parallel with numba when it is
+installed and falls back to numpy fancy indexing otherwise.
+
+Tables reproduce the colors matplotlib gives for the same color maps, so
+rendered images match the ones built with cmap(values).
+
+Rendered PNG files are kept by PNGCache in memory and optionally on disk,
+keyed by city hash, layer, year and threshold.
+"""
+
+import io
+import threading
+
+import matplotlib.pyplot as plt
+import numpy as np
+import ursa.utils.cache as uc
+
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Entries of continuous color tables, as in matplotlib color maps
+N_COLORS = 256
+
+
+@lru_cache(maxsize=None)
+def categorical_table(name, n):
+    """Table with the n colors of color map name, for codes 1 to n."""
+
+    colors = plt.get_cmap(name, n)(np.arange(n), bytes=True)
+    return _with_transparent(colors)
+
+
+@lru_cache(maxsize=None)
+def class_table(name, n):
+    """Table for codes 1 to n, class k gets the color of k / n in color map
+    name."""
+
+    colors = plt.get_cmap(name)(np.arange(1, n + 1) / n, bytes=True)
+    return _with_transparent(colors)
+
+
+@lru_cache(maxsize=None)
+def continuous_table(name):
+    """Table for the indices given by continuous_index."""
+
+    colors = plt.get_cmap(name)(np.arange(N_COLORS), bytes=True)
+    return _with_transparent(colors)
+
+
+def _with_transparent(colors):
+    table = np.zeros((len(colors) + 1, 4), dtype="uint8")
+    table[1:] = colors
+    table.flags.writeable = False
+    return table
+
+
+def continuous_index(values, vmin=0.0, vmax=1.0):
+    """Indices into continuous_table of values scaled from vmin to vmax.
+
+    Values out of range get the first or last color, zeros and NaN are
+    transparent.
+    """
+
+    values = np.asarray(values, dtype="float64")
+    scaled = (values - vmin) / (vmax - vmin)
+    index = np.clip(np.floor(scaled * N_COLORS), 0, N_COLORS - 1) + 1
+    index[(values == 0) | np.isnan(values)] = 0
+    return index.astype("uint16")
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _gather(index, table, out):
+        for i in numba.prange(index.size):
+            for c in range(4):
+                out[i, c] = table[index[i], c]
+
+
+def apply_lut(index, table):
+    """Colorizes an integer index array through an RGBA table.
+
+    Parameters
+    ----------
+    index : np.ndarray
+        Integer array with values between 0 and len(table) - 1.
+    table : np.ndarray
+        uint8 array with shape (n, 4).
+
+    Returns
+    -------
+    rgba : np.ndarray
+        uint8 array with shape index.shape + (4,).
+
+    """
+
+    index = np.asarray(index)
+    assert index.min(initial=0) >= 0 and index.max(initial=0) < len(table)
+
+    if numba is None:
+        return table[index]
+
+    flat = np.ascontiguousarray(index, dtype="intp").ravel()
+    out = np.empty((flat.size, 4), dtype="uint8")
+    _gather(flat, np.ascontiguousarray(table), out)
+    return out.reshape(*index.shape, 4)
+
+
+def encode_png(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(rgba).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class PNGCache:
+    """LRU cache of rendered PNG files.
+
+    Keys are tuples starting with (id_hash, layer, year, thresh). If a
+    path function is given, PNG files are also written to and read from
+    the path it returns for each key, so they survive restarts and are
+    shared between server processes.
+    """
+
+    def __init__(self, maxsize, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        """Returns the PNG for key, calling render() if it is not cached."""
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        fpath = self.path(key) if self.path is not None else None
+        if fpath is not None and fpath.exists():
+            png = fpath.read_bytes()
+        else:
+            png = render()
+            if fpath is not None:
+                fpath.parent.mkdir(exist_ok=True, parents=True)
+                with uc.atomic_path(fpath) as tmp:
+                    tmp.write_bytes(png)
+
+        with self._lock:
+            self._items[key] = png
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+        return png
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
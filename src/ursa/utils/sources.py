@@ -0,0 +1,123 @@
+"""Backends serving the remote rasters and arrays used by URSA.
+
+Every GHSL, LAND and SLEUTH prediction read goes through a raster source.
+Paths are always relative to the root of the public bucket, e.g.
+"GHSL/GHS_POP/GHS_POP_E2020_GLOBE_R2023A_54009_100_V1_0.tif", so a mirror
+only needs to replicate the bucket layout.
+
+The backend is chosen with environment variables:
+
+    URSA_RASTER_SOURCE
+        "s3" (default) reads from the public Amazon S3 bucket.
+        "local" reads from a directory mirroring the bucket, e.g. an NFS share.
+        "http" reads from any HTTP server mirroring the bucket, e.g.
+        `python -m http.server` started on a local mirror.
+    URSA_RASTER_ROOT
+        Mirror directory for "local", base URL for "http".
+"""
+
+import os
+import requests
+
+import rasterio as rio
+import ursa.utils.raster as ru
+
+from pathlib import Path
+
+DEFAULT_BUCKET = "tec-expansion-urbana-p"
+
+
+class RasterSource:
+    """Base class for raster backends, resolves relative paths into
+    something rasterio can open."""
+
+    def locate(self, path):
+        raise NotImplementedError
+
+    def read_window(self, path, bbox, nodata_to_zero=False):
+        """Reads the window defined by bbox from the COG at path.
+
+        Returns a (subset, profile) tuple, see ursa.utils.raster.np_from_bbox.
+        """
+        return ru.np_from_bbox(self.locate(path), bbox, nodata_to_zero)
+
+    def read_profile(self, path):
+        """Reads the profile of the whole COG at path."""
+        with rio.open(self.locate(path)) as src:
+            return src.profile.copy()
+
+    def read_pixels(self, path, window):
+        """Reads a pixel window, in the grid of the whole COG, from path."""
+        with rio.open(self.locate(path)) as src:
+            return src.read(window=window)
+
+    def read_bytes(self, path):
+        """Reads a whole file. Raises FileNotFoundError if it does not exist."""
+        raise NotImplementedError
+
+
+class HTTPSource(RasterSource):
+    """Rasters served by a plain HTTP server."""
+
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+
+    def locate(self, path):
+        return f"{self.root}/{path}"
+
+    def read_bytes(self, path):
+        url = self.locate(path)
+        r = requests.get(url, allow_redirects=True)
+        if r.status_code != 200:
+            raise FileNotFoundError(f"{url} returned status code {r.status_code}.")
+        return r.content
+
+
+class S3Source(HTTPSource):
+    """Rasters in a public Amazon S3 bucket."""
+
+    def __init__(self, bucket=DEFAULT_BUCKET):
+        super().__init__(f"http://{bucket}.s3.amazonaws.com")
+
+
+class LocalSource(RasterSource):
+    """Rasters in a local directory with the same layout as the bucket."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def locate(self, path):
+        return self.root / path
+
+    def read_bytes(self, path):
+        with open(self.locate(path), "rb") as f:
+            return f.read()
+
+
+def get_source(bucket=DEFAULT_BUCKET):
+    """Returns the raster source selected by URSA_RASTER_SOURCE.
+
+    Parameters
+    ----------
+    bucket : str
+        Name of the S3 bucket, only used by the s3 backend.
+
+    Returns
+    -------
+    source : RasterSource
+
+    """
+
+    kind = os.environ.get("URSA_RASTER_SOURCE", "s3").lower()
+    root = os.environ.get("URSA_RASTER_ROOT")
+
+    if kind == "s3":
+        return S3Source(bucket)
+
+    assert root is not None, f"URSA_RASTER_ROOT must be set for the {kind} source."
+    if kind == "local":
+        return LocalSource(root)
+    elif kind == "http":
+        return HTTPSource(root)
+
+    raise ValueError(f"Unknown raster source {kind}.")
@@ -0,0 +1,111 @@
+"""Chunked per-city raster store.
+
+All the GHS rasters of a city are kept in a single compressed Zarr store
+inside the city cache. Each raster is stored as a variable chunked by band
+and by spatial tiles, so opening it is lazy and only the bands and windows
+that are actually used get read and decompressed.
+
+Rasters in the store have different grids and years, so each variable gets
+its own dimensions, suffixed with the variable name, e.g. SMOD_1000 has
+dimensions (band_SMOD_1000, y_SMOD_1000, x_SMOD_1000). They are renamed back
+to (band, y, x) when opened.
+
+Each variable gets a random version when written, products rendered from it
+can include it in their cache keys, see raster_version.
+"""
+
+import uuid
+
+import xarray as xr
+
+from affine import Affine
+
+STORE_NAME = "ghsl.zarr"
+CHUNK_SIZE = 512
+
+
+def store_path(path_cache):
+    return path_cache / STORE_NAME
+
+
+def has_raster(path_cache, name):
+    """Checks whether the variable name exists in the city store."""
+
+    fpath = store_path(path_cache)
+    if not fpath.exists():
+        return False
+
+    with xr.open_zarr(fpath) as ds:
+        return name in ds.data_vars
+
+
+def write_raster(path_cache, name, raster):
+    """Adds a (band, y, x) raster to the city store as variable name.
+
+    Parameters
+    ----------
+    path_cache : Path
+        Path to the city cache directory.
+    name : str
+        Name of the variable, e.g. POP_100.
+    raster : xarray.DataArray
+        Raster with band, y and x dimensions and spatial metadata.
+
+    """
+
+    dims = {dim: f"{dim}_{name}" for dim in ("band", "y", "x")}
+    _, height, width = raster.shape
+
+    da = raster.drop_vars("spatial_ref", errors="ignore").rename(dims)
+    da.attrs = {
+        "crs": raster.rio.crs.to_wkt(),
+        "transform": list(raster.rio.transform())[:6],
+        "nodata": raster.rio.nodata,
+        "version": uuid.uuid4().hex[:12],
+    }
+    da.encoding = {}
+
+    chunks = (1, min(CHUNK_SIZE, height), min(CHUNK_SIZE, width))
+    da.to_dataset(name=name).to_zarr(
+        store_path(path_cache), mode="a", encoding={name: {"chunks": chunks}}
+    )
+
+
+def raster_version(path_cache, name):
+    """Version of variable name, it changes whenever the variable is written.
+
+    Variables written before versions existed share version "0". Returns
+    None if the variable is not in the store.
+    """
+
+    fpath = store_path(path_cache)
+    if not fpath.exists():
+        return None
+
+    with xr.open_zarr(fpath) as ds:
+        if name not in ds.data_vars:
+            return None
+        return ds[name].attrs.get("version", "0")
+
+
+def open_raster(path_cache, name):
+    """Lazily opens variable name from the city store.
+
+    Returns
+    -------
+    raster : xarray.DataArray
+        Dask backed raster with band, y and x dimensions, chunked as stored.
+
+    """
+
+    ds = xr.open_zarr(store_path(path_cache), chunks={})
+    da = ds[name]
+    attrs = da.attrs
+
+    da = da.rename({f"{dim}_{name}": dim for dim in ("band", "y", "x")})
+    da.attrs = {}
+    da = da.rio.write_crs(attrs["crs"])
+    da = da.rio.write_transform(Affine(*attrs["transform"]))
+    da = da.rio.write_nodata(attrs["nodata"])
+
+    return da
@@ -0,0 +1,206 @@
+"""Global tile cache for windowed reads from the GHSL COGs.
+
+Windows are never cached as such. Instead, each COG is split into fixed
+TILE_SIZE x TILE_SIZE pixel tiles aligned to its own grid, and tiles are
+stored once in a directory shared by all cities. Any bounding box is then
+assembled from the cached tiles, fetching only the ones that are missing,
+so custom sub-regions and overlapping neighbouring cities reuse the tiles
+already downloaded.
+
+The cache lives in URSA_TILE_CACHE, ./data/cache/tiles by default, with a
+directory per COG holding its profile and its tiles as .npy files.
+"""
+
+import json
+import os
+
+import numpy as np
+import rasterio as rio
+import ursa.utils.cache as uc
+import ursa.utils.fetch as fetch
+
+from affine import Affine
+from pathlib import Path
+
+TILE_SIZE = 512
+TILE_CACHE_PATH = Path(os.environ.get("URSA_TILE_CACHE", "./data/cache/tiles"))
+
+
+def cog_dir(path):
+    return TILE_CACHE_PATH / Path(path).stem
+
+
+def profile_to_json(profile):
+    return {
+        "crs": profile["crs"].to_wkt(),
+        "transform": list(profile["transform"])[:6],
+        "width": profile["width"],
+        "height": profile["height"],
+        "count": profile["count"],
+        "dtype": profile["dtype"],
+        "nodata": profile["nodata"],
+    }
+
+
+def profile_from_json(profile_json):
+    profile = dict(profile_json)
+    profile["driver"] = "GTiff"
+    profile["crs"] = rio.crs.CRS.from_wkt(profile["crs"])
+    profile["transform"] = Affine(*profile["transform"])
+    return profile
+
+
+def load_profiles(paths, source):
+    """Loads the profiles of the whole COGs, fetching the unknown ones."""
+
+    profiles = {}
+    missing = []
+    for path in paths:
+        fpath = cog_dir(path) / "profile.json"
+        if fpath.exists():
+            with open(fpath, "r") as f:
+                profiles[path] = profile_from_json(json.load(f))
+        else:
+            missing.append(path)
+
+    tasks = {path: (lambda path=path: source.read_profile(path)) for path in missing}
+    results, _ = fetch.fetch_tasks(tasks, verbose=False)
+
+    for path, profile in results.items():
+        profile_json = profile_to_json(profile)
+        fpath = cog_dir(path) / "profile.json"
+        with uc.locked(fpath):
+            with uc.atomic_path(fpath) as tmp:
+                with open(tmp, "w") as f:
+                    json.dump(profile_json, f)
+        profiles[path] = profile_from_json(profile_json)
+
+    return profiles
+
+
+def bbox_window(bbox, transform):
+    """Window of bbox in a grid, rounded as in ursa.utils.raster.np_from_bbox."""
+
+    window = rio.windows.from_bounds(*bbox.bounds, transform)
+    return window.round_lengths().round_offsets()
+
+
+def tile_window(row, col, profile):
+    col_off = col * TILE_SIZE
+    row_off = row * TILE_SIZE
+    return rio.windows.Window(
+        col_off,
+        row_off,
+        min(TILE_SIZE, profile["width"] - col_off),
+        min(TILE_SIZE, profile["height"] - row_off),
+    )
+
+
+def tiles_for_window(window):
+    """Returns the (row, col) indices of all tiles intersecting window."""
+
+    row_start = int(window.row_off) // TILE_SIZE
+    row_stop = (int(window.row_off) + int(window.height) - 1) // TILE_SIZE
+    col_start = int(window.col_off) // TILE_SIZE
+    col_stop = (int(window.col_off) + int(window.width) - 1) // TILE_SIZE
+
+    return [
+        (row, col)
+        for row in range(row_start, row_stop + 1)
+        for col in range(col_start, col_stop + 1)
+    ]
+
+
+def assemble(path, window, profile):
+    """Builds the window array from the cached tiles of a COG."""
+
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    height, width = int(window.height), int(window.width)
+
+    subset = np.zeros((profile["count"], height, width), dtype=profile["dtype"])
+    for row, col in tiles_for_window(window):
+        tile = np.load(cog_dir(path) / f"{row}_{col}.npy")
+        t_row, t_col = row * TILE_SIZE, col * TILE_SIZE
+
+        # Overlap between tile and window in global pixel coordinates
+        r0 = max(row_off, t_row)
+        r1 = min(row_off + height, t_row + tile.shape[1])
+        c0 = max(col_off, t_col)
+        c1 = min(col_off + width, t_col + tile.shape[2])
+
+        subset[:, r0 - row_off : r1 - row_off, c0 - col_off : c1 - col_off] = tile[
+            :, r0 - t_row : r1 - t_row, c0 - t_col : c1 - t_col
+        ]
+
+    return subset
+
+
+def read_bbox_many(jobs, bbox, source, nodata_to_zero=True):
+    """Reads windows with the same bounds from several COGs through the
+    tile cache.
+
+    Equivalent to reading each window with source.read_window, except that
+    only the tiles not yet in the cache are fetched from the raster source.
+
+    Parameters
+    ----------
+    jobs : dict
+        Mapping from an arbitrary key to the relative path of a COG.
+    bbox : Polygon
+        Shapely Polygon defining the windows' bounding box.
+    source : RasterSource
+        Backend serving the COGs, see ursa.utils.sources.
+    nodata_to_zero : bool
+        If True, sets the output rasters' nodata values to 0.
+
+    Returns
+    -------
+    results : dict
+        Mapping from each key in jobs to a (subset, profile) tuple.
+
+    """
+
+    paths = sorted(set(jobs.values()))
+    profiles = load_profiles(paths, source)
+
+    windows = {}
+    tasks = {}
+    n_tiles = 0
+    for path in paths:
+        profile = profiles[path]
+        window = bbox_window(bbox, profile["transform"])
+        windows[path] = window
+        for row, col in tiles_for_window(window):
+            n_tiles += 1
+            if (cog_dir(path) / f"{row}_{col}.npy").exists():
+                continue
+            t_window = tile_window(row, col, profile)
+            tasks[(Path(path).stem, row, col)] = (
+                lambda path=path, t_window=t_window: source.read_pixels(
+                    path, t_window
+                )
+            )
+
+    print(f"    {n_tiles - len(tasks)} of {n_tiles} tiles found in the tile cache.")
+    tiles, _ = fetch.fetch_tasks(tasks)
+    for (stem, row, col), tile in tiles.items():
+        with uc.atomic_path(TILE_CACHE_PATH / stem / f"{row}_{col}.npy") as tmp:
+            np.save(tmp, tile)
+
+    results = {}
+    for key, path in jobs.items():
+        profile = profiles[path].copy()
+        window = windows[path]
+        subset = assemble(path, window, profile)
+        if nodata_to_zero:
+            subset[subset == profile["nodata"]] = 0
+        profile.update(
+            {
+                "height": window.height,
+                "width": window.width,
+                "transform": rio.windows.transform(window, profile["transform"]),
+            }
+        )
+        results[key] = (subset, profile)
+
+    return results
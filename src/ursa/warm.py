@@ -0,0 +1,336 @@
+"""Pre-bakes the city cache for a batch of cities.
+
+Runs, for every selected city, the same work the app does on its first
+visit: GHSL rasters, Degree of Urbanization, urban growth table, display
+rasters and map tiles up to tiles.WARM_ZOOM, SLEUTH inputs and heat island
+statistics. Cities are processed in parallel by a pool of processes.
+
+Completed stages are recorded in warm.json inside each city cache, so an
+interrupted run resumes where it stopped. A row per city and stage, with
+its status and duration, is appended to the timing report as cities finish.
+
+Usage:
+
+    ursa-warm                                  # all cities in city_hashes.json
+    ursa-warm --country Argentina --country Chile
+    ursa-warm --city México "Ciudad de México" --workers 4
+    ursa-warm --country Brazil --strip-budget 256MB
+    ursa-warm --country Brazil --workers 1 --dou-workers 8
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import ee
+import pandas as pd
+import ursa.degree_of_urbanization as dou
+import ursa.ghsl as ghsl
+import ursa.prefetch as prefetch
+import ursa.tiles as tiles
+import ursa.utils.cache as uc
+import ursa.utils.chunked as chunked
+import ursa.utils.geometry as ug
+import ursa.utils.raster as ru
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+PATH_CITIES = Path("./data/output/cities/")
+PATH_CACHE = Path("./data/cache/")
+
+# Processes per city for the DoU years, set by init_worker
+_dou_workers = 1
+
+
+def stage_dou(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    # Workers of warm run a single city each, they can fork a pool
+    dou.load_or_process_dou(bbox_mollweide, path_cache, max_workers=_dou_workers)
+
+
+def stage_growth(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    uc_mollweide = ug.reproject_geometry(uc_latlon, "ESRI:54009")
+    smod, built, pop = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
+    ghsl.load_or_get_urb_growth_df(
+        smod=smod,
+        built=built,
+        pop=pop,
+        centroid_mollweide=uc_mollweide.centroid,
+        path_cache=path_cache,
+    )
+
+
+def stage_display(bbox_latlon, uc_latlon, bbox_mollweide, path_cache):
+    # Display rasters of the image overlays, then the tiles of the maps
+    smod, built, pop = ghsl.load_plot_datasets(bbox_mollweide, path_cache, clip=True)
+    ghsl.load_or_get_first_year(built, path_cache=path_cache)
+    ghsl.load_or_get_display_density(built, "built", "m", path_cache=path_cache)
+    ghsl.load_or_get_display_density(pop, "pop", "km", path_cache=path_cache)
+    tiles.warm_tiles(path_cache.name)
+
+
+# Stages in the order they are run for each city
+STAGES = {
+    "ghsl": prefetch.stage_ghsl,
+    "dou": stage_dou,
+    "growth": stage_growth,
+    "display": stage_display,
+    "sleuth": prefetch.stage_sleuth,
+    "suhi": prefetch.stage_suhi,
+}
+
+
+def list_cities(path_cities, countries=None, cities=None):
+    """Returns the (country, city) pairs to warm.
+
+    All the cities in city_hashes.json, as written by
+    ursa.utils.cache.generate_hash_files, if neither countries nor cities
+    are given.
+    """
+
+    with open(path_cities / "city_hashes.json", "r", encoding="utf8") as f:
+        hashes = json.load(f)
+
+    all_cities = [
+        (country, city) for country, names in hashes.items() for city in names
+    ]
+    if not countries and not cities:
+        return all_cities
+
+    countries = set(countries or [])
+    cities = set(tuple(c) for c in cities or [])
+    selected = [c for c in all_cities if c[0] in countries or c in cities]
+
+    unknown = cities - set(all_cities)
+    assert len(unknown) == 0, f"Unknown cities: {sorted(unknown)}."
+
+    return selected
+
+
+def load_done(fpath):
+    if fpath.exists():
+        with open(fpath, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def warm_city(country, city, stages, path_cities, path_cache):
+    """Runs the missing stages for a city.
+
+    A failed stage is reported and does not stop the following ones, it
+    is retried on the next run.
+
+    Returns
+    -------
+    rows : list of dict
+        A row per stage with the city, its hash, the stage status and the
+        seconds spent on it.
+
+    """
+
+    bbox_latlon, uc_latlon, _ = ru.get_bboxes(city, country, path_cities)
+    bbox_mollweide = ug.reproject_geometry(bbox_latlon, "ESRI:54009").envelope
+
+    # Same hash as the one used by the app, see pages/home.py
+    id_hash = ug.hash_geometry(ug.geometry_to_json(bbox_latlon))
+    city_cache = path_cache / str(id_hash)
+    city_cache.mkdir(exist_ok=True, parents=True)
+
+    fpath_done = city_cache / "warm.json"
+    done = load_done(fpath_done)
+
+    rows = []
+    for name in stages:
+        row = dict(country=country, city=city, id_hash=id_hash, stage=name)
+        if name in done:
+            row.update(status="cached", seconds=0.0)
+            rows.append(row)
+            continue
+
+        start = time.perf_counter()
+        try:
+            STAGES[name](bbox_latlon, uc_latlon, bbox_mollweide, city_cache)
+            status = "ok"
+        except Exception as e:
+            status = f"error: {e}"
+        elapsed = time.perf_counter() - start
+        row.update(status=status, seconds=elapsed)
+        rows.append(row)
+
+        if status == "ok":
+            done[name] = elapsed
+            with uc.atomic_path(fpath_done) as tmp, open(tmp, "w") as f:
+                json.dump(done, f)
+
+    return rows
+
+
+def init_worker(path_cache, strip_budget=None, dou_workers=1):
+    global _dou_workers
+    _dou_workers = dou_workers
+
+    # Tiles are read from and written to the city caches under path_cache
+    tiles.PATH_CACHE = path_cache
+
+    if strip_budget is not None:
+        chunked.enable(strip_budget, num_workers=1)
+
+    try:
+        ee.Initialize()
+    except Exception as e:
+        print(f"Google Earth Engine not available, GEE stages will fail: {e}")
+
+
+def warm(
+    cities,
+    stages=None,
+    max_workers=2,
+    path_cities=PATH_CITIES,
+    path_cache=PATH_CACHE,
+    report_path=None,
+    strip_budget=None,
+    dou_workers=1,
+):
+    """Warms the cache of several cities with a pool of processes.
+
+    Parameters
+    ----------
+    cities : list of tuple
+        List of (country, city) pairs.
+    stages : list of str
+        Stages to run, a subset of STAGES. All of them by default.
+    max_workers : int
+        Number of cities processed at the same time.
+    path_cities : Path
+        Directory with cities_fua.gpkg and city_hashes.json.
+    path_cache : Path
+        Root of the city caches.
+    report_path : Path
+        CSV file the timing report is appended to. Defaults to
+        warm_report.csv in path_cache.
+    strip_budget : str or int, optional
+        Runs each worker in chunked mode with this strip budget, e.g.
+        "256MB", see ursa.utils.chunked.
+    dou_workers : int
+        Processes classifying the DoU years of each city, see
+        ursa.degree_of_urbanization.dou_for_ghs.
+
+    Returns
+    -------
+    report : DataFrame
+        Timing report of this run.
+
+    """
+
+    if stages is None:
+        stages = list(STAGES)
+    assert all(s in STAGES for s in stages), f"Stages must be in {list(STAGES)}."
+
+    if report_path is None:
+        report_path = path_cache / "warm_report.csv"
+    report_path.parent.mkdir(exist_ok=True, parents=True)
+
+    all_rows = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_worker,
+        initargs=(path_cache, strip_budget, dou_workers),
+    ) as executor:
+        futures = {
+            executor.submit(
+                warm_city, country, city, stages, path_cities, path_cache
+            ): (country, city)
+            for country, city in cities
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            country, city = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                rows = [
+                    dict(
+                        country=country,
+                        city=city,
+                        id_hash=None,
+                        stage=None,
+                        status=f"error: {e}",
+                        seconds=0.0,
+                    )
+                ]
+
+            # Append as cities finish, so an interrupted run keeps its report
+            df = pd.DataFrame(rows)
+            df.to_csv(
+                report_path, mode="a", header=not report_path.exists(), index=False
+            )
+            all_rows += rows
+
+            seconds = sum(row["seconds"] for row in rows)
+            failed = [
+                row["stage"]
+                for row in rows
+                if row["status"] not in ("ok", "cached")
+            ]
+            print(
+                f"[{i}/{len(cities)}] {city}, {country}: {seconds:.1f} s"
+                + (f", failed: {failed}" if failed else "")
+            )
+
+    print(f"Warmed {len(cities)} cities in {time.perf_counter() - start:.1f} s.")
+
+    return pd.DataFrame(all_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-bakes the URSA city cache.")
+    parser.add_argument(
+        "--country", action="append", help="Warm all the cities of a country."
+    )
+    parser.add_argument(
+        "--city",
+        action="append",
+        nargs=2,
+        metavar=("COUNTRY", "CITY"),
+        help="Warm a single city.",
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+        help="Stages to run.",
+    )
+    parser.add_argument("--workers", type=int, default=2, help="Parallel cities.")
+    parser.add_argument("--cities-path", type=Path, default=PATH_CITIES)
+    parser.add_argument("--cache-path", type=Path, default=PATH_CACHE)
+    parser.add_argument("--report", type=Path, default=None)
+    parser.add_argument(
+        "--strip-budget",
+        default=None,
+        help="Size of the strips of a city, e.g. 256MB. Enables chunked mode.",
+    )
+    parser.add_argument(
+        "--dou-workers",
+        type=int,
+        default=1,
+        help="Processes per city for the Degree of Urbanization years.",
+    )
+    args = parser.parse_args()
+
+    cities = list_cities(args.cities_path, args.country, args.city)
+    if len(cities) == 0:
+        print("No cities selected.")
+        sys.exit(1)
+
+    warm(
+        cities,
+        stages=args.stages,
+        max_workers=args.workers,
+        path_cities=args.cities_path,
+        path_cache=args.cache_path,
+        report_path=args.report,
+        strip_budget=args.strip_budget,
+        dou_workers=args.dou_workers,
+    )